@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+upsert_to_excel ベンチマーク
+
+1k/10k/100k 行のワークブック（カスタム列・既存テーブルあり）を生成し、
+次の処理の所要時間とピークメモリを計測して JSON に保存します。
+
+- upsert_to_excel: append（新規行の追加）/ update（既存行の多数更新）/ new_column（列の追加）
+- read_existing_data_from_sheet: 既存シートの読み込み
+- manage_table: テーブル範囲の更新
+
+使用例:
+    python bench_upsert_to_excel.py
+    python bench_upsert_to_excel.py --sizes 1000 10000 --index -o bench_output.json
+    python bench_upsert_to_excel.py --compare old.json   # 前回の結果より遅くなった項目を表示
+"""
+
+import io
+import os
+import sys
+import json
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+from time import perf_counter
+from datetime import datetime, timedelta
+from contextlib import redirect_stdout
+
+import numpy as np
+import pandas as pd
+import openpyxl
+from openpyxl import load_workbook
+
+from cf_term_data import (upsert_to_excel, read_existing_data_from_sheet, manage_table,
+                          EXCEL_INDEX_SUFFIX)
+
+SHEET_NAME = 'user_asset_act'
+TABLE_NAME = 'user_asset_act'
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+SCENARIOS = ('append', 'update', 'new_column')
+
+# append: 既存行の末尾 APPEND_RATIO を再取得し、同じ数の新規行を追加
+# update: 既存行の UPDATE_RATIO の amount / memo を変更
+APPEND_RATIO = 0.01
+UPDATE_RATIO = 0.2
+
+
+def make_frame(n, start_id=1, seed=0):
+    """user_asset_act に似た n 行の DataFrame を作る"""
+    rng = np.random.default_rng(seed)
+    ids = np.arange(start_id, start_id + n)
+    base = datetime(2015, 1, 1)
+    recognized_at = [(base + timedelta(days=int(d))).isoformat() + '+09:00' for d in (ids % 3650)]
+    categories = np.array(['食費', '日用品', '交通費', '趣味・娯楽', '住宅', '水道・光熱費'])
+    return pd.DataFrame({
+        'id': ids,
+        'date': [r[2:10].replace('-', '/') for r in recognized_at],
+        'content': [f'店舗{i % 500}' for i in ids],
+        'amount': -rng.integers(100, 50000, n),
+        'large_category': categories[rng.integers(0, len(categories), n)],
+        'middle_category': categories[rng.integers(0, len(categories), n)],
+        'memo': [None] * n,
+        'recognized_at': recognized_at,
+    })
+
+
+def make_workbook(path, n):
+    """n 行のワークブックを作り、カスタム列を追加する（テーブルはカスタム列を含まない）"""
+    with redirect_stdout(io.StringIO()):
+        upsert_to_excel(make_frame(n), SHEET_NAME, path, 'id', TABLE_NAME)
+    wb = load_workbook(path)
+    ws = wb[SHEET_NAME]
+    custom_col = ws.max_column + 2
+    ws.cell(row=1, column=custom_col, value='custom')
+    for row in range(2, n + 2, 7):
+        ws.cell(row=row, column=custom_col, value=f'note {row}')
+    wb.save(path)
+
+
+def scenario_frame(scenario, n):
+    if scenario == 'append':
+        k = max(1, int(n * APPEND_RATIO))
+        return pd.concat([make_frame(n).tail(k), make_frame(k, start_id=n + 1, seed=1)], ignore_index=True)
+    if scenario == 'update':
+        df = make_frame(n)
+        changed = df.sample(frac=UPDATE_RATIO, random_state=0).index
+        df.loc[changed, 'amount'] = df.loc[changed, 'amount'] - 1
+        df['memo'] = df['memo'].astype(object)
+        df.loc[changed, 'memo'] = 'updated'
+        return df
+    if scenario == 'new_column':
+        df = make_frame(n)
+        df['new_col'] = df['id'] % 10
+        return df
+    raise ValueError(f'invalid scenario: {scenario}')
+
+
+def measure(func, memory=True):
+    """func を実行し (戻り値, 秒, ピークメモリMB) を返す。memory=True の場合は2回目を tracemalloc で計測する"""
+    with redirect_stdout(io.StringIO()):
+        start = perf_counter()
+        result = func()
+        seconds = perf_counter() - start
+        peak = None
+        if memory:
+            tracemalloc.start()
+            try:
+                func()
+                peak = tracemalloc.get_traced_memory()[1] / 2**20
+            finally:
+                tracemalloc.stop()
+    return result, seconds, peak
+
+
+def bench_size(n, work_dir, index=False, memory=True):
+    results = []
+    base = os.path.join(work_dir, f'base_{n}.xlsx')
+    make_workbook(base, n)
+    size_mb = os.path.getsize(base) / 2**20
+
+    def record(benchmark, scenario, seconds, peak, phases=None):
+        results.append({'rows': n, 'benchmark': benchmark, 'scenario': scenario, 'index': index,
+                        'seconds': round(seconds, 4), 'phases': phases,
+                        'peak_memory_mb': None if peak is None else round(peak, 2),
+                        'file_mb': round(size_mb, 2)})
+        print(f'{n:>7} {benchmark:<30} {scenario:<11} {seconds:8.3f}s'
+              + ('' if peak is None else f' {peak:8.1f}MB'), file=sys.stderr)
+
+    # read_existing_data_from_sheet / manage_table (ワークブックの読み込みは含めない)
+    ws = load_workbook(base)[SHEET_NAME]
+    _, seconds, peak = measure(lambda: read_existing_data_from_sheet(ws, 'id', SHEET_NAME), memory)
+    record('read_existing_data_from_sheet', 'full', seconds, peak)
+    ws = load_workbook(base, read_only=True)[SHEET_NAME]
+    _, seconds, peak = measure(lambda: read_existing_data_from_sheet(ws, 'id', SHEET_NAME), memory)
+    record('read_existing_data_from_sheet', 'read_only', seconds, peak)
+    ws.parent.close()
+
+    ws = load_workbook(base)[SHEET_NAME]
+    max_col = len(make_frame(1).columns)
+    _, seconds, peak = measure(lambda: manage_table(ws, TABLE_NAME, max_col, n + 1 + int(n * APPEND_RATIO)), memory)
+    record('manage_table', 'extend', seconds, peak)
+    del ws
+
+    if index:
+        # 変更の無い upsert でインデックスを作っておく
+        with redirect_stdout(io.StringIO()):
+            upsert_to_excel(make_frame(n), SHEET_NAME, base, 'id', TABLE_NAME, base + EXCEL_INDEX_SUFFIX)
+
+    for scenario in SCENARIOS:
+        df = scenario_frame(scenario, n)
+        path = os.path.join(work_dir, f'{scenario}_{n}.xlsx')
+
+        def run():
+            # 毎回ベースのファイルから始める（copy2 は更新日時も保つのでインデックスも有効）
+            shutil.copy2(base, path)
+            index_file = None
+            if index:
+                index_file = path + EXCEL_INDEX_SUFFIX
+                shutil.copy2(base + EXCEL_INDEX_SUFFIX, index_file)
+            return upsert_to_excel(df, SHEET_NAME, path, 'id', TABLE_NAME, index_file)
+
+        phases, seconds, peak = measure(run, memory)
+        record('upsert_to_excel', scenario, seconds, peak, {k: round(v, 4) for k, v in phases.items()})
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, old_results, threshold):
+    """前回の結果より threshold 倍以上遅くなった項目を返す"""
+    key = lambda r: (r['rows'], r['benchmark'], r['scenario'], r['index'])
+    old = {key(r): r for r in old_results}
+    regressions = []
+    for r in results:
+        o = old.get(key(r))
+        if o and o['seconds'] > 0 and r['seconds'] / o['seconds'] >= threshold:
+            regressions.append((r, o))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='upsert_to_excel / read_existing_data_from_sheet / manage_table のベンチマーク')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES), help='ワークブックの行数')
+    parser.add_argument('--index', action='store_true', help='upsert_to_excel で行インデックスを使う')
+    parser.add_argument('--no_memory', action='store_true', help='ピークメモリを計測しない（tracemalloc で2回目を実行しない）')
+    parser.add_argument('-o', '--output', default='bench_output.json', help='結果の JSON ファイル')
+    parser.add_argument('--compare', metavar='JSON', help='前回の結果と比較し、遅くなった項目があれば終了コード1')
+    parser.add_argument('--threshold', type=float, default=1.2, help='--compare で遅くなったとみなす倍率')
+    parser.add_argument('--work_dir', help='ワークブックを作るディレクトリ（省略時は一時ディレクトリを作って削除）')
+    args = parser.parse_args(argv)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='bench_upsert_to_excel_')
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        results = []
+        for n in args.sizes:
+            results.extend(bench_size(n, work_dir, args.index, not args.no_memory))
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'openpyxl': openpyxl.__version__,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f'saved: {args.output}', file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old_report = json.load(f)
+        regressions = compare(results, old_report['results'], args.threshold)
+        for r, o in regressions:
+            print(f"regression: {r['rows']} {r['benchmark']} {r['scenario']} index={r['index']}: "
+                  f"{o['seconds']:.3f}s ({old_report.get('revision')}) -> {r['seconds']:.3f}s", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
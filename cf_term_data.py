@@ -9,10 +9,11 @@ import dateutil.parser
 from datetime import timedelta, datetime
 import sqlite3
 from contextlib import closing
-from time import sleep
+from time import sleep, perf_counter
 from random import uniform
 from tqdm import tqdm
 import os
+import json
 import warnings
 from openpyxl import load_workbook, Workbook
 from openpyxl.utils.dataframe import dataframe_to_rows
@@ -30,6 +31,11 @@ from moneyforward_api import *
 # move shared utilities to separate module
 from moneyforward_utils import traverse, get_categories_form_session
 
+# SQLite storage (upsert etc.)
+from moneyforward_db import connect, upsert, compute_row_hashes
+from moneyforward_schema import migrate, table_schema, parse_header, SQLITE_HEADER
+from moneyforward_parquet import upsert_parquet
+
 
 def is_range_overlapping(range1, range2):
     """
@@ -41,21 +47,39 @@ def is_range_overlapping(range1, range2):
     return not (max_col1 < min_col2 or max_col2 < min_col1 or max_row1 < min_row2 or max_row2 < min_row1)
 
 
-def save_workbook(wb, excel_file):
+# ファイルがロックされている (Excel で開いている) 場合の保存のリトライ
+SAVE_WORKBOOK_RETRIES = 5
+SAVE_WORKBOOK_INTERVAL = 2.0
+
+
+def save_workbook(wb, excel_file, retries=SAVE_WORKBOOK_RETRIES, interval=SAVE_WORKBOOK_INTERVAL):
     """
-    Save the workbook with retry on PermissionError.
-    
+    Save the workbook to a temporary file and atomically replace excel_file.
+
+    The file is never left half-written. If excel_file is locked (PermissionError,
+    e.g. opened in Excel on Windows), retry up to `retries` times waiting `interval`
+    seconds, then re-raise so unattended runs never block on user input.
+
     Args:
         wb: openpyxl.Workbook
         excel_file: str
+        retries: int
+        interval: float
     """
-    while True:
+    tmp = excel_file + '.tmp'
+    for attempt in range(retries + 1):
         try:
-            wb.save(excel_file)
-            break
-        except PermissionError:
-            print(f"PermissionError: {excel_file} が開いている可能性があります。Excelファイルを閉じてEnterキーを押してください。")
-            input()
+            wb.save(tmp)
+            os.replace(tmp, excel_file)
+            return
+        except PermissionError as e:
+            if attempt == retries:
+                raise PermissionError(f"{excel_file} が開いている可能性があります。Excelファイルを閉じてから再実行してください。") from e
+            logger.warning('PermissionError: %s is locked, retrying in %.1fs (%d/%d)', excel_file, interval, attempt + 1, retries)
+            sleep(interval)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
 
 
 def has_overlapped_range_table(ws, new_range: tuple, table_name: str) -> bool:
@@ -141,37 +165,6 @@ def manage_table(ws, table_name: str, new_max_col: int, new_max_row: int):
         add_new_table(ws, table_name, new_max_col, new_max_row)
 
 
-def upsert(frame, name: str, unique_index_label, con):
-    pandas_sql = pd.io.sql.pandasSQL_builder(con)
-    
-    if isinstance(frame, pd.Series):
-        frame = frame.to_frame()
-    elif not isinstance(frame, pd.DataFrame):
-        raise NotImplementedError(
-            "'frame' argument should be either a Series or a DataFrame"
-        )
-    
-    # table = pd.io.sql.SQLiteTable(name, pandas_sql, frame=frame, index=False, if_exists='append')
-    table = pd.io.sql.SQLiteTable(name, pandas_sql, frame=frame, index=False, if_exists='append', keys=unique_index_label)
-    table.create()
-    # pandas_sql.execute('CREATE UNIQUE INDEX IF NOT EXISTS "{0}_{1}" ON "{0}" ("{1}");'.format(table.name, unique_index_label))
-    
-    def _execute_insert(self, conn, keys, data_iter):
-        wld = "?"  # wildcard char
-        escape = pd.io.sql._get_valid_sqlite_name
-
-        bracketed_names = [escape(str(column)) for column in keys]
-        col_names = ",".join(bracketed_names)
-        wildcards = ",".join([wld] * len(bracketed_names))
-        insert_statement = (
-            f"INSERT OR REPLACE INTO {escape(self.name)} ({col_names}) VALUES ({wildcards})"
-        )
-        data_list = list(data_iter)
-        conn.executemany(insert_statement, data_list)
-    
-    table.insert(method=_execute_insert)
-
-
 def read_existing_data_from_sheet(ws, unique_index_label, sheet_name):
     """
     ワークシートから既存データを読み込み、headers と existing_df を返す。
@@ -203,11 +196,12 @@ def read_existing_data_from_sheet(ws, unique_index_label, sheet_name):
 
     # ヘッダー行を処理
     header_row = header_rows[0]
+    header_len = len(header_row)
     for i, h in enumerate(header_row):
         if h is None:
+            header_len = i
             break
-    
-    header_len = i
+
     headers = header_row[:header_len]
 
     if not headers:
@@ -220,6 +214,9 @@ def read_existing_data_from_sheet(ws, unique_index_label, sheet_name):
     
     # データ行を処理 (2行目から)
     for row_idx, row in enumerate(ws.iter_rows(values_only=True, min_row=2), 2):
+        if len(row) < header_len:
+            # 読み取り専用モードでは、末尾の空セルが省略されることがある
+            row = tuple(row) + (None,) * (header_len - len(row))
         val = row[unique_idx]
         if pd.isna(val) or val == '':
             break  # 無効な値なので、それ以降は読み込まない
@@ -234,6 +231,38 @@ def read_existing_data_from_sheet(ws, unique_index_label, sheet_name):
 
 
 
+def open_excel_sheet(excel_file, sheet_name):
+    """
+    Excelファイルとシートを読み書きモードで開く。無ければ新規作成する。
+
+    戻り値:
+        tuple: (wb, ws)
+    """
+    wb, worksheets = open_excel_sheets(excel_file, [sheet_name])
+    return wb, worksheets[sheet_name]
+
+
+def open_excel_sheets(excel_file, sheet_names):
+    """
+    Excelファイルを読み書きモードで1回だけ開き、複数のシートを返す。
+    ファイルやシートが無ければ新規作成する。
+
+    戻り値:
+        tuple: (wb, {シート名: ws})
+    """
+    worksheets = {}
+    if not os.path.exists(excel_file):
+        # ファイルを新規作成し、最初のシートは既定のシートの名前を変えて使う
+        wb = Workbook()
+        wb.active.title = sheet_names[0]
+    else:
+        wb = load_workbook(excel_file)
+    for sheet_name in sheet_names:
+        # シートが存在しない場合、シートのみ新規作成
+        worksheets[sheet_name] = wb[sheet_name] if sheet_name in wb.sheetnames else wb.create_sheet(sheet_name)
+    return wb, worksheets
+
+
 def load_excel_sheet(excel_file, sheet_name, unique_index_label):
     """
     Excelファイルとシートを読み込み、既存データを準備する。
@@ -253,24 +282,285 @@ def load_excel_sheet(excel_file, sheet_name, unique_index_label):
     例外:
         ValueError: 既存シートにunique_index_label列がない場合（headersが存在する場合のみ）。
     """
-    if not os.path.exists(excel_file):
-        # ファイルとシートを新規作成
-        wb = Workbook()
-        ws = wb.active
-        ws.title = sheet_name
-    elif sheet_name not in (wb := load_workbook(excel_file)).sheetnames:    
-        # 既存のファイルを開き、シートが存在しない場合、シートのみ新規作成
-        ws = wb.create_sheet(sheet_name)
-    else:
-        # シートが存在する場合
-        ws = wb[sheet_name]
-    
+    wb, ws = open_excel_sheet(excel_file, sheet_name)
     existing_df, headers = read_existing_data_from_sheet(ws, unique_index_label, sheet_name)
     
     return wb, ws, existing_df, headers
 
 
-def upsert_to_excel(df, sheet_name, excel_file, unique_index_label, table_name="user_asset_act"):
+def scan_excel_sheet(excel_file, sheet_name, unique_index_label):
+    """
+    Excelシートの既存データを読み取り専用モード（ストリーミング）で読み込む。
+
+    load_workbook の通常モードは全セルのオブジェクトを作るため、大きなファイルでは
+    読み込みだけで時間とメモリの大半を使う。既存データの比較にはこちらを使い、
+    書き込みが必要な場合だけ通常モードで開き直す。
+
+    引数:
+        excel_file (str): Excelファイルのパス。
+        sheet_name (str): シート名。
+        unique_index_label (str): ユニークインデックス列名。
+
+    戻り値:
+        tuple: (existing_df, headers)。ファイルやシートが無い場合は空。
+
+    例外:
+        ValueError: 既存シートにunique_index_label列がない場合（headersが存在する場合のみ）。
+    """
+    return scan_excel_sheets(excel_file, [sheet_name], unique_index_label)[sheet_name]
+
+
+def scan_excel_sheets(excel_file, sheet_names, unique_index_label):
+    """
+    scan_excel_sheet と同じ読み込みを、ファイルを1回だけ開いて複数のシートに行う。
+
+    戻り値:
+        dict: {シート名: (existing_df, headers)}。ファイルやシートが無い場合は空。
+    """
+    scanned = {}
+    if sheet_names and os.path.exists(excel_file):
+        wb = load_workbook(excel_file, read_only=True)
+        try:
+            for sheet_name in sheet_names:
+                if sheet_name in wb.sheetnames:
+                    scanned[sheet_name] = read_existing_data_from_sheet(wb[sheet_name], unique_index_label, sheet_name)
+        finally:
+            wb.close()
+    for sheet_name in sheet_names:
+        if sheet_name not in scanned:
+            existing_df = pd.DataFrame()
+            existing_df['excel_row'] = []
+            scanned[sheet_name] = (existing_df, [])
+    return scanned
+
+
+def changed_cells(new_df, old_df):
+    """
+    同じインデックスの2つのDataFrameを比較し、書き込みが必要なセルのマスクを返す。
+
+    両方が欠損値 (NaN/None/NA) のセルは一致とみなす。
+    old_df に無い列は、値に関わらず全て変更ありとする。
+
+    引数:
+        new_df (pd.DataFrame): 書き込む値。
+        old_df (pd.DataFrame): 既存の値（new_df と同じインデックス）。
+
+    戻り値:
+        pd.DataFrame: new_df と同じ形の bool の DataFrame。
+    """
+    missing_columns = ~new_df.columns.isin(old_df.columns)
+    new_df = new_df.astype(object)
+    old_df = old_df.reindex(index=new_df.index, columns=new_df.columns).astype(object)
+    same = new_df.eq(old_df) | (new_df.isna() & old_df.isna())
+    return ~same | missing_columns
+
+
+# Excel の行インデックス（サイドカーファイル）
+EXCEL_INDEX_SUFFIX = '.index.json'
+EXCEL_INDEX_VERSION = 1
+
+
+def excel_row_hashes(frame):
+    """
+    行ごとのハッシュを求める。
+
+    Excel から読んだ値と DataFrame の値が同じハッシュになるよう、
+    欠損値を None に揃えてから（文字列として）ハッシュする。
+    """
+    frame = frame.astype(object)
+    return compute_row_hashes(frame.where(frame.notna(), None))
+
+
+def excel_file_stamp(excel_file):
+    st = os.stat(excel_file)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def load_excel_index(index_file, excel_file):
+    """
+    Excel の行インデックスを読み込む。
+
+    インデックスには保存時のExcelファイルの更新日時とサイズを記録しておき、
+    一致しない場合（Excel で編集された等）は古いものとして使わない。
+
+    戻り値:
+        dict: {シート名: エントリ}。無い・古い場合は空。
+    """
+    if not os.path.exists(index_file) or not os.path.exists(excel_file):
+        return {}
+    try:
+        with open(index_file, encoding='utf-8') as f:
+            index = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning('failed to read excel index %s: %s', index_file, e)
+        return {}
+    if index.get('version') != EXCEL_INDEX_VERSION or index.get('stamp') != excel_file_stamp(excel_file):
+        logger.info('excel index is stale: %s', index_file)
+        return {}
+    return index['sheets']
+
+
+def save_excel_index(index_file, excel_file, sheets):
+    """Excel の行インデックスを、現在のExcelファイルの更新日時・サイズとともに保存する"""
+    index = {'version': EXCEL_INDEX_VERSION, 'stamp': excel_file_stamp(excel_file), 'sheets': sheets}
+    tmp = index_file + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False, default=lambda o: o.item() if hasattr(o, 'item') else str(o))
+    os.replace(tmp, index_file)
+
+
+def update_excel_index_entry(entry, existing_df, df, unique_index_label, current_headers, data_max_row, row_map):
+    """
+    アップサート後のシートのインデックスエントリを作る。
+
+    引数:
+        entry (dict): 使用した保存済みのエントリ。シートを読み込んだ場合は None。
+        existing_df (pd.DataFrame): 読み込んだ既存データ（entry が None の場合に使用）。
+        df (pd.DataFrame): アップサートしたDataFrame。
+        unique_index_label (str): ユニークインデックス列名。
+        current_headers (list): アップサート後のヘッダー。
+        data_max_row (int): データのある最大行。
+        row_map (dict): df の各 id を書き込んだ行 {id: row}。
+
+    戻り値:
+        dict: 新しいエントリ。
+    """
+    hash_columns = [c for c in current_headers if c in df.columns]
+    if entry is None:
+        base = existing_df.drop_duplicates(subset=unique_index_label) if len(existing_df) else existing_df
+        base_ids = base[unique_index_label].tolist() if len(base) else []
+        rows = dict(zip(base_ids, base['excel_row'].tolist()))
+        hashes = dict(zip(base_ids, excel_row_hashes(base.reindex(columns=hash_columns)).tolist()))
+    else:
+        rows = dict(zip(entry['ids'], entry['rows']))
+        hashes = dict(zip(entry['ids'], entry['hashes']))
+
+    df = df.drop_duplicates(subset=unique_index_label, keep='last')
+    rows.update(row_map)
+    hashes.update(zip(df[unique_index_label].tolist(), excel_row_hashes(df[hash_columns]).tolist()))
+    return {
+        'headers': list(current_headers),
+        'hash_columns': hash_columns,
+        'data_rows': data_max_row - 1,
+        'ids': list(rows),
+        'rows': list(rows.values()),
+        'hashes': [hashes[id_] for id_ in rows],
+    }
+
+
+def plan_excel_upsert(df, existing_df, headers, unique_index_label):
+    """
+    既存データと比較して、アップサートで書き込むセルを求める。
+
+    引数:
+        df (pd.DataFrame): アップサートするDataFrame。
+        existing_df (pd.DataFrame): 既存データ（'excel_row'列を含む）。
+        headers (list): 既存シートのヘッダー。
+        unique_index_label (str): ユニークインデックス列名。
+
+    戻り値:
+        tuple: (current_headers, cells, data_max_row)
+            current_headers: 新規列を追加した後のヘッダーのリスト。
+            cells: 書き込むセルのリスト [(row, column, value), ...]。
+            data_max_row: データのある最大行。
+            row_map: df の各 id を書き込む行 {id: row}。
+    """
+    cells = []
+
+    # 列の同期: dfにある列がheadersになければ追加
+    current_headers = list(headers)
+    col_map = {name: i+1 for i, name in enumerate(current_headers)}
+
+    for col in df.columns:
+        if col not in col_map:
+            # 新規列追加
+            new_col_idx = len(current_headers) + 1
+            cells.append((1, new_col_idx, col))
+            col_map[col] = new_col_idx
+            current_headers.append(col)
+
+    # 行の同期
+    # unique_index_label はチェック済み。同じ id が複数ある場合は最後の行を使う
+    df_indexed = df.drop_duplicates(subset=unique_index_label, keep='last').set_index(unique_index_label)
+
+    if not existing_df.empty and unique_index_label in existing_df.columns:
+        # 既存シートで id が重複している場合は先頭の行を更新する
+        existing_df_indexed = existing_df.drop_duplicates(subset=unique_index_label).set_index(unique_index_label)
+    else:
+        existing_df_indexed = pd.DataFrame(columns=['excel_row'])
+
+    is_new = ~df_indexed.index.isin(existing_df_indexed.index)
+
+    # 2-1. 新規行の追加 (df の順序で末尾に追加)
+    rows_to_add = df_indexed[is_new].reset_index()
+    start_row = 1 + len(existing_df) + 1  # ヘッダー行 + 既存データ行 の 次の行
+    col_numbers = [col_map[col] for col in rows_to_add.columns]
+    for row_idx, values in enumerate(rows_to_add.astype(object).to_numpy(), start_row):
+        cells.extend(zip([row_idx] * len(col_numbers), col_numbers, values))
+    row_map = dict(zip(rows_to_add[unique_index_label].tolist(), range(start_row, start_row + len(rows_to_add))))
+
+    # データのある最大行を計算 (ヘッダー + 既存データ行 + 新規追加行)
+    data_max_row = 1 + len(existing_df) + len(rows_to_add)
+
+    # 2-2. 既存行の更新 (変更のあるセルだけを書き込む)
+    common_df = df_indexed[~is_new]
+    if not common_df.empty:
+        old_df = existing_df_indexed.loc[common_df.index]
+        mask = changed_cells(common_df, old_df.drop(columns='excel_row')).to_numpy()
+        excel_rows = old_df['excel_row'].to_numpy()
+        row_map.update(zip(common_df.index.tolist(), excel_rows.tolist()))
+        values = common_df.astype(object).to_numpy()
+        col_numbers = [col_map[col] for col in common_df.columns]
+        for i, j in zip(*mask.nonzero()):
+            cells.append((int(excel_rows[i]), col_numbers[j], values[i, j]))
+
+    return current_headers, cells, data_max_row, row_map
+
+
+def plan_excel_upsert_indexed(df, entry, unique_index_label):
+    """
+    保存済みの行インデックスを使って、アップサートで書き込むセルを求める。
+
+    シートを読まずに、id の行番号と行ハッシュだけで新規行・変更行を判定する。
+    変更のあった行は df の全列を書き込む。
+
+    引数:
+        df (pd.DataFrame): アップサートするDataFrame（列は全て entry['headers'] にあること）。
+        entry (dict): load_excel_index で読み込んだシートのインデックス。
+        unique_index_label (str): ユニークインデックス列名。
+
+    戻り値:
+        tuple: plan_excel_upsert と同じ (current_headers, cells, data_max_row, row_map)。
+    """
+    current_headers = list(entry['headers'])
+    col_map = {name: i+1 for i, name in enumerate(current_headers)}
+    rows = dict(zip(entry['ids'], entry['rows']))
+    hashes = dict(zip(entry['ids'], entry['hashes']))
+
+    df = df.drop_duplicates(subset=unique_index_label, keep='last')
+    ids = df[unique_index_label].tolist()
+    new_hashes = excel_row_hashes(df[entry['hash_columns']]).tolist()
+    values = df.astype(object).to_numpy()
+    col_numbers = [col_map[col] for col in df.columns]
+
+    cells = []
+    row_map = {}
+    next_row = 1 + entry['data_rows'] + 1
+    for id_, row_hash, row_values in zip(ids, new_hashes, values):
+        row_idx = rows.get(id_)
+        if row_idx is None:
+            row_idx = next_row
+            next_row += 1
+        elif hashes[id_] == row_hash:
+            row_map[id_] = row_idx
+            continue
+        row_map[id_] = row_idx
+        cells.extend(zip([row_idx] * len(col_numbers), col_numbers, row_values))
+
+    return current_headers, cells, next_row - 1, row_map
+
+
+def upsert_to_excel(df, sheet_name, excel_file, unique_index_label, table_name="user_asset_act", index_file=None):
     """
     ユニークインデックスを用いて差分更新を行い、DataFrameをExcelシートにアップサートします。
 
@@ -287,10 +577,17 @@ def upsert_to_excel(df, sheet_name, excel_file, unique_index_label, table_name="
         excel_file (str): Excelファイルのパス。
         unique_index_label (str): 更新時に使うユニークインデックスとなる列名。dfおよび既存シート（存在する場合）に必須。
         table_name (str): テーブル名。デフォルトは"user_asset_act"。
+        index_file (str): id と行番号・行ハッシュを保存するインデックスファイル。
+            指定すると、インデックスが新しい（Excelファイルが更新されていない）間は
+            シートを読まずに差分を求める。デフォルトはNone（使用しない）。
+
+    戻り値:
+        dict: フェーズ (scan / diff / load / write / table / save / index) ごとの所要時間（秒）。
+            変更が無い場合、Excelファイルは書き込まない。インデックスを使った場合 scan は無い。
 
     例外:
         ValueError: dfが空、unique_index_labelが空、または既存シートにunique_index_label列がない場合。
-        PermissionError: ファイルがロックされている場合（ユーザー入力によるリトライ処理あり）。
+        PermissionError: ファイルがロックされたままの場合（一定回数リトライした後）。
 
     動作:
         - 新規ファイル/シート: dfを書き込み作成。
@@ -299,91 +596,190 @@ def upsert_to_excel(df, sheet_name, excel_file, unique_index_label, table_name="
         - 空df: エラー。
         - 既存シートにunique_index_label列がない: エラー。
     """
-    if df.empty:
-        raise ValueError("DataFrame must not be empty")
+    return upsert_sheets_to_excel([(df, sheet_name, table_name)], excel_file, unique_index_label, index_file)
+
+
+def upsert_sheets_to_excel(parts, excel_file, unique_index_label, index_file=None):
+    """
+    1つのExcelファイルの複数のシートに、upsert_to_excel と同じアップサートを行います。
+
+    既存データの読み込み（読み取り専用）、読み書きモードでの読み込み、保存、
+    インデックスの保存はシートの数に関わらずそれぞれ1回だけ行います。
+
+    引数:
+        parts (list): (df, sheet_name, table_name) のリスト。
+        excel_file (str): Excelファイルのパス。
+        unique_index_label (str): ユニークインデックス列名。
+        index_file (str): upsert_to_excel を参照。
+
+    戻り値:
+        dict: upsert_to_excel と同じフェーズごとの所要時間（秒、全シートの合計）。
+
+    例外:
+        upsert_to_excel と同じ。
+    """
+    for df, _, _ in parts:
+        if df.empty:
+            raise ValueError("DataFrame must not be empty")
     if not unique_index_label:
         raise ValueError("unique_index_label must be provided and not empty")
     
-    wb, ws, existing_df, headers = load_excel_sheet(excel_file, sheet_name, unique_index_label)
-    tqdm.write(f"Loaded Excel file '{excel_file}', sheet '{sheet_name}'. Existing rows: {len(existing_df)}, Existing columns: {len(headers)}")
-    
-    # 1. 列の同期
-    # dfにある列がheadersになければ追加
-    current_headers = list(headers)
-    col_map = {name: i+1 for i, name in enumerate(current_headers)}
-    
-    for col in df.columns:
-        if col not in col_map:
-            # 新規列追加
-            new_col_idx = len(current_headers) + 1
-            ws.cell(row=1, column=new_col_idx, value=col)
-            col_map[col] = new_col_idx
-            current_headers.append(col)
+    timings = {}
+    last = perf_counter()
 
-    # 2. 行の同期
-    # unique_index_label はチェック済み
-    df_indexed = df.set_index(unique_index_label)
+    def lap(phase):
+        nonlocal last
+        now = perf_counter()
+        timings[phase] = now - last
+        last = now
 
-    if not existing_df.empty and unique_index_label in existing_df.columns:
-        existing_df_indexed = existing_df.set_index(unique_index_label)
-        existing_ids = set(existing_df_indexed.index)
+    sheets = load_excel_index(index_file, excel_file) if index_file else {}
+    entries = {}
+    for df, sheet_name, _ in parts:
+        entry = sheets.get(sheet_name)
+        if entry is not None and (not set(df.columns) <= set(entry['headers'])
+                                  or [c for c in entry['headers'] if c in df.columns] != entry['hash_columns']):
+            # 列が変わった場合はシートを読み直す
+            entry = None
+        entries[sheet_name] = entry
+
+    # 1. インデックスの無いシートの既存データの読み込み (読み取り専用モード、ファイルを開くのは1回)
+    scan_sheets = [sheet_name for _, sheet_name, _ in parts if entries[sheet_name] is None]
+    scanned = scan_excel_sheets(excel_file, scan_sheets, unique_index_label)
+    for sheet_name in scan_sheets:
+        existing_df, headers = scanned[sheet_name]
+        tqdm.write(f"Loaded Excel file '{excel_file}', sheet '{sheet_name}'. Existing rows: {len(existing_df)}, Existing columns: {len(headers)}")
+    if scan_sheets:
+        lap('scan')
+
+    # 2. 差分の計算
+    plans = []
+    for df, sheet_name, table_name in parts:
+        entry = entries[sheet_name]
+        if entry is not None:
+            # インデックスから差分の計算 (シートは読まない)
+            existing_df = None
+            tqdm.write(f"Loaded Excel index '{index_file}', sheet '{sheet_name}'. Existing rows: {entry['data_rows']}, Existing columns: {len(entry['headers'])}")
+            plan = plan_excel_upsert_indexed(df, entry, unique_index_label)
+        else:
+            existing_df, headers = scanned[sheet_name]
+            plan = plan_excel_upsert(df, existing_df, headers, unique_index_label)
+        plans.append((df, sheet_name, table_name, existing_df, plan))
+    lap('diff')
+
+    changed = [(sheet_name, table_name, plan) for _, sheet_name, table_name, _, plan in plans if plan[1]]
+    if changed:
+        # 3. 変更がある場合だけ、読み書きモードで1回開いて全てのシートに書き込む
+        wb, worksheets = open_excel_sheets(excel_file, [sheet_name for sheet_name, _, _ in changed])
+        lap('load')
+        for sheet_name, _, (current_headers, cells, data_max_row, _) in changed:
+            ws = worksheets[sheet_name]
+            for row_idx, col_idx, val in cells:
+                ws.cell(row=row_idx, column=col_idx, value=val)
+            tqdm.write(f"Data upserted to Excel file '{excel_file}', sheet '{sheet_name}'. Changed cells: {len(cells)}, Total rows now: {data_max_row}, Total columns now: {len(current_headers)}")
+        lap('write')
+
+        # テーブル処理 (メモリ上で範囲を更新し、保存は1回だけ行う)
+        for sheet_name, table_name, (current_headers, _, data_max_row, _) in changed:
+            manage_table(worksheets[sheet_name], table_name, len(current_headers), data_max_row)
+            tqdm.write(f"Table '{table_name}' managed in sheet '{sheet_name}'.")
+        lap('table')
+
+        # 保存
+        save_workbook(wb, excel_file)
+        lap('save')
     else:
-        existing_df_indexed = pd.DataFrame()
-        existing_ids = set()
-
-    new_ids = set(df_indexed.index)
-    
-    # 2-1. 新規行の追加
-    rows_to_add = new_ids - existing_ids
-    if rows_to_add:
-        start_row = 1 + len(existing_df) + 1  # ヘッダー行 + 既存データ行 の 次の行
-        for idx in rows_to_add:
-            row_data = df_indexed.loc[idx]
-            # unique_index_label の値も書き込む
-            if unique_index_label in col_map:
-                 ws.cell(row=start_row, column=col_map[unique_index_label], value=idx)
-            
-            for col, val in row_data.items():
-                if col in col_map:
-                    ws.cell(row=start_row, column=col_map[col], value=val)
-            start_row += 1
+        tqdm.write(f"No changes to Excel file '{excel_file}', sheet {', '.join(repr(p[1]) for p in parts)}.")
 
-    # データのある最大行を計算 (ヘッダー + 既存データ行 + 新規追加行)
-    data_max_row = 1 + len(existing_df) + len(rows_to_add)
+    if index_file:
+        updated = False
+        for df, sheet_name, _, existing_df, (current_headers, cells, data_max_row, row_map) in plans:
+            entry = entries[sheet_name]
+            if cells or entry is None:
+                sheets[sheet_name] = update_excel_index_entry(entry, existing_df, df, unique_index_label,
+                                                              current_headers, data_max_row, row_map)
+                updated = True
+        if updated:
+            save_excel_index(index_file, excel_file, sheets)
+            lap('index')
 
-    # 2-2. 既存行の更新
-    common_ids = new_ids & existing_ids
-    if common_ids:
-        for idx in common_ids:
-            excel_row_idx = existing_df_indexed.loc[idx, 'excel_row']
-            if isinstance(excel_row_idx, pd.Series):
-                excel_row_idx = excel_row_idx.iloc[0]
-            
-            row_data = df_indexed.loc[idx]
-            for col, val in row_data.items():
-                if col in col_map:
-                    should_write = True
-                    if col in existing_df_indexed.columns:
-                        existing_val = existing_df_indexed.loc[idx, col]
-                        # pandas の比較は NaN の扱いに注意
-                        if pd.isna(val) and pd.isna(existing_val):
-                            should_write = False
-                        elif val == existing_val:
-                            should_write = False
-                    
-                    if should_write:
-                        ws.cell(row=excel_row_idx, column=col_map[col], value=val)
-    
-    # テーブル処理前に保存
-    save_workbook(wb, excel_file)
-    tqdm.write(f"Data upserted to Excel file '{excel_file}', sheet '{sheet_name}'. Total rows now: {data_max_row}, Total columns now: {len(current_headers)}")
-    
-    # テーブル処理
-    manage_table(ws, table_name, len(current_headers), data_max_row)
-    tqdm.write(f"Table '{table_name}' managed in sheet '{sheet_name}'.")
-    
-    # 保存
-    save_workbook(wb, excel_file)
+    tqdm.write('Excel upsert timing: ' + ', '.join(f'{phase} {sec:.2f}s' for phase, sec in timings.items()))
+    return timings
+
+
+# 年ごとに分割して保存する場合の単位
+EXCEL_PARTITIONS = ('sheet', 'workbook')
+
+
+def excel_partition_target(excel_file, sheet_name, table_name, partition, year):
+    """
+    年ごとのパーティションの保存先を返す。
+
+    - sheet: 同じファイルの "<シート名>_<年>" シート（テーブル名も "<テーブル名>_<年>"）
+    - workbook: "<ファイル名>_<年>.xlsx" ファイルの同じシート・テーブル
+
+    戻り値:
+        tuple: (excel_file, sheet_name, table_name)
+    """
+    if partition == 'sheet':
+        return excel_file, f'{sheet_name}_{year}', f'{table_name}_{year}'
+    if partition == 'workbook':
+        root, ext = os.path.splitext(excel_file)
+        return f'{root}_{year}{ext}', sheet_name, table_name
+    raise ValueError(f'invalid partition: {partition}')
+
+
+def upsert_to_excel_by_year(df, sheet_name, excel_file, unique_index_label, table_name="user_asset_act",
+                            partition='sheet', index=False):
+    """
+    recognized_at の年ごとにシートまたはファイルを分けて、DataFrameをアップサートします。
+
+    df に含まれる年のパーティションだけを更新するため、
+    書き込みの量は履歴全体ではなく、今回取得した期間に比例します。
+    partition='sheet' の場合は、全ての年のシートを upsert_sheets_to_excel で
+    まとめて更新し、ファイルの読み込みと保存は1回だけ行います。
+    partition='workbook' の場合は年ごとのファイルを upsert_to_excel で更新し、
+    他の年のファイルは開きません。
+    upsert_to_excel と同様に行の削除は行わないので、recognized_at の年が
+    変わった取引は元の年のパーティションにも残ります。
+
+    引数:
+        df (pd.DataFrame): アップサートするDataFrame（recognized_at 列が必要）。
+        sheet_name (str): Excelシート名（パーティションの名前の元になる）。
+        excel_file (str): Excelファイルのパス（パーティションの名前の元になる）。
+        unique_index_label (str): ユニークインデックス列名。
+        table_name (str): テーブル名。
+        partition (str): 'sheet'（年ごとのシート）または 'workbook'（年ごとのファイル）。
+        index (bool): True の場合、ファイルごとに行インデックス (EXCEL_INDEX_SUFFIX) を使う。
+
+    戻り値:
+        dict: {年: upsert_to_excel の所要時間}。partition='sheet' の場合は全ての年で共通の所要時間。
+
+    例外:
+        ValueError: recognized_at 列が無い、または年を求められない行がある場合。
+    """
+    if 'recognized_at' not in df.columns:
+        raise ValueError("recognized_at column is required to partition by year")
+    years = pd.to_datetime(df['recognized_at'].astype(str).str[:10], format='%Y-%m-%d', errors='coerce').dt.strftime('%Y')
+    if years.isna().any():
+        raise ValueError(f"invalid recognized_at: {df.loc[years.isna(), 'recognized_at'].head().tolist()}")
+
+    groups = list(df.groupby(years, sort=True))
+    if partition == 'sheet':
+        parts = []
+        for year, group in groups:
+            _, part_sheet, part_table = excel_partition_target(excel_file, sheet_name, table_name, partition, year)
+            parts.append((group, part_sheet, part_table))
+        index_file = excel_file + EXCEL_INDEX_SUFFIX if index else None
+        shared = upsert_sheets_to_excel(parts, excel_file, unique_index_label, index_file)
+        return {year: shared for year, _ in groups}
+
+    timings = {}
+    for year, group in groups:
+        part_file, part_sheet, part_table = excel_partition_target(excel_file, sheet_name, table_name, partition, year)
+        index_file = part_file + EXCEL_INDEX_SUFFIX if index else None
+        timings[year] = upsert_to_excel(group, part_sheet, part_file, unique_index_label, part_table, index_file)
+    return timings
 
 
 def get_account_summaries_list(account_summaries, args):
@@ -491,39 +887,6 @@ def request_term_data(s, args):
     return pd.concat(term_data_list)
 
 
-def parse_header(header_list):
-    select_header = []
-    rename_header = {}
-    dtypes_dict = {}
-    
-    for item in header_list:
-        # まず : で型を分離
-        if ':' in item:
-            name_part, dtype = item.rsplit(':', 1)  # 右からsplitして最後の:を型とする
-        else:
-            name_part = item
-            dtype = None
-        
-        # 次に = でnameとaliasを分離
-        if '=' in name_part:
-            name, alias = name_part.split('=', 1)
-            rename_header[name] = alias
-            select_header.append(name)
-            if dtype:
-                dtypes_dict[alias] = dtype  # エイリアス後の型はaliasに適用
-            else:
-                dtypes_dict[alias] = 'object'
-        else:
-            name = name_part
-            select_header.append(name)
-            if dtype:
-                dtypes_dict[name] = dtype
-            else:
-                dtypes_dict[name] = 'object'
-    
-    return select_header, rename_header, dtypes_dict
-
-
 def get_term_data(s, args):
     with change_default_group(s):
         term_data_list = request_term_data(s, args)
@@ -550,7 +913,10 @@ def get_term_data(s, args):
             # dtypesを適用
             term_data_list = term_data_list.astype(dtypes_dict)
             
-        with closing(sqlite3.connect(args.sqlite)) as con:
+        with closing(connect(args.sqlite)) as con:
+            if args.sqlite_header:
+                # 型注釈から STRICT テーブルのスキーマを作り、必要なら移行する
+                migrate(con, 'user_asset_act', table_schema(dtypes_dict), 'id')
             upsert(term_data_list, 'user_asset_act', 'id', con)
         return
     
@@ -567,7 +933,28 @@ def get_term_data(s, args):
             # dtypesを適用
             term_data_list = term_data_list.astype(dtypes_dict)
             
-        upsert_to_excel(term_data_list, args.excel_sheet_name, args.excel, 'id', args.excel_table_name)
+        if args.excel_partition:
+            upsert_to_excel_by_year(term_data_list, args.excel_sheet_name, args.excel, 'id', args.excel_table_name,
+                                    args.excel_partition, args.excel_index)
+        else:
+            index_file = args.excel + EXCEL_INDEX_SUFFIX if args.excel_index else None
+            upsert_to_excel(term_data_list, args.excel_sheet_name, args.excel, 'id', args.excel_table_name, index_file)
+        return
+    
+    if args.parquet:
+        if args.parquet_header:
+            select_header, rename_header, dtypes_dict = parse_header(args.parquet_header)
+            for c in set(select_header) - set(term_data_list.columns):
+                term_data_list[c] = None
+            term_data_list = term_data_list[select_header]
+            
+            if rename_header:
+                term_data_list = term_data_list.rename(columns=rename_header)
+            
+            # dtypesを適用
+            term_data_list = term_data_list.astype(dtypes_dict)
+            
+        upsert_parquet(term_data_list, args.parquet, 'id')
         return
     
     print(*term_data_list.columns.tolist())
@@ -588,43 +975,49 @@ def main(argv=None):
     group.add_argument('--csv')
     group.add_argument('--sqlite')
     group.add_argument('--excel')
+    group.add_argument('--parquet', metavar='DIR', help='年・月で分割した Parquet データセットに保存 (要 pyarrow)')
     parser.add_argument('--csv_header', nargs='+')
-    sqlite_header = """id:str date year month account_id:str sub_account_id:str is_transfer is_income
-                       orig_content=content orig_amount=amount currency jpyrate memo 
-                       large_category_id middle_category_id large_category middle_category
-                       is_target partner_account_id:str partner_sub_account_id:str partner_act_id:str
-                       created_at recognized_at updated_at sub_account_id_hash transfer_type
-                       account.account.service_id=service_id
-                       account.account.service_category_id=service_category_id
-                       account.account.disp_name=disp_name
-                       account.account.service.service.service_name=service_name
-                       sub_account.sub_account.sub_name=sub_name
-                       sub_account.sub_account.sub_type=sub_type
-                       sub_account.sub_account.sub_number=sub_number
-                       partner_account.partner_account.service_id=partner_account_service_id
-                       partner_account.partner_account.service_category_id=partner_account_service_category_id
-                       partner_account.partner_account.disp_name=partner_account_disp_name
-                       partner_account.partner_account.memo=partner_account_memo
-                       partner_account.partner_account.display_name=partner_account_display_name
-                       partner_sub_account.partner_sub_account.sub_name=partner_account_sub_name
-                       partner_sub_account.partner_sub_account.sub_type=partner_account_sub_type
-                       partner_sub_account.partner_sub_account.sub_number=partner_account_sub_number
-                       partner_sub_account.partner_sub_account.service_category_id=partner_sub_account_service_category_id
-                       partner_sub_account.partner_sub_account.is_dummy=partner_sub_account_is_dummy
-                       partner_act.partner_act.orig_content=partner_act_content
-                       partner_act.partner_act.orig_amount=partner_act_amount
-                       partner_act.partner_act.currency=partner_act_currency
-                       partner_act.partner_act.jpyrate=partner_act_jpyrate
-                       partner_act.partner_act.memo=partner_act_memo
-                       partner_act.partner_act.large_category_id=partner_act_large_category_id
-                       partner_act.partner_act.middle_category_id=partner_act_middle_category_id
-                       partner_act.partner_act.sub_account_id_hash=partner_act_sub_account_id_hash
-                       partner_act.partner_act.partner_sub_account_id_hash=partner_act_partner_sub_account_id_hash
-                       """.split()
+    sqlite_header = SQLITE_HEADER
+    # Excel は従来どおり型注釈なし (id などは文字列) で出力する
+    excel_header = """id:str date year month account_id:str sub_account_id:str is_transfer is_income
+                      orig_content=content orig_amount=amount currency jpyrate memo 
+                      large_category_id middle_category_id large_category middle_category
+                      is_target partner_account_id:str partner_sub_account_id:str partner_act_id:str
+                      created_at recognized_at updated_at sub_account_id_hash transfer_type
+                      account.account.service_id=service_id
+                      account.account.service_category_id=service_category_id
+                      account.account.disp_name=disp_name
+                      account.account.service.service.service_name=service_name
+                      sub_account.sub_account.sub_name=sub_name
+                      sub_account.sub_account.sub_type=sub_type
+                      sub_account.sub_account.sub_number=sub_number
+                      partner_account.partner_account.service_id=partner_account_service_id
+                      partner_account.partner_account.service_category_id=partner_account_service_category_id
+                      partner_account.partner_account.disp_name=partner_account_disp_name
+                      partner_account.partner_account.memo=partner_account_memo
+                      partner_account.partner_account.display_name=partner_account_display_name
+                      partner_sub_account.partner_sub_account.sub_name=partner_account_sub_name
+                      partner_sub_account.partner_sub_account.sub_type=partner_account_sub_type
+                      partner_sub_account.partner_sub_account.sub_number=partner_account_sub_number
+                      partner_sub_account.partner_sub_account.service_category_id=partner_sub_account_service_category_id
+                      partner_sub_account.partner_sub_account.is_dummy=partner_sub_account_is_dummy
+                      partner_act.partner_act.orig_content=partner_act_content
+                      partner_act.partner_act.orig_amount=partner_act_amount
+                      partner_act.partner_act.currency=partner_act_currency
+                      partner_act.partner_act.jpyrate=partner_act_jpyrate
+                      partner_act.partner_act.memo=partner_act_memo
+                      partner_act.partner_act.large_category_id=partner_act_large_category_id
+                      partner_act.partner_act.middle_category_id=partner_act_middle_category_id
+                      partner_act.partner_act.sub_account_id_hash=partner_act_sub_account_id_hash
+                      partner_act.partner_act.partner_sub_account_id_hash=partner_act_partner_sub_account_id_hash
+                      """.split()
     parser.add_argument('--sqlite_header', nargs='+', default=sqlite_header)
-    parser.add_argument('--excel_header', nargs='+', default=sqlite_header)  # 同じデフォルトを使用
+    parser.add_argument('--excel_header', nargs='+', default=excel_header)
+    parser.add_argument('--parquet_header', nargs='+', default=sqlite_header)  # 型注釈付きの sqlite_header を使用
     parser.add_argument('--excel_sheet_name', default='user_asset_act')
     parser.add_argument('--excel_table_name', default='user_asset_act')
+    parser.add_argument('--excel_partition', choices=EXCEL_PARTITIONS, help='recognized_at の年ごとにシート (<シート名>_<年>) またはファイル (<ファイル名>_<年>.xlsx) を分けて保存')
+    parser.add_argument('--excel_index', action='store_true', help=f'id と行番号のインデックスを <excel>{EXCEL_INDEX_SUFFIX} に保存し、次回の差分計算に使う')
     parser.add_argument('-i', '--ignore_KeyError', action='store_true')
     
     args = parser.parse_args(argv)
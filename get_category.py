@@ -32,7 +32,7 @@ def main(argv=None):
     
     parser.add_argument(
         'category_name',
-        help='検索する中カテゴリ名（部分一致）'
+        help='検索する中カテゴリ名（完全一致・前方一致・部分一致の順に検索）'
     )
     
     parser.add_argument(
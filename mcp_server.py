@@ -18,7 +18,8 @@ Claude Desktop 設定 (%%APPDATA%%/Claude/claude_desktop_config.json):
           "args": ["run", "--project", "<project_dir>", "python", "<project_dir>/mcp_server.py"],
           "env": {
             "MF_COOKIE_FILE": "<project_dir>/mf_cookies.pkl",
-            "MF_CATEGORY_CACHE": "<project_dir>/large_categories.csv"
+            "MF_CATEGORY_CACHE": "<project_dir>/large_categories.csv",
+            "MF_SQLITE_DB": "<project_dir>/cf_term_data.db"
           }
         }
       }
@@ -28,6 +29,7 @@ Claude Desktop 設定 (%%APPDATA%%/Claude/claude_desktop_config.json):
 import sys
 import os
 import logging
+from contextlib import closing
 from datetime import datetime, timedelta
 from typing import Literal
 
@@ -40,13 +42,12 @@ from moneyforward_api import (
     request_large_categories,
     request_account_summaries,
     request_cf_term_data_by_sub_account,
-    request_update_user_asset_act,
-    request_transactions_category_bulk_updates,
-    get_csrf_token,
 )
+from moneyforward_db import connect, summarize_monthly
+from moneyforward_queue import apply_mutations
 from moneyforward_utils import (
     search_category_sub,
-    get_middle_category_impl,
+    get_category_index,
     append_row_form_user_asset_acts,
     get_categories_form_user_asset_acts,
 )
@@ -56,6 +57,11 @@ from moneyforward_utils import (
 # -----------------------------------------------------------------------
 COOKIE_FILE = os.environ.get("MF_COOKIE_FILE", "mf_cookies.pkl")
 CATEGORY_CACHE = os.environ.get("MF_CATEGORY_CACHE", "large_categories.csv")
+# ローカルミラー (cf_term_data.py --sqlite で作成)。指定時は集計を月次集計表から行う
+SQLITE_DB = os.environ.get("MF_SQLITE_DB")
+SQLITE_TABLE = os.environ.get("MF_SQLITE_TABLE", "user_asset_act")
+# 取引の変更キュー (moneyforward.py --mutation_queue と共通)。送れなかった変更は failed になる
+MUTATION_QUEUE = os.environ.get("MF_MUTATION_QUEUE", "mutation_queue.db")
 
 logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
 
@@ -173,24 +179,19 @@ def find_category_by_name(
     一意に特定できない場合はエラーと候補一覧を返す。
 
     Args:
-        category_name: 中カテゴリ名（部分一致）
+        category_name: 中カテゴリ名（完全一致・前方一致・部分一致の順に検索）
         is_income: True=収入カテゴリから検索, False=支出カテゴリから検索
     """
     with session_from_cookie_file(COOKIE_FILE) as s:
-        try:
-            large_id, middle_id = get_middle_category_impl(
-                s, CATEGORY_CACHE, force_update=False,
-                category_name=category_name, is_income=is_income
-            )
-        except ValueError as e:
-            # 候補一覧も付けて返す
-            df = search_category_sub(
-                s, CATEGORY_CACHE, force_update=False, middle=category_name
-            )
-            return {
-                "error": str(e),
-                "candidates": df.to_dict(orient="records"),
-            }
+        index = get_category_index(s, CATEGORY_CACHE)
+    try:
+        large_id, middle_id = index.resolve(category_name, is_income)
+    except ValueError as e:
+        # 候補一覧も付けて返す
+        return {
+            "error": str(e),
+            "candidates": index.frame(index.find_middle(category_name)).to_dict(orient="records"),
+        }
 
     return {
         "large_category_id": large_id,
@@ -368,6 +369,15 @@ def get_transactions_by_account(
 
 # === 取引更新 ===
 
+def mutation_result(transaction_id: int, results: list) -> dict:
+    """apply_mutations の結果を1件の取引の更新結果にする（失敗した変更は errors で返す）"""
+    errors = {r["field"]: r["error"] for r in results if not r["ok"]}
+    result = {"success": not errors, "transaction_id": transaction_id}
+    if errors:
+        result["errors"] = errors
+    return result
+
+
 @mcp.tool()
 def set_transaction_category(
     transaction_id: int,
@@ -385,15 +395,12 @@ def set_transaction_category(
         middle_category_id: 中カテゴリID（find_category_by_name で取得）
         memo: メモ（省略可）
     """
+    mutations = [(transaction_id, "category", [large_category_id, middle_category_id])]
+    if memo:
+        mutations.append((transaction_id, "memo", memo))
     with session_from_cookie_file(COOKIE_FILE) as s:
-        csrf = get_csrf_token(s)
-        request_update_user_asset_act(
-            s, csrf, transaction_id,
-            large_category_id=large_category_id,
-            middle_category_id=middle_category_id,
-            memo=memo,
-        )
-    return {"success": True, "transaction_id": transaction_id}
+        results = apply_mutations(s, mutations, MUTATION_QUEUE)
+    return mutation_result(transaction_id, results)
 
 
 @mcp.tool()
@@ -404,8 +411,8 @@ def bulk_set_category(
 ) -> dict:
     """複数取引のカテゴリを一括更新する。
 
-    内部で100件ずつバッチ処理する。同じカテゴリに分類できる取引を
-    まとめて更新する際に使う。
+    変更キューに記録してから100件ずつのバッチを並列に送信し、失敗した取引をエラーごとに failed_batches で返す。
+    送れなかった変更は自動では再送しない。同じカテゴリに分類できる取引をまとめて更新する際に使う。
 
     Args:
         transaction_ids: 取引IDのリスト
@@ -413,10 +420,18 @@ def bulk_set_category(
         middle_category_id: 中カテゴリID
     """
     with session_from_cookie_file(COOKIE_FILE) as s:
-        request_transactions_category_bulk_updates(
-            s, large_category_id, middle_category_id, transaction_ids
+        results = apply_mutations(
+            s, [(i, "category", [large_category_id, middle_category_id]) for i in transaction_ids], MUTATION_QUEUE
         )
-    return {"success": True, "updated_count": len(transaction_ids)}
+    failed = {}
+    for r in results:
+        if not r["ok"]:
+            failed.setdefault(r["error"], []).append(r["id"])
+    return {
+        "success": not failed,
+        "updated_count": sum(1 for r in results if r["ok"]),
+        "failed_batches": [{"ids": ids, "error": error} for error, ids in failed.items()],
+    }
 
 
 @mcp.tool()
@@ -428,9 +443,8 @@ def set_transaction_memo(transaction_id: int, memo: str) -> dict:
         memo: 設定するメモ文字列
     """
     with session_from_cookie_file(COOKIE_FILE) as s:
-        csrf = get_csrf_token(s)
-        request_update_user_asset_act(s, csrf, transaction_id, memo=memo)
-    return {"success": True, "transaction_id": transaction_id}
+        results = apply_mutations(s, [(transaction_id, "memo", memo)], MUTATION_QUEUE)
+    return mutation_result(transaction_id, results)
 
 
 # === 集計 ===
@@ -454,6 +468,9 @@ def summarize_transactions(
         is_income: True=収入のみ, False=支出のみ, None=両方
         exclude_transfers: True=振替取引を除外
     """
+    if SQLITE_DB:
+        return _summarize_local_transactions(date_from, date_to, group_by, is_income, exclude_transfers)
+
     with session_from_cookie_file(COOKIE_FILE) as s:
         acts, total_count = _fetch_all_transactions(
             s,
@@ -509,7 +526,47 @@ def summarize_transactions(
         "total_count": len(acts),
     }
 
+# summarize_transactions の group_by と月次集計表のキー列の対応
+_SUMMARY_GROUP_KEYS = {
+    "month": "month",
+    "large_category": "large_category",
+    "middle_category": "middle_category",
+    "account": "service_name",
+}
+
 
+def _summarize_local_transactions(
+    date_from: str,
+    date_to: str,
+    group_by: str,
+    is_income: bool | None,
+    exclude_transfers: bool,
+) -> dict:
+    """内部: ローカルミラーの月次集計表から summarize_transactions の結果を作る。"""
+    if group_by not in _SUMMARY_GROUP_KEYS:
+        return {"error": f"Unknown group_by: {group_by}. Must be one of {list(_SUMMARY_GROUP_KEYS)}"}
+
+    dt_from = datetime.strptime(date_from, "%Y-%m-%d").date()
+    dt_to = datetime.strptime(date_to, "%Y-%m-%d").date()
+    with closing(connect(SQLITE_DB)) as con:
+        rows = summarize_monthly(
+            con, SQLITE_TABLE, dt_from, dt_to,
+            group_by=(_SUMMARY_GROUP_KEYS[group_by],),
+            is_income=is_income,
+            exclude_transfers=exclude_transfers,
+        )
+
+    summary = [
+        {"group_key": group_key, "total_amount": total_amount, "transaction_count": transaction_count}
+        for group_key, total_amount, transaction_count in rows
+    ]
+    return {
+        "date_from": date_from,
+        "date_to": date_to,
+        "group_by": group_by,
+        "summary": summary,
+        "total_count": sum(r["transaction_count"] for r in summary),
+    }
 
 
 # -----------------------------------------------------------------------
@@ -20,6 +20,8 @@ import sqlalchemy
 from contextlib import closing
 from bs4 import BeautifulSoup
 from time import sleep
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import random
 from random import uniform
 from tqdm import tqdm
 from contextlib import contextmanager
@@ -38,6 +40,7 @@ from moneyforward_utils import (
     save_large_categories_csv, 
     search_category_sub, 
     get_middle_category_impl,
+    get_category_index,
     traverse,
     convert_user_asset_act_to_dict,
     save_json,
@@ -46,6 +49,15 @@ from moneyforward_utils import (
     output_rows
 )
 
+# SQLite storage (upsert etc.)
+from moneyforward_db import (connect, upsert, update_rows, bucket_digests, replace_bucket, full_month_range,
+                             ensure_filter_indexes, plan_filter_query, get_pattern_matcher, quote)
+from moneyforward_schema import SQLITE_HEADER, parse_header, apply_header, migrate, table_schema
+from moneyforward_parquet import query_parquet
+from moneyforward_rules import load_rules, resolve_rule_categories, plan_categorize, group_category_updates
+from moneyforward_queue import (MUTATION_QUEUE_DB, apply_mutations, connect_queue, drain_mutations, queue_status,
+                                retry_failed_mutations)
+
 
 
 # CLI wrapper functions for moneyforward_api functions
@@ -103,37 +115,6 @@ def get_category(s, args):
 # save_large_categories_csv is now imported from moneyforward_utils
 
 
-def upsert(frame, name: str, unique_index_label, con):
-    pandas_sql = pd.io.sql.pandasSQL_builder(con)
-    
-    if isinstance(frame, pd.Series):
-        frame = frame.to_frame()
-    elif not isinstance(frame, pd.DataFrame):
-        raise NotImplementedError(
-            "'frame' argument should be either a Series or a DataFrame"
-        )
-    
-    # table = pd.io.sql.SQLiteTable(name, pandas_sql, frame=frame, index=False, if_exists='append')
-    table = pd.io.sql.SQLiteTable(name, pandas_sql, frame=frame, index=False, if_exists='append', keys=unique_index_label)
-    table.create()
-    # pandas_sql.execute('CREATE UNIQUE INDEX IF NOT EXISTS "{0}_{1}" ON "{0}" ("{1}");'.format(table.name, unique_index_label))
-    
-    def _execute_insert(self, conn, keys, data_iter):
-        wld = "?"  # wildcard char
-        escape = pd.io.sql._get_valid_sqlite_name
-
-        bracketed_names = [escape(str(column)) for column in keys]
-        col_names = ",".join(bracketed_names)
-        wildcards = ",".join([wld] * len(bracketed_names))
-        insert_statement = (
-            f"INSERT OR REPLACE INTO {escape(self.name)} ({col_names}) VALUES ({wildcards})"
-        )
-        data_list = list(data_iter)
-        conn.executemany(insert_statement, data_list)
-    
-    table.insert(method=_execute_insert)
-
-
 def get_large_categories(s, args):
     large_categories = request_large_categories(s)
     if args.json:
@@ -155,7 +136,7 @@ def get_large_categories(s, args):
         large_category_df = pd.DataFrame(large_category_list)
         middle_category_df = pd.DataFrame(middle_category_list)
         
-        with closing(sqlite3.connect(args.sqlite)) as con:
+        with closing(connect(args.sqlite)) as con:
             upsert(large_category_df, 'large_categories', 'id', con)
             upsert(middle_category_df, 'middle_categories', 'id', con)
         return
@@ -380,6 +361,18 @@ def request_term_data(s, args):
     return pd.concat(term_data_list)
 
 
+def select_sqlite_header(term_data_list, sqlite_header):
+    select_header = [x.split("=", 2)[0] for x in sqlite_header]
+    for c in set(select_header) - set(term_data_list.columns):
+        term_data_list[c] = None
+    term_data_list = term_data_list[select_header]
+    
+    rename_header = dict(x.split("=", 2) for x in sqlite_header if x.find('=') != -1)
+    if rename_header:
+        term_data_list = term_data_list.rename(columns=rename_header)
+    return term_data_list
+
+
 def get_term_data(s, args):
     with change_default_group(s):
         term_data_list = request_term_data(s, args)
@@ -395,16 +388,9 @@ def get_term_data(s, args):
     
     if args.sqlite:
         if args.sqlite_header:
-            select_header = [x.split("=", 2)[0] for x in args.sqlite_header]
-            for c in set(select_header) - set(term_data_list.columns):
-                term_data_list[c] = None
-            term_data_list = term_data_list[select_header]
-            
-            rename_header = dict(x.split("=", 2) for x in args.sqlite_header if x.find('=') != -1)
-            if rename_header:
-                term_data_list=term_data_list.rename(columns=rename_header)
+            term_data_list = select_sqlite_header(term_data_list, args.sqlite_header)
             
-        with closing(sqlite3.connect(args.sqlite)) as con:
+        with closing(connect(args.sqlite)) as con:
             upsert(term_data_list, 'user_asset_act', 'id', con)
         return
     
@@ -413,8 +399,168 @@ def get_term_data(s, args):
         print(*row.tolist())
 
 
+# バケットを取得し直す期間の前後の余裕（サーバーの期間指定が recognized_at と
+# 異なる日付で絞り込んでいても、バケットの月の行を取りこぼさないようにする）
+RECONCILE_FETCH_MARGIN_DAYS = 7
+
+
+def bucket_fetch_range(month, margin_days=RECONCILE_FETCH_MARGIN_DAYS):
+    """バケットの月 'YYYY-MM' を前後 margin_days 日広げた取得期間 (date_from, date_to) を返す"""
+    first = datetime.strptime(month, '%Y-%m')
+    last = (first + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    return first - timedelta(days=margin_days), last + timedelta(days=margin_days)
+
+
+def reconcile_month_range(date_from=None, date_to=None, years=1, today=None):
+    """
+    比べる月の範囲 ('YYYY-MM', 'YYYY-MM') を返す
+
+    期間に丸ごと含まれる月だけを比べる（端数の月はサーバー側の行が揃わないため）。
+    date_to の省略時は今月末、date_from の省略時は date_to の月を含む years 年分（12 * years か月）とする。
+
+    Returns:
+        tuple: ('YYYY-MM', 'YYYY-MM')。丸ごと含まれる月が無い場合は None
+    """
+    if date_to is None:
+        today = today or datetime.now()
+        date_to = (today.replace(day=1) + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    if date_from is None:
+        months = date_to.year * 12 + date_to.month - 12 * years
+        date_from = date_to.replace(year=months // 12, month=months % 12 + 1, day=1)
+    return full_month_range(date_from.date() if isinstance(date_from, datetime) else date_from,
+                            date_to.date() if isinstance(date_to, datetime) else date_to)
+
+
+def request_sub_account_acts(s, sub_account_id_hash, month_from, month_to, large, middle, sqlite_header):
+    """
+    サブアカウントの month_from〜month_to の取引を、前後に余裕を持たせて取得する
+
+    cf_term_data と同じく365日ずつ request_cf_term_data_by_sub_account で取得し、
+    get_term_data_list で読んで sqlite_header の型注釈を適用する。
+
+    Raises:
+        KeyError, ValueError, TypeError: レスポンスの形式が違う場合
+    """
+    date_from = bucket_fetch_range(month_from)[0]
+    date_to = bucket_fetch_range(month_to)[1]
+    frames = []
+    for term_from in xrange(date_from, date_to, timedelta(days=365)):
+        term_to = min(term_from + timedelta(days=364), date_to)
+        cf_term_data = request_cf_term_data_by_sub_account(s, sub_account_id_hash, term_from, term_to)
+        frames.append(get_term_data_list(cf_term_data, large=large, middle=middle))
+        sleep(uniform(0.1, 1))
+    frame, _ = apply_header(pd.concat(frames, ignore_index=True), sqlite_header)
+    return frame
+
+
+def frame_bucket_digests(frame, schema, month_from, month_to):
+    """
+    取得した取引のダイジェストを、ローカルと同じ列型のテーブルに入れて bucket_digests で求める
+
+    ローカルと同じ型・同じ行（ダミー行以外の全て）で集計するので、
+    内容が同じならローカルの bucket_digests と同じ値になる。
+    """
+    with closing(sqlite3.connect(':memory:')) as con:
+        migrate(con, 'user_asset_act', schema, 'id')
+        if len(frame):
+            upsert(frame, 'user_asset_act', 'id', con)
+        return bucket_digests(con, 'user_asset_act', month_from, month_to)
+
+
+def find_differing_buckets(local, remote, sub_account_id_hash):
+    """
+    サブアカウントの (sub_account, 月) ごとのダイジェスト (件数・金額・ハッシュ) を比べ、
+    一致しないバケットを返す
+
+    Args:
+        local (dict): ローカルの bucket_digests
+        remote (dict): サーバーから取得した取引の bucket_digests
+
+    Returns:
+        list: (月, ローカルのダイジェスト, サーバーのダイジェスト)。無い方は None
+    """
+    months = {m for sub, m in [*local, *remote] if sub == sub_account_id_hash}
+    return [(month, local.get((sub_account_id_hash, month)), remote.get((sub_account_id_hash, month)))
+            for month in sorted(months)
+            if local.get((sub_account_id_hash, month)) != remote.get((sub_account_id_hash, month))]
+
+
+def reconcile(s, args):
+    month_range = reconcile_month_range(args.date_from, args.date_to, args.years)
+    if month_range is None:
+        sys.exit('reconcile: the range contains no full month')
+    month_from, month_to = month_range
+    _, _, dtypes_dict = parse_header(args.sqlite_header)
+    schema = table_schema(dtypes_dict)
+    
+    with change_default_group(s):
+        large, middle = get_categories_form_session(s)
+        df = get_account_summaries_list(request_account_summaries(s), args)
+        sub_account_id_hash_list = df['sub_accounts.sub_account_id_hash'].dropna().unique()
+        
+        with closing(connect(args.sqlite)) as con:
+            # ローカルのハッシュをサーバーの取引と同じ列型で求めるため、先に移行する
+            migrate(con, 'user_asset_act', schema, 'id')
+            local = bucket_digests(con, 'user_asset_act', month_from, month_to)
+            
+            differing_count = 0
+            skipped = []
+            for sub_account_id_hash in tqdm(sub_account_id_hash_list, desc='sub_account'):
+                try:
+                    frame = request_sub_account_acts(s, sub_account_id_hash, month_from, month_to,
+                                                     large, middle, args.sqlite_header)
+                except (KeyError, ValueError, TypeError) as e:
+                    # 想定外のレスポンスからは比べない（バケットの更新・削除もしない）
+                    logger.warning('reconcile: skip %s: unexpected response: %r', sub_account_id_hash, e)
+                    skipped.append(sub_account_id_hash)
+                    continue
+                remote = frame_bucket_digests(frame, schema, month_from, month_to)
+                if not remote and any(sub == sub_account_id_hash for sub, _ in local):
+                    # 取得できなかっただけの可能性があるので、ローカルの行を全て消えたとは扱わない
+                    logger.warning('reconcile: skip %s: no acts returned for %s..%s',
+                                   sub_account_id_hash, month_from, month_to)
+                    skipped.append(sub_account_id_hash)
+                    continue
+                
+                differing = find_differing_buckets(local, remote, sub_account_id_hash)
+                differing_count += len(differing)
+                for month, local_digest, remote_digest in differing:
+                    tqdm.write(f'{sub_account_id_hash} {month} local: {local_digest} remote: {remote_digest}')
+                if args.dry_run:
+                    continue
+                
+                for month, _, _ in differing:
+                    # 月をまたいで移った行を消さないよう、バケットの月の前後の行も渡す
+                    date_from, date_to = bucket_fetch_range(month)
+                    recognized_at = pd.to_datetime(frame['recognized_at'].str[:10])
+                    bucket = frame[(recognized_at >= date_from) & (recognized_at <= date_to)]
+                    changed, missing = replace_bucket(con, 'user_asset_act', bucket, sub_account_id_hash, month,
+                                                      delete=args.delete)
+                    if missing and args.delete:
+                        tqdm.write(f'{sub_account_id_hash} {month}: {changed} rows updated, {len(missing)} rows deleted: {missing}')
+                    elif missing:
+                        tqdm.write(f'{sub_account_id_hash} {month}: {changed} rows updated, '
+                                   f'{len(missing)} rows not found upstream (use --delete to delete): {missing}')
+                    else:
+                        tqdm.write(f'{sub_account_id_hash} {month}: {changed} rows updated')
+    
+    print(f'{differing_count} buckets differ ({month_from}..{month_to}, '
+          f'{len(sub_account_id_hash_list) - len(skipped)}/{len(sub_account_id_hash_list)} sub accounts compared)')
+    if skipped and len(skipped) == len(sub_account_id_hash_list):
+        sys.exit(f'reconcile: all {len(skipped)} sub accounts were skipped')
+
+
+def sql_parquet(s, args):
+    df = query_parquet(args.parquet, args.query)
+    if args.csv:
+        df.to_csv(args.csv, encoding='utf-8-sig', index=False)
+        return
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', None):
+        print(df.to_string(index=False))
+
+
 def add_dummy_data_to_user_asset_act(s, args):
-    with closing(sqlite3.connect(args.sqlite)) as con:
+    with closing(connect(args.sqlite)) as con:
         df = pd.read_sql('SELECT * FROM user_asset_act WHERE id > 0 AND content = ?', con, params=(args.content,))
         df['service_category_id'] = args.service_category_id
         df['id'] = df['id'] * -10
@@ -425,7 +571,7 @@ def add_dummy_data_to_user_asset_act(s, args):
 
 
 def add_dummy_offset_data_to_user_asset_act(s, args):
-    with closing(sqlite3.connect(args.sqlite)) as con:
+    with closing(connect(args.sqlite)) as con:
         placeholder = ','.join('?' * len(args.service_category_ids))
         df = pd.read_sql('SELECT * FROM user_asset_act WHERE id > 0 AND service_category_id IN (%s)'  % placeholder, con, params=args.service_category_ids)
         df['service_category_id'] = - df['service_category_id']
@@ -454,19 +600,33 @@ def get_ids(args):
 def request_bulk_update_user_asset_act(s, ids, 
         large_category_id=None, middle_category_id=None, is_target=None, memo=None,
         partner_account_id_hash=None, partner_sub_account_id_hash=None, partner_act_id=None,
-        sqlite=None, sqlite_table=None):
-    
-    csrf_token = get_csrf_token(s)
+        sqlite=None, sqlite_table=None, queue_file=MUTATION_QUEUE_DB):
     
+    # カテゴリ・計算対象・メモは変更キューを通して送る
+    mutations = []
+    category = large_category_id and middle_category_id
     for id_ in ids:
-        request_update_user_asset_act(s, csrf_token, id_,
-            large_category_id=large_category_id,
-            middle_category_id=middle_category_id,
-            is_target=is_target, memo=memo, 
-            partner_account_id_hash=partner_account_id_hash, 
-            partner_sub_account_id_hash=partner_sub_account_id_hash, 
-            partner_act_id=partner_act_id,
-        )
+        if category:
+            mutations.append((id_, 'category', [large_category_id, middle_category_id]))
+        if is_target is not None:
+            mutations.append((id_, 'is_target', is_target))
+        if memo:
+            mutations.append((id_, 'memo', memo))
+    if mutations:
+        print_mutation_report(apply_mutations(s, mutations, queue_file))
+    
+    # 振替先や、大・中カテゴリの片方だけの変更は直接送る
+    if not category and (large_category_id or middle_category_id) \
+            or partner_account_id_hash or partner_sub_account_id_hash or partner_act_id:
+        csrf_token = get_csrf_token(s)
+        for id_ in ids:
+            request_update_user_asset_act(s, csrf_token, id_,
+                large_category_id=None if category else large_category_id,
+                middle_category_id=None if category else middle_category_id,
+                partner_account_id_hash=partner_account_id_hash, 
+                partner_sub_account_id_hash=partner_sub_account_id_hash, 
+                partner_act_id=partner_act_id,
+            )
     
     if sqlite and sqlite_table:
         request_update_sqlite_db(s, ids, sqlite, sqlite_table)
@@ -493,16 +653,14 @@ def update_user_asset_act(s, args):
         partner_sub_account_id_hash=args.partner_sub_account_id_hash, 
         partner_act_id=args.partner_act_id,
         sqlite=args.sqlite, sqlite_table=args.sqlite_table,
+        queue_file=args.mutation_queue,
     )
 
 
 def update_change_transfer_type(s, args, is_transfer, ids=None):
-    csrf_token = get_csrf_token(s)
     ids = ids or get_ids(args)
-    change_type = 'enable_transfer' if is_transfer else 'disable_transfer'
-    
-    for id_ in ids:
-        request_update_change_type(s, csrf_token, id_, change_type)
+    results = apply_mutations(s, [(id_, 'is_transfer', int(bool(is_transfer))) for id_ in ids], args.mutation_queue)
+    print_mutation_report(results)
 
 def update_enable_transfer(s, args):
     update_change_transfer_type(s, args, True)
@@ -514,14 +672,24 @@ def update_disable_transfer(s, args):
 
 
 def change_transfer(s, args):
-    request_change_transfer(s, str(args.id), 
-        partner_account_id_hash=args.partner_account_id_hash or "0",
-        partner_sub_account_id_hash=args.partner_sub_account_id_hash or "0",
-        partner_act_id=args.partner_act_id)
+    transfer = dict(partner_account_id_hash=args.partner_account_id_hash or "0",
+                    partner_sub_account_id_hash=args.partner_sub_account_id_hash or "0",
+                    partner_act_id=args.partner_act_id)
+    print_mutation_report(apply_mutations(s, [(args.id, 'transfer', transfer)], args.mutation_queue))
 
 
 def clear_transfer(s, args):
-    request_clear_transfer(s, str(args.id))
+    print_mutation_report(apply_mutations(s, [(args.id, 'transfer', None)], args.mutation_queue))
+
+
+def mutation_queue(s, args):
+    """変更キューの件数を表示し、--drain で未送信の変更を送る"""
+    with closing(connect_queue(args.mutation_queue)) as con:
+        if args.retry_failed:
+            print('retry:', retry_failed_mutations(con))
+        if args.drain:
+            print_mutation_report(drain_mutations(s, con))
+        print(*(f'{state}={count}' for state, count in queue_status(con).items()))
 
 
 # search_category_sub is now imported from moneyforward_utils
@@ -701,76 +869,38 @@ def update_filter_flags(df, base_flags, column_name, match_values, not_match_val
     elif is_not_null:
         flags = df[column_name].notnull()
     elif match_values:
-        flags = False
-        for val in match_values:
-            flags |= df[column_name].str.contains(val, na=False)
+        flags = get_pattern_matcher(tuple(match_values)).flags(df[column_name])
     elif not_match_values:
-        flags = True
-        for val in not_match_values:
-            flags &= ~df[column_name].str.contains(val, na=True)
+        # 値が無い行は not_match でも除外する (str.contains(..., na=True) と同じ)
+        flags = ~get_pattern_matcher(tuple(not_match_values)).flags(df[column_name], na=True)
     else:
-        flags = True
+        return base_flags
     return base_flags & flags
 
 def get_middle_category(s, args, category_name, is_income=None):
     """argsからカテゴリIDを取得（CLIラッパー）"""
+    index = get_category_index(s, args.cache_category_csv, args.force_category_update)
     try:
-        return get_middle_category_impl(
-            s,
-            args.cache_category_csv,
-            args.force_category_update,
-            category_name,
-            is_income=is_income
-        )
+        return index.resolve(category_name, is_income)
     except ValueError as e:
         # エラー時に候補を表示（既存動作の互換性維持）
         if "Not Unique" in str(e):
-            category_df = search_category_sub(
-                s,
-                args.cache_category_csv,
-                args.force_category_update,
-                middle=category_name,
-                is_income=is_income
-            )
+            category_df = index.frame(index.find_middle(category_name, is_income))
             print(*category_df.columns.tolist())
             for index, row in category_df.iterrows():
                 print(*row.tolist())
         raise
 
 
-def filter_db(s, args):
-    category_id = None
-    if args.update_category_name:
-        category_id = get_middle_category(s, args, args.update_category_name, is_income=args.is_income)
-    elif args.update_category:
-        category_id = args.update_category
-    
-    column_name_for_service_name = 'account.service.service_name'
-    column_name_for_sub_type = 'sub_account.sub_type'
-    
-    if args.csv:
-        df = pd.read_csv(args.csv)
-    elif args.sqlite:
-        column_name_for_service_name = 'service_name'
-        column_name_for_sub_type = 'sub_type'
-        with closing(sqlite3.connect(args.sqlite)) as con:
-            df = pd.read_sql(f'SELECT * FROM {args.sqlite_table}', con)
-    else:
-        raise ValueError("invalid args")
-
-    if args.query:
-        df = df.query(args.query, engine='python')
-    
+def get_filter_flags(df, args, column_name_for_service_name, column_name_for_sub_type):
+    """filter_db の絞り込み条件を pandas で評価する（CSV 用）"""
     if args.patterns is not None:
-        flags = df.index == np.nan
-        for pat in args.patterns:
-            flags |= df['content'].str.contains(pat, na=False)
+        flags = get_pattern_matcher(tuple(args.patterns)).flags(df['content'])
     else:
         flags = df.index != np.nan
     
     if args.exclude_patterns is not None:
-        for ep in args.exclude_patterns:
-            flags &= ~df['content'].str.contains(ep, na=False)
+        flags &= ~get_pattern_matcher(tuple(args.exclude_patterns)).flags(df['content'])
     
     flags = update_filter_flags(df, flags, 'middle_category', args.match_middle_categories, args.not_match_middle_categories)
     flags = update_filter_flags(df, flags, 'large_category', args.match_large_categories, args.not_match_large_categories)
@@ -780,7 +910,6 @@ def filter_db(s, args):
     flags = update_filter_flags(df, flags, 'memo', args.match_memo, args.not_match_memo, args.null_memo, args.not_null_memo)
     
     if args.date_from or args.date_to:
-        print(f"date: {args.date_from and args.date_from.strftime('%y/%m/%d')} - {args.date_to and args.date_to.strftime('%y/%m/%d')}")
         dt = pd.to_datetime(df['date'], format='%y/%m/%d')
     if args.date_from:
         flags &= dt >= args.date_from
@@ -803,7 +932,132 @@ def filter_db(s, args):
     if args.ge is not None:
         flags &= df['amount'] >= args.ge
     
-    result = df.loc[flags ^ args.reverse]
+    return flags
+
+
+# filter_db --chunksize で SQLite をメモリマップで読む上限サイズ
+FILTER_DB_MMAP_SIZE = 256 * 1024 * 1024
+
+
+def plan_filter_db_query(con, args):
+    """filter_db の絞り込み条件を SQL の WHERE 句に変換する"""
+    ensure_filter_indexes(con, args.sqlite_table)
+    
+    columns = None
+    if args.columns and not args.query:
+        columns = list(dict.fromkeys(['id', *args.columns, *(args.sort or [])]))
+    
+    sql, params = plan_filter_query(con, args.sqlite_table, columns=columns,
+        patterns=args.patterns, exclude_patterns=args.exclude_patterns,
+        match_columns=[
+            ('middle_category', args.match_middle_categories, args.not_match_middle_categories),
+            ('large_category', args.match_large_categories, args.not_match_large_categories),
+            ('service_name', args.match_service_name, args.not_match_service_name),
+            ('sub_type', args.match_sub_account, args.not_match_sub_account),
+            ('memo', args.match_memo, args.not_match_memo, args.null_memo, args.not_null_memo, False),
+        ],
+        date_from=args.date_from, date_to=args.date_to,
+        ignore_invalid_data=args.ignore_invalid_data,
+        is_income=args.is_income, is_transfer=args.is_transfer,
+        lt=args.lt, le=args.le, gt=args.gt, ge=args.ge,
+        reverse=args.reverse)
+    logger.debug("filter_db: %s %s", sql, params)
+    return sql, params
+
+
+def read_filtered_sqlite(args):
+    """filter_db の絞り込み条件を SQL の WHERE 句に変換し、該当行のみ読み込む"""
+    with closing(sqlite3.connect(args.sqlite)) as con:
+        sql, params = plan_filter_db_query(con, args)
+        return pd.read_sql(sql, con, params=params)
+
+
+def iter_filtered_chunks(args):
+    """
+    filter_db の絞り込み結果を args.chunksize 行ずつ読み込んで返す
+    
+    CSV は chunk ごとに --query と絞り込み条件を pandas で評価する。
+    SQLite は WHERE 句で絞り込んだ結果を chunk ごとに読み、--query のみ pandas で評価する。
+    """
+    if args.csv:
+        for chunk in pd.read_csv(args.csv, chunksize=args.chunksize):
+            if args.query:
+                chunk = chunk.query(args.query, engine='python')
+            flags = get_filter_flags(chunk, args, 'account.service.service_name', 'sub_account.sub_type')
+            yield chunk.loc[flags ^ args.reverse]
+    elif args.sqlite:
+        with closing(sqlite3.connect(args.sqlite)) as con:
+            con.execute(f'PRAGMA mmap_size={FILTER_DB_MMAP_SIZE}')
+            sql, params = plan_filter_db_query(con, args)
+            for chunk in pd.read_sql(sql, con, params=params, chunksize=args.chunksize):
+                if args.query:
+                    chunk = chunk.query(args.query, engine='python')
+                yield chunk
+    else:
+        raise ValueError("invalid args")
+
+
+def filter_db_chunked(s, args, category_id):
+    """
+    filter_db のストリーミング実行（--chunksize 指定時）
+    
+    一覧・CSV 出力は chunk ごとに書き出し、更新系の操作は該当 id のみ集めてから実行する。
+    """
+    if args.sort:
+        raise ValueError("--sort can't be used with --chunksize")
+    
+    collect_ids = not (args.list or args.output_csv) and has_filter_db_action(args, category_id)
+    ids = []
+    header = True
+    for chunk in iter_filtered_chunks(args):
+        if args.columns:
+            chunk = chunk[args.columns]
+        
+        if args.list:
+            if header:
+                print(*chunk.columns.tolist())
+            for row in chunk.itertuples(index=False, name=None):
+                print(*row)
+        elif args.output_csv:
+            chunk.to_csv(args.output_csv, encoding='utf_8_sig' if header else 'utf-8', index=False,
+                         header=header, mode='w' if header else 'a')
+        elif collect_ids:
+            ids.extend(chunk['id'].tolist())
+        else:
+            print(chunk.to_string(header=header))
+        header = False
+    
+    if collect_ids:
+        apply_filter_db_action(s, args, category_id, ids)
+
+
+def filter_db(s, args):
+    category_id = None
+    if args.update_category_name:
+        category_id = get_middle_category(s, args, args.update_category_name, is_income=args.is_income)
+    elif args.update_category:
+        category_id = args.update_category
+    
+    if args.date_from or args.date_to:
+        print(f"date: {args.date_from and args.date_from.strftime('%y/%m/%d')} - {args.date_to and args.date_to.strftime('%y/%m/%d')}")
+    
+    if args.chunksize:
+        filter_db_chunked(s, args, category_id)
+        return
+    
+    if args.csv:
+        df = pd.read_csv(args.csv)
+        if args.query:
+            df = df.query(args.query, engine='python')
+        flags = get_filter_flags(df, args, 'account.service.service_name', 'sub_account.sub_type')
+        result = df.loc[flags ^ args.reverse]
+    elif args.sqlite:
+        # SQL で表現できない --query のみ pandas で評価する
+        result = read_filtered_sqlite(args)
+        if args.query:
+            result = result.query(args.query, engine='python')
+    else:
+        raise ValueError("invalid args")
     
     if args.columns:
         result = result[args.columns]
@@ -817,31 +1071,41 @@ def filter_db(s, args):
             print(*row.tolist())
     elif args.output_csv:
         result.to_csv(args.output_csv, encoding='utf_8_sig', index=False)
-    elif category_id:
+    elif has_filter_db_action(args, category_id):
+        apply_filter_db_action(s, args, category_id, result['id'].tolist())
+    else:
+        print(result)
+
+
+def has_filter_db_action(args, category_id):
+    return bool(category_id or args.update_sqlite_db or args.list_id
+                or args.update_transfer is not None or args.update_partner_account is not None)
+
+
+def apply_filter_db_action(s, args, category_id, ids):
+    """filter_db で絞り込んだ id に対して、指定された更新・出力を行う"""
+    if category_id:
         large_category_id, middle_category_id = category_id[0], category_id[1]
-        request_transactions_category_bulk_updates_with_update_db(s, large_category_id, middle_category_id, result['id'].tolist(), args.sqlite, args.sqlite_table)
+        request_transactions_category_bulk_updates_with_update_db(s, large_category_id, middle_category_id, ids, args.sqlite, args.sqlite_table,
+                                                                  queue_file=args.mutation_queue)
     elif args.update_sqlite_db:
-        update_sqlite_db(s, args, ids=result['id'].tolist())
+        update_sqlite_db(s, args, ids=ids)
     elif args.list_id:
         print()
-        print(" ".join(str(x) for x in result['id'].tolist()))
+        print(" ".join(str(x) for x in ids))
         print()
     elif args.update_transfer is not None:
-        ids = result['id'].tolist()
         update_change_transfer_type(s, args, args.update_transfer, ids=ids)
         if args.sqlite:
             update_sqlite_db(s, args, ids=ids)
     elif args.update_partner_account is not None:
-        ids = result['id'].tolist()
         partner_account_id_hash, partner_sub_account_id_hash = args.update_partner_account
         update_change_transfer_type(s, args, True, ids=ids)
         request_bulk_update_user_asset_act(s, ids=ids, 
             partner_account_id_hash=partner_account_id_hash,
             partner_sub_account_id_hash=partner_sub_account_id_hash,
-            sqlite=args.sqlite, sqlite_table=args.sqlite_table,
+            sqlite=args.sqlite, sqlite_table=args.sqlite_table, queue_file=args.mutation_queue,
         )
-    else:
-        print(result)
 
 
 def update_sqlite_db(s, args, ids=None):
@@ -851,59 +1115,166 @@ def update_sqlite_db(s, args, ids=None):
         pretty = args.pretty
 
     if args.sqlite and args.sqlite_table:
-        request_update_sqlite_db(s, ids, args.sqlite, args.sqlite_table, pretty=pretty)
+        request_update_sqlite_db(s, ids, args.sqlite, args.sqlite_table, pretty=pretty,
+                                 trace=getattr(args, 'trace', False))
     else:
         raise ValueError("invalid args #{args.sqlite=}, {args.sqlite_table=}")
 
 
-def request_update_sqlite_db(s, ids, sqlite, sqlite_table, pretty=False):
+# 取引の再取得時にローカルミラーへ書き戻す列 (APIのキー=テーブルの列名)
+UPDATE_SQLITE_DB_COLUMNS = [
+    tuple(n.split('=', 1)) if '=' in n else (n, n) for n in
+    '''middle_category_id middle_category large_category_id large_category memo
+       is_transfer
+       partner_account.disp_name=partner_account_disp_name
+       partner_account.display_name=partner_account_display_name
+       partner_account.memo=partner_account_memo
+       partner_sub_account.sub_name=partner_account_sub_name
+       partner_sub_account.sub_type=partner_account_sub_type
+       partner_sub_account.sub_number=partner_account_sub_number
+       transfer_type is_target partner_account_id partner_sub_account_id partner_act_id'''.split()
+]
+
+# 取引の再取得の並列数と、リクエストの最小間隔 (秒)（カテゴリ一括更新と同じ）
+UPDATE_SQLITE_DB_WORKERS = CATEGORY_BULK_UPDATE_WORKERS
+UPDATE_SQLITE_DB_INTERVAL = CATEGORY_BULK_UPDATE_INTERVAL
+
+
+def request_user_asset_act_records(s, ids, large, middle, pretty=False,
+                                   workers=UPDATE_SQLITE_DB_WORKERS, interval=UPDATE_SQLITE_DB_INTERVAL):
+    """
+    取引を並列に取得し、ローカルミラーの UPDATE 用の辞書を返す
+    
+    取得に失敗した取引は警告して飛ばし、取得できた分だけを返す。
+    
+    Returns:
+        tuple: (UPDATE 用の辞書のリスト, 取得に失敗した id のリスト)
+    """
+    limiter = RateLimiter(interval)
+    
+    def fetch(id):
+        limiter.wait()
+        return request_user_asset_act_by_id(s, id)
+    
+    records = []
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(fetch, id): id for id in ids}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            id = futures[future]
+            try:
+                user_asset_act = future.result()
+                user_asset_act_dict = convert_user_asset_act_to_dict(user_asset_act, large, middle)
+            except Exception as e:
+                logger.warning('failed to fetch user_asset_act %s: %s', id, e)
+                failed.append(id)
+                continue
+            if pretty:
+                tqdm.write(pformat(user_asset_act))
+            record = dict(id=id)
+            for k, n in UPDATE_SQLITE_DB_COLUMNS:
+                if k in user_asset_act_dict:
+                    record[n] = user_asset_act_dict[k]
+            records.append(record)
+    return records, failed
+
+
+def request_update_sqlite_db(s, ids, sqlite, sqlite_table, pretty=False, trace=False):
     large, middle = get_categories_form_session(s)
     if not (large and middle):
         raise ValueError("failed: get_categories_form_session")
     
-    with closing(sqlite3.connect(sqlite)) as con:
-        cur = con.cursor()
-        con.set_trace_callback(tqdm.write)
-        
-        for id in tqdm(ids):
-            user_asset_act = request_user_asset_act_by_id(s, id)
-            #tqdm.write(f"{user_asset_act=}")
-            user_asset_act_dict = convert_user_asset_act_to_dict(user_asset_act, large, middle)
-            if pretty:
-                tqdm.write(pformat(user_asset_act))
-            param = dict(id=id)
-            names = '''middle_category_id middle_category large_category_id large_category memo
-                       is_transfer
-                       partner_account.disp_name=partner_account_disp_name
-                       partner_account.display_name=partner_account_display_name
-                       partner_account.memo=partner_account_memo
-                       partner_sub_account.sub_name=partner_account_sub_name
-                       partner_sub_account.sub_type=partner_account_sub_type
-                       partner_sub_account.sub_number=partner_account_sub_number
-                       transfer_type is_target partner_account_id partner_sub_account_id partner_act_id'''.split()
-            for n in names:
-                if n.find('=') == -1:
-                    k = n
-                else:
-                    k, n = n.split("=", 2)
-                if k in user_asset_act_dict:
-                    param[n] = user_asset_act_dict[k]
+    records, failed = request_user_asset_act_records(s, ids, large, middle, pretty=pretty)
+    
+    with closing(connect(sqlite)) as con:
+        if trace:
+            con.set_trace_callback(tqdm.write)
+        count = update_rows(con, sqlite_table, records)
+    logger.info('update_sqlite_db: %d/%d rows updated', count, len(ids))
+    if failed:
+        logger.warning('update_sqlite_db: %d rows could not be fetched: %s', len(failed), sorted(failed))
+    return failed
 
-            try:
-                cur.execute(f"UPDATE {sqlite_table} SET "
-                            + ", ".join(f"{n} = :{n}" for n in param.keys() if n != 'id')
-                            + " WHERE id == :id", param)
-            except sqlite3.Error as e:
-                print("error", e.args[0])
-            sleep(uniform(0.1, 1))
-        con.commit()
+
+def print_mutation_report(results):
+    """apply_mutations / drain_mutations の結果（失敗した変更と件数）を表示する"""
+    failed = defaultdict(list)
+    for r in results:
+        if not r['ok']:
+            failed[r['field'], json.dumps(r['value'], ensure_ascii=False), r['error']].append(r['id'])
+    for (field, value, error), ids in failed.items():
+        print('failed:', field, value, error, ids)
+    print(f"mutations: {sum(1 for r in results if r['ok'])}/{len(results)} applied")
 
 
-def request_transactions_category_bulk_updates_with_update_db(s, large_category_id, middle_category_id, ids, sqlite=None, sqlite_table=None):
-    request_transactions_category_bulk_updates(s, large_category_id, middle_category_id, ids)
+# カテゴリの一括更新後に、ローカルミラーへ書き込んだ内容を確かめるため再取得する件数
+BULK_UPDATE_VERIFY_SAMPLE = 5
+
+# 一括更新で書き込むカテゴリの列
+CATEGORY_UPDATE_COLUMNS = ('large_category_id', 'middle_category_id')
+
+
+def apply_category_updates_to_db(s, groups, sqlite, sqlite_table, verify_sample=BULK_UPDATE_VERIFY_SAMPLE):
+    """
+    一括更新したカテゴリを、取引を再取得せずにローカルミラーへ書き込む
     
-    if sqlite and sqlite_table:
-        request_update_sqlite_db(s, ids, sqlite, sqlite_table)
+    変更内容（大・中カテゴリのIDと名前）は分かっているので1トランザクションで更新し、
+    verify_sample 件だけ再取得して書き込んだ内容と一致するか確かめる
+    （再取得した内容で上書きし、一致しなければ警告する）。
+    
+    Args:
+        groups (dict): (large_category_id, middle_category_id) → 更新できた id のリスト
+    """
+    large, middle = get_categories_form_session(s)
+    records = [dict(id=i, large_category_id=l, large_category=large.get(l, '-'),
+                    middle_category_id=m, middle_category=middle.get(m, '-'))
+               for (l, m), ids in groups.items() for i in ids]
+    with closing(connect(sqlite)) as con:
+        count = update_rows(con, sqlite_table, records)
+    logger.info('update_sqlite_db: %d/%d rows updated without re-fetching', count, len(records))
+    
+    expected = {r['id']: r for r in random.sample(records, min(verify_sample, len(records)))}
+    if not expected:
+        return
+    fetched, failed = request_user_asset_act_records(s, list(expected), large, middle)
+    if failed:
+        logger.warning('update_sqlite_db: %d sampled rows could not be re-fetched: %s', len(failed), sorted(failed))
+    mismatched = [r['id'] for r in fetched
+                  if any(str(r.get(c)) != str(expected[r['id']][c]) for c in CATEGORY_UPDATE_COLUMNS)]
+    with closing(connect(sqlite)) as con:
+        update_rows(con, sqlite_table, fetched)
+    if mismatched:
+        logger.warning('update_sqlite_db: %d/%d sampled rows differ from the server, '
+                       'run update_sqlite_db to re-fetch all: %s', len(mismatched), len(fetched), mismatched)
+
+
+def request_category_bulk_updates_with_update_db(s, groups, sqlite=None, sqlite_table=None, queue_file=MUTATION_QUEUE_DB):
+    """
+    カテゴリの変更を変更キューに記録してまとめて送信し、更新できた取引をローカルミラーに反映する
+    
+    Args:
+        groups (dict): (large_category_id, middle_category_id) → id のリスト
+        queue_file (str): 変更キューの SQLite ファイルパス
+    
+    Returns:
+        list: 変更ごとの結果（apply_mutations を参照）
+    """
+    results = apply_mutations(s, [(i, 'category', [l, m]) for (l, m), ids in groups.items() for i in ids], queue_file)
+    print_mutation_report(results)
+    
+    updated = defaultdict(list)
+    for r in results:
+        if r['ok']:
+            updated[tuple(r['value'])].append(r['id'])
+    if sqlite and sqlite_table and updated:
+        apply_category_updates_to_db(s, updated, sqlite, sqlite_table)
+    return results
+
+
+def request_transactions_category_bulk_updates_with_update_db(s, large_category_id, middle_category_id, ids, sqlite=None, sqlite_table=None,
+                                                              queue_file=MUTATION_QUEUE_DB):
+    return request_category_bulk_updates_with_update_db(s, {(large_category_id, middle_category_id): list(ids)},
+                                                        sqlite=sqlite, sqlite_table=sqlite_table, queue_file=queue_file)
 
 
 def transactions_category_bulk_updates(s, args):
@@ -922,7 +1293,8 @@ def transactions_category_bulk_updates(s, args):
         if not ids:
             raise ValueError('ids not specified')
     request_transactions_category_bulk_updates_with_update_db(s, large_category_id, middle_category_id, ids,
-                                               sqlite=args.sqlite, sqlite_table=args.sqlite_table)
+                                               sqlite=args.sqlite, sqlite_table=args.sqlite_table,
+                                               queue_file=args.mutation_queue)
 
 
 def bulk_update_category(s, args):
@@ -952,10 +1324,8 @@ def bulk_update_category(s, args):
             sys.exit(1)
         print("execute")
         
-        for l, md in data.items():
-            for m, ids in md.items():
-                print('large_category_id', l, 'middle_category_id', m)
-                request_transactions_category_bulk_updates_with_update_db(s, l, m, list(ids))
+        request_category_bulk_updates_with_update_db(s, {(l, m): sorted(ids) for l, md in data.items() for m, ids in md.items()},
+                                                     queue_file=args.mutation_queue)
 
     except KeyboardInterrupt:
         print("Ok ok, quitting")
@@ -968,7 +1338,7 @@ def bulk_update_category2(s, args):
     else:
       print(f"Please Input. ({args.delimiter=}, column_category_name={args.column_category_name=}, {args.column_id=})")
     
-    data = defaultdict(set)
+    rows = []
     for line in stream.readlines():
         line = line.strip()
         if not line:
@@ -977,25 +1347,44 @@ def bulk_update_category2(s, args):
         try:
             row = line.split(args.delimiter)
             i = row[args.column_id]
-            c = row[args.column_category_name]
+            c = row[args.column_category_name].strip()
             
             if i.strip() == "":
                 print(f"Not Found ID. Skip! {line}")
                 continue
             i = int(i)
             
-            if c.strip() == "":
+            if c == "":
                 print(f"Not Found ID. Skip! {line}")
                 continue
             
-            category_id = get_middle_category(s, args, c)
-            data[category_id].add(i)
+            rows.append((i, c, line))
             
         except Exception as e:
             print(e)
             print(f"Parse Error. Skip! {line}")
             continue
     
+    # カテゴリ名は重複を除いてまとめて解決し、解決できない名前は実行前に全て表示する
+    index = get_category_index(s, args.cache_category_csv, args.force_category_update)
+    resolved, errors = index.resolve_many(c for _, c, _ in rows)
+    for name, candidates in errors.items():
+        if not candidates:
+            print(f"Not Found Category Name: {name}")
+            continue
+        print(f"Not Unique Category Name: {name}")
+        category_df = index.frame(candidates)
+        print(*category_df.columns.tolist())
+        for _, row in category_df.iterrows():
+            print(*row.tolist())
+    
+    data = defaultdict(set)
+    for i, c, line in rows:
+        if c in errors:
+            print(f"Unresolved Category Name. Skip! {line}")
+            continue
+        data[resolved[c]].add(i)
+    
     print("--------")
     for (l, m), ids in data.items():
         print('large_category_id', l, 'middle_category_id', m)
@@ -1007,10 +1396,59 @@ def bulk_update_category2(s, args):
         sys.exit(1)
     print("execute")
     
-    for (l, m), ids in data.items():
-        print('large_category_id', l, 'middle_category_id', m)
-        request_transactions_category_bulk_updates_with_update_db(s, l, m, list(ids),
-            sqlite=args.sqlite, sqlite_table=args.sqlite_table)
+    request_category_bulk_updates_with_update_db(s, {k: sorted(ids) for k, ids in data.items()},
+        sqlite=args.sqlite, sqlite_table=args.sqlite_table, queue_file=args.mutation_queue)
+
+def read_categorize_source(args):
+    """categorize の対象の取引を読み込む（--date_from / --date_to で絞り込む）"""
+    if args.csv:
+        df = pd.read_csv(args.csv)
+        column_names = {'service_name': 'account.service.service_name', 'sub_type': 'sub_account.sub_type'}
+    else:
+        with closing(sqlite3.connect(args.sqlite)) as con:
+            df = pd.read_sql(f'SELECT * FROM {quote(args.sqlite_table)}', con)
+        column_names = {}
+    
+    if args.date_from or args.date_to:
+        dt = pd.to_datetime(df['date'], format='%y/%m/%d')
+        flags = dt.notnull()
+        if args.date_from:
+            flags &= dt >= args.date_from
+        if args.date_to:
+            flags &= dt <= args.date_to
+        df = df.loc[flags]
+    return df, column_names
+
+
+def categorize(s, args):
+    """ルールファイルの条件で取引をまとめてカテゴリ分けする"""
+    rules = load_rules(args.rules)
+    index = get_category_index(s, args.cache_category_csv, args.force_category_update)
+    targets = resolve_rule_categories(rules, index)
+    
+    df, column_names = read_categorize_source(args)
+    changes = plan_categorize(df, rules, targets, column_names)
+    groups = group_category_updates(changes)
+    
+    columns = [c for c in ('id', 'date', 'content', 'amount', 'large_category', 'middle_category', 'rule') if c in changes]
+    for (l, m), ids in groups.items():
+        print(f'{index.large.get(l, l)}/{index.middle.get(m, m)}', 'large_category_id', l, 'middle_category_id', m, f'({len(ids)})')
+        group = changes.loc[changes['id'].isin(ids), columns]
+        print(group.to_string(index=False))
+        print()
+    print(f'{len(changes)} transactions, {len(groups)} categories')
+    
+    if args.dry_run or not groups:
+        return
+    
+    if not args.yes and not input("\nReally quit? (y/N)> ").lower().startswith('y'):
+        sys.exit(1)
+    print("execute")
+    
+    sqlite = args.sqlite if not args.no_update_sqlite_db else None
+    request_category_bulk_updates_with_update_db(s, groups, sqlite=sqlite, sqlite_table=args.sqlite_table,
+                                                 queue_file=args.mutation_queue)
+
 
 setattr(argparse._ActionsContainer, '__enter__', lambda self: self)
 setattr(argparse._ActionsContainer, '__exit__', lambda self, exc_type, exc_value, traceback: None)
@@ -1024,6 +1462,13 @@ def add_standard_output_group(subparser, csv=True, lst=False):
         group.add_argument('--list', action='store_true')
     return group
 
+def positive_int(value):
+    """1以上の整数の引数"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'must be >= 1: {value}')
+    return number
+
 def add_parser(subparsers, name, func):
     subparser = subparsers.add_parser(name)
     subparser.set_defaults(func=func)
@@ -1034,6 +1479,7 @@ parser.add_argument('-c', '--mf_cookies', default='mf_cookies.pkl')
 parser.add_argument('-d', '--debug', action='store_true')
 parser.add_argument('--cache_category_csv', default='cache_search_categories.csv') # いろいろなコマンドで使うので共通化
 parser.add_argument('--force_category_update', action='store_true') # いろいろなコマンドで使うので共通化
+parser.add_argument('--mutation_queue', default=MUTATION_QUEUE_DB, help='取引の変更を記録するキュー (SQLite)')
 
 
 subparsers = parser.add_subparsers(dest='cmd', required=True)
@@ -1164,6 +1610,24 @@ with add_parser(subparsers, 'cf_term_data', func=get_term_data) as subparser:
     subparser.add_argument('-i', '--ignore_KeyError', action='store_true')
 
 
+with add_parser(subparsers, 'reconcile', func=reconcile) as subparser:
+    subparser.add_argument('-s', '--sqlite', required=True, metavar='cf_term_data.db')
+    subparser.add_argument('-f', '--date_from', type=dateutil.parser.parse)
+    subparser.add_argument('-t', '--date_to', type=dateutil.parser.parse)
+    subparser.add_argument('-y', '--years', type=positive_int, default=1, help='--date_from の省略時に比べる年数（今月を含む 12 * years か月）')
+    subparser.add_argument('-c', '--service_category_id', type=int)
+    subparser.add_argument('-n', '--name')
+    subparser.add_argument('--dry_run', action='store_true', help='一致しないバケットを表示するだけ')
+    subparser.add_argument('--delete', action='store_true', help='取得し直した期間に無い行をローカルから削除する（既定は表示のみ）')
+    subparser.add_argument('--sqlite_header', nargs='+', default=SQLITE_HEADER)
+
+
+with add_parser(subparsers, 'sql', func=sql_parquet) as subparser:
+    subparser.add_argument('parquet', metavar='DIR', help='cf_term_data.py --parquet で作成したデータセット')
+    subparser.add_argument('query', help='SQL (データセットは user_asset_act として参照)')
+    subparser.add_argument('--csv')
+
+
 with subparsers.add_parser('add_dummy_data_to_user_asset_act') as subparser:
     subparser.set_defaults(func=add_dummy_data_to_user_asset_act)
     subparser.add_argument('sqlite')
@@ -1251,6 +1715,7 @@ with add_parser(subparsers, 'update_sqlite_db', func=update_sqlite_db) as subpar
     subparser.add_argument('-s', '--sqlite', required=True, metavar='cf_term_data.db')
     subparser.add_argument('--sqlite_table', default='user_asset_act')
     subparser.add_argument('--pretty', action='store_true')
+    subparser.add_argument('--trace', action='store_true', help='実行するSQLを表示')
 
 
 with subparsers.add_parser('filter_db') as subparser:
@@ -1261,6 +1726,7 @@ with subparsers.add_parser('filter_db') as subparser:
     subparser.add_argument('--sqlite_table', default='user_asset_act')
     subparser.add_argument('--columns', type=str, nargs='+')
     subparser.add_argument('--sort', metavar='column', nargs='+')
+    subparser.add_argument('--chunksize', type=int, metavar='rows', help='指定行数ずつ読み込んで順に出力する (--sort は不可)')
 
     with subparser.add_mutually_exclusive_group() as group:
         group.add_argument('--list', action='store_true')
@@ -1332,6 +1798,24 @@ with add_parser(subparsers, 'bulk_update_category', func=bulk_update_category) a
     subparser.add_argument('-l', '--column_large_category_id', type=int, required=True)
     subparser.add_argument('-i', '--column_id', type=int, required=True)
 
+with add_parser(subparsers, 'mutation_queue', func=mutation_queue) as subparser:
+    subparser.add_argument('--drain', action='store_true', help='未送信・再送待ちの変更を送る')
+    subparser.add_argument('--retry_failed', action='store_true', help='再送をあきらめた変更を再送待ちに戻す')
+
+
+with add_parser(subparsers, 'categorize', func=categorize) as subparser:
+    subparser.add_argument('rules', help='ルールファイル (JSON または CSV)')
+    with subparser.add_mutually_exclusive_group(required=True) as group:
+        group.add_argument('--csv')
+        group.add_argument('--sqlite', metavar='cf_term_data.db')
+    subparser.add_argument('--sqlite_table', default='user_asset_act')
+    subparser.add_argument('-b', '--date_from', type=dateutil.parser.parse)
+    subparser.add_argument('-e', '--date_to', type=dateutil.parser.parse)
+    subparser.add_argument('-n', '--dry_run', action='store_true', help='変更内容を表示するだけで更新しない')
+    subparser.add_argument('-y', '--yes', action='store_true', help='確認せずに更新する')
+    subparser.add_argument('--no_update_sqlite_db', action='store_true', help=f'更新したカテゴリを --sqlite に書き込まず、確認用の再取得（{BULK_UPDATE_VERIFY_SAMPLE}件）もしない')
+
+
 with add_parser(subparsers, 'bulk_update_category2', func=bulk_update_category2) as subparser:
     subparser.add_argument('-f', '--input_file')
     subparser.add_argument('-d', '--delimiter', default=":", nargs='?', const=None)
@@ -3,9 +3,12 @@
 
 import json
 import logging
+import threading
 import requests
 from bs4 import BeautifulSoup
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from time import sleep, monotonic
 import pickle
 
 logger = logging.getLogger(__name__)
@@ -228,6 +231,9 @@ def request_update_user_asset_act(s, csrf_token, id_,
         partner_account_id_hash: 振替先アカウントIDハッシュ (optional)
         partner_sub_account_id_hash: 振替先サブアカウントIDハッシュ (optional)
         partner_act_id: 振替先取引ID (optional)
+    
+    Returns:
+        requests.Response: レスポンス
     """
     url = 'https://moneyforward.com/cf/update'
     headers = {
@@ -255,6 +261,7 @@ def request_update_user_asset_act(s, csrf_token, id_,
     is_ok = r.status_code == 200
     if not is_ok:
         logger.warning("%s %s", r.status_code, r.text)
+    return r
 
 
 def request_update_change_type(s, csrf_token, id_, change_type):
@@ -267,6 +274,9 @@ def request_update_change_type(s, csrf_token, id_, change_type):
         csrf_token: CSRFトークン
         id_: 取引ID
         change_type: 変更タイプ ('enable_transfer', 'disable_transfer'等)
+    
+    Returns:
+        requests.Response: レスポンス
     """
     url = 'https://moneyforward.com/cf/update'
     headers = {
@@ -278,6 +288,7 @@ def request_update_change_type(s, csrf_token, id_, change_type):
     is_ok = r.status_code == 200
     if not is_ok:
         logger.warning("%s %s", r.status_code, r.text)
+    return r
 
 
 def request_change_transfer(s, id, partner_account_id_hash="0", partner_sub_account_id_hash="0", partner_act_id=None):
@@ -291,6 +302,9 @@ def request_change_transfer(s, id, partner_account_id_hash="0", partner_sub_acco
         partner_account_id_hash: 振替先アカウントIDハッシュ (デフォルト: "0")
         partner_sub_account_id_hash: 振替先サブアカウントIDハッシュ (デフォルト: "0")
         partner_act_id: 振替先取引ID (optional)
+    
+    Returns:
+        requests.Response: レスポンス
     """
     url = 'https://moneyforward.com/sp/change_transfer'
     params = dict(id=id, partner_account_id_hash=partner_account_id_hash, partner_sub_account_id_hash=partner_sub_account_id_hash)
@@ -299,6 +313,7 @@ def request_change_transfer(s, id, partner_account_id_hash="0", partner_sub_acco
     r = s.post(url, json.dumps(params), headers={'Content-Type': 'application/json'})
     if r.status_code != requests.codes.ok:
         logger.warning("%s %s", r.status_code, r.text)
+    return r
 
 
 def request_clear_transfer(s, id):
@@ -309,12 +324,16 @@ def request_clear_transfer(s, id):
     Args:
         s: requests.Session
         id: 取引ID
+    
+    Returns:
+        requests.Response: レスポンス
     """
     url = 'https://moneyforward.com/sp/clear_transfer'
     params = dict(id=id)
     r = s.post(url, json.dumps(params), headers={'Content-Type': 'application/json'})
     if r.status_code != requests.codes.ok:
         logger.warning("%s %s", r.status_code, r.text)
+    return r
 
 
 def request_user_asset_act_by_id(s, id):
@@ -453,18 +472,149 @@ def request_transactions_category_bulk_updates(s, large_category_id, middle_cate
         logger.warning("ids is empty")
         return
 
-    url = 'https://moneyforward.com/sp2/transactions_category_bulk_updates'
     n = 100
     for i in range(0, len(ids), n):
-        params = dict(
-          middle_category_id=middle_category_id,
-          large_category_id=large_category_id,
-          ids=ids[i:i + n]
-        )
-        r = s.put(url, json.dumps(params), headers={'Content-Type': 'application/json'})
+        r = request_transactions_category_bulk_update(s, large_category_id, middle_category_id, ids[i:i + n])
         if r.status_code != requests.codes.ok:
             logger.warning("%s %s", r.status_code, r.text)
 
+
+def request_transactions_category_bulk_update(s, large_category_id, middle_category_id, ids):
+    """複数取引のカテゴリを1回のリクエストで更新
+    
+    分割やIDのフィルタリングは行わない（呼び出し側でバッチに分ける）。
+    
+    Args:
+        s: requests.Session
+        large_category_id: 大カテゴリID
+        middle_category_id: 中カテゴリID
+        ids: 取引IDのリスト
+    
+    Returns:
+        requests.Response: レスポンス
+    """
+    url = 'https://moneyforward.com/sp2/transactions_category_bulk_updates'
+    params = dict(
+      middle_category_id=middle_category_id,
+      large_category_id=large_category_id,
+      ids=list(ids)
+    )
+    return s.put(url, json.dumps(params), headers={'Content-Type': 'application/json'})
+
+# カテゴリ一括更新の並列数、リクエストの最小間隔 (秒)、1リクエストの最大・最小の件数
+CATEGORY_BULK_UPDATE_WORKERS = 4
+CATEGORY_BULK_UPDATE_INTERVAL = 0.2
+CATEGORY_BULK_UPDATE_BATCH_SIZE = 100
+CATEGORY_BULK_UPDATE_MIN_BATCH_SIZE = 10
+
+# バッチを小さくすれば受け付けられる可能性があるステータス（大きすぎるリクエスト）
+CATEGORY_BULK_UPDATE_SPLIT_STATUS = (413, 414)
+
+# 同じバッチを待ってから送り直すステータス、送り直す回数、最初の待ち時間 (秒、送り直すたびに倍)
+CATEGORY_BULK_UPDATE_RETRY_STATUS = (500, 502, 503, 504)
+CATEGORY_BULK_UPDATE_RETRIES = 2
+CATEGORY_BULK_UPDATE_BACKOFF = 1.0
+
+
+class RateLimiter:
+    """スレッド間で共有する、リクエストの最小間隔の制限"""
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_time = 0
+    
+    def wait(self):
+        with self.lock:
+            now = monotonic()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait > 0:
+            sleep(wait)
+
+
+def run_category_bulk_updates(s, groups, workers=CATEGORY_BULK_UPDATE_WORKERS, limiter=None,
+                              batch_size=CATEGORY_BULK_UPDATE_BATCH_SIZE,
+                              min_batch_size=CATEGORY_BULK_UPDATE_MIN_BATCH_SIZE,
+                              retries=CATEGORY_BULK_UPDATE_RETRIES, backoff=CATEGORY_BULK_UPDATE_BACKOFF):
+    """複数カテゴリの一括更新を、全てのバッチをまとめて並列に実行
+    
+    カテゴリごとの id を batch_size 件ずつのバッチに分け、limiter の間隔を
+    守りながら workers 並列で送信する。リクエストが大きすぎるエラー (413, 414) の
+    場合はバッチを半分に分けて送り直し、以降のバッチもそのサイズで送る
+    （min_batch_size 件以下のバッチは分けずに失敗とする）。サーバーエラー (5xx) は
+    同じバッチを backoff 秒から倍々に待って retries 回まで送り直す。それ以外の
+    エラー（400, 422 などの検証エラー）はバッチの失敗とする。負のIDは除外する。
+    
+    Args:
+        s: requests.Session
+        groups: (large_category_id, middle_category_id) → 取引IDのリスト
+        workers: 並列数
+        limiter: 共有する RateLimiter (省略時は CATEGORY_BULK_UPDATE_INTERVAL)
+        batch_size: 1リクエストの最大件数
+        min_batch_size: 分割する最小の件数
+        retries: サーバーエラーの時に送り直す回数
+        backoff: 最初に送り直すまでの待ち時間 (秒)
+    
+    Returns:
+        list: 送信したバッチごとの結果 (dict)
+            large_category_id, middle_category_id, ids, status_code (通信エラーは None), ok, error
+    """
+    limiter = limiter or RateLimiter(CATEGORY_BULK_UPDATE_INTERVAL)
+    size = batch_size  # サーバーが受け付けるバッチサイズ（失敗するたびに縮める）
+    size_lock = threading.Lock()
+    
+    def send(large_category_id, middle_category_id, ids):
+        nonlocal size
+        if len(ids) > size:
+            return None  # 待っている間にバッチサイズが縮んだので分け直す
+        for attempt in range(retries + 1):
+            if attempt:
+                logger.info("bulk update: %s, retry %d/%d", r.status_code, attempt, retries)
+                sleep(backoff * 2 ** (attempt - 1))
+            limiter.wait()
+            try:
+                r = request_transactions_category_bulk_update(s, large_category_id, middle_category_id, ids)
+            except requests.RequestException as e:
+                return None, str(e)
+            if r.status_code not in CATEGORY_BULK_UPDATE_RETRY_STATUS:
+                break
+        if r.status_code in CATEGORY_BULK_UPDATE_SPLIT_STATUS and len(ids) > min_batch_size:
+            with size_lock:
+                size = max(min_batch_size, min(size, (len(ids) + 1) // 2))
+        return r.status_code, None if r.status_code == requests.codes.ok else r.text
+    
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        
+        def submit(large_category_id, middle_category_id, ids):
+            n = size
+            for i in range(0, len(ids), n):
+                batch = ids[i:i + n]
+                futures[executor.submit(send, large_category_id, middle_category_id, batch)] = \
+                    (large_category_id, middle_category_id, batch)
+        
+        for (large_category_id, middle_category_id), ids in groups.items():
+            submit(large_category_id, middle_category_id, [id for id in ids if id > 0])
+        
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                large_category_id, middle_category_id, ids = futures.pop(future)
+                if future.result() is None:
+                    submit(large_category_id, middle_category_id, ids)
+                    continue
+                status_code, error = future.result()
+                if status_code in CATEGORY_BULK_UPDATE_SPLIT_STATUS and len(ids) > min_batch_size:
+                    logger.info("bulk update: %s, retry with batch size %d", status_code, size)
+                    submit(large_category_id, middle_category_id, ids)
+                    continue
+                results.append(dict(large_category_id=large_category_id, middle_category_id=middle_category_id,
+                                    ids=ids, status_code=status_code, ok=status_code == requests.codes.ok,
+                                    error=error))
+    return results
+
+
 @contextmanager
 def session_from_cookie_file(cookie_file='mf_cookies.pkl'):
     """クッキーファイルから認証済みセッションを作成
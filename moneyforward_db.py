@@ -0,0 +1,828 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+MoneyForward ローカルミラー (SQLite) ストレージモジュール
+
+cf_term_data などで取得した取引データを SQLite に保存する。
+pandas の内部 API には依存せず、INSERT ... ON CONFLICT DO UPDATE で
+内容が変わった行だけを書き込む。
+このモジュールの関数は args に依存せず、具体的な引数のみを受け取ります。
+"""
+
+import re
+import hashlib
+import sqlite3
+import logging
+from datetime import timedelta
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# executemany 1回あたりの行数
+UPSERT_BATCH_SIZE = 10000
+
+
+def connect(sqlite_file):
+    """
+    SQLite に接続し、WAL モードなどの書き込み向け設定を行う
+
+    Args:
+        sqlite_file (str): SQLite ファイルパス
+
+    Returns:
+        sqlite3.Connection: 接続
+    """
+    con = sqlite3.connect(sqlite_file)
+    con.execute('PRAGMA journal_mode=WAL')
+    con.execute('PRAGMA synchronous=NORMAL')
+    return con
+
+
+def quote(name):
+    """SQLite の識別子をクォートする"""
+    return '"{}"'.format(str(name).replace('"', '""'))
+
+
+def get_columns(con, name):
+    """
+    テーブルの列情報を返す（テーブルが存在しない場合は空の辞書）
+
+    Returns:
+        dict: {列名: (型, 主キー順位)}
+    """
+    rows = con.execute(f'PRAGMA table_info({quote(name)})').fetchall()
+    return {row[1]: (row[2], row[5]) for row in rows}
+
+
+def get_sqlite_type(series):
+    """pandas の列から SQLite の列型を推定する（pandas.to_sql と同じ対応）"""
+    if pd.api.types.is_bool_dtype(series) or pd.api.types.is_integer_dtype(series):
+        return 'INTEGER'
+    if pd.api.types.is_float_dtype(series):
+        return 'REAL'
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return 'TIMESTAMP'
+    inferred = pd.api.types.infer_dtype(series, skipna=True)
+    if inferred in ('integer', 'boolean'):
+        return 'INTEGER'
+    if inferred in ('floating', 'mixed-integer-float', 'decimal'):
+        return 'REAL'
+    if inferred in ('datetime', 'datetime64', 'date'):
+        return 'TIMESTAMP'
+    return 'TEXT'
+
+
+def is_strict_table(con, name):
+    """テーブルが STRICT テーブルかどうか"""
+    row = con.execute('SELECT strict FROM pragma_table_list WHERE name = ?', [name]).fetchone()
+    return bool(row and row[0])
+
+
+def ensure_table(con, name, frame, unique_index_label):
+    """
+    frame の列を保存できるようにテーブルを作成・拡張する
+
+    テーブルが無ければ unique_index_label を主キーとして作成する。
+    既存テーブルに無い列は ALTER TABLE で追加し、主キーが無い場合は
+    ON CONFLICT で使う一意インデックスを作成する。
+
+    Args:
+        con (sqlite3.Connection): 接続
+        name (str): テーブル名
+        frame (pd.DataFrame): 保存するデータ
+        unique_index_label (str): ユニークインデックス列名
+    """
+    columns = get_columns(con, name)
+    if not columns:
+        column_defs = ', '.join(f'{quote(c)} {get_sqlite_type(frame[c])}' for c in frame.columns)
+        con.execute(f'CREATE TABLE IF NOT EXISTS {quote(name)} ({column_defs}, '
+                    f'CONSTRAINT {quote(name + "_pk")} PRIMARY KEY ({quote(unique_index_label)}))')
+    else:
+        strict = None
+        for c in frame.columns:
+            if c not in columns:
+                column_type = get_sqlite_type(frame[c])
+                if strict is None:
+                    strict = is_strict_table(con, name)
+                if strict and column_type == 'TIMESTAMP':
+                    # STRICT テーブルには日時型が無い
+                    column_type = 'TEXT'
+                logger.info('add column: %s.%s', name, c)
+                con.execute(f'ALTER TABLE {quote(name)} ADD COLUMN {quote(c)} {column_type}')
+
+        if columns.get(unique_index_label, (None, 0))[1] == 0:
+            con.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS {quote(name + "_" + unique_index_label)} '
+                        f'ON {quote(name)} ({quote(unique_index_label)})')
+
+    ensure_row_hash_table(con, name, unique_index_label)
+    ensure_fts_index(con, name)
+    ensure_monthly_summary(con, name)
+
+
+def row_hash_table_name(name):
+    return f'{name}_row_hash'
+
+
+def ensure_row_hash_table(con, name, unique_index_label):
+    """
+    行ハッシュ表と、それを無効化するトリガーを作成する
+
+    upsert 以外の UPDATE / DELETE でテーブルが変更された場合は、
+    トリガーでハッシュを削除し、次回の upsert で必ず書き込まれるようにする。
+    """
+    hash_table = row_hash_table_name(name)
+    key = quote(unique_index_label)
+    con.execute(f'CREATE TABLE IF NOT EXISTS {quote(hash_table)} '
+                f'(id PRIMARY KEY, row_hash INTEGER NOT NULL) WITHOUT ROWID')
+    for event, ref in (('UPDATE', 'OLD'), ('DELETE', 'OLD')):
+        con.execute(f'CREATE TRIGGER IF NOT EXISTS {quote(hash_table + "_" + event.lower())} '
+                    f'AFTER {event} ON {quote(name)} BEGIN '
+                    f'DELETE FROM {quote(hash_table)} WHERE id = {ref}.{key}; END')
+
+
+def compute_row_hashes(frame):
+    """行ごとの内容ハッシュ（SQLite の INTEGER に収まる符号付き64bit）を返す"""
+    return pd.util.hash_pandas_object(frame, index=False).to_numpy().view('int64')
+
+
+def to_sqlite_rows(frame):
+    """DataFrame を executemany に渡せる Python 値のタプルに変換する"""
+    frame = frame.copy(deep=False)
+    for c in frame.columns:
+        if pd.api.types.is_datetime64_any_dtype(frame[c]):
+            frame[c] = frame[c].map(lambda x: None if pd.isna(x) else x.isoformat(' '))
+    values = frame.astype(object).where(frame.notna(), None)
+    return values.itertuples(index=False, name=None)
+
+
+def batched(iterable, n):
+    batch = []
+    for x in iterable:
+        batch.append(x)
+        if len(batch) >= n:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def upsert(frame, name: str, unique_index_label, con, batch_size=UPSERT_BATCH_SIZE):
+    """
+    DataFrame をテーブルにアップサートする
+
+    前回の書き込みから内容ハッシュが変わった行だけを
+    INSERT ... ON CONFLICT DO UPDATE で書き込む。値が同じ列しかない行は
+    WHERE 句で更新対象から外れるため、ページの書き換えも発生しない。
+    全体を1トランザクションで実行する。
+
+    Args:
+        frame (pd.DataFrame | pd.Series): 保存するデータ
+        name (str): テーブル名
+        unique_index_label (str): ユニークインデックス列名
+        con (sqlite3.Connection): 接続
+        batch_size (int): executemany 1回あたりの行数
+
+    Returns:
+        int: 書き込み対象になった行数
+    """
+    if isinstance(frame, pd.Series):
+        frame = frame.to_frame()
+    elif not isinstance(frame, pd.DataFrame):
+        raise NotImplementedError(
+            "'frame' argument should be either a Series or a DataFrame"
+        )
+
+    frame = frame.drop_duplicates(subset=unique_index_label, keep='last')
+    hashes = compute_row_hashes(frame)
+    hash_table = row_hash_table_name(name)
+    key = quote(unique_index_label)
+
+    with con:
+        ensure_table(con, name, frame, unique_index_label)
+
+        stored = dict(con.execute(f'SELECT id, row_hash FROM {quote(hash_table)}'))
+        ids = frame[unique_index_label].tolist()
+        changed = [stored.get(id_) != h for id_, h in zip(ids, hashes.tolist())]
+        frame = frame[changed]
+        hashes = hashes[changed]
+
+        columns = [quote(c) for c in frame.columns]
+        update_columns = [c for c in columns if c != key]
+        statement = (
+            f'INSERT INTO {quote(name)} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))}) '
+            f'ON CONFLICT({key}) DO UPDATE SET '
+            + ', '.join(f'{c} = excluded.{c}' for c in update_columns)
+            + ' WHERE ' + ' OR '.join(f'{quote(name)}.{c} IS NOT excluded.{c}' for c in update_columns)
+        ) if update_columns else (
+            f'INSERT INTO {quote(name)} ({key}) VALUES (?) ON CONFLICT({key}) DO NOTHING'
+        )
+        for rows in batched(to_sqlite_rows(frame), batch_size):
+            con.executemany(statement, rows)
+
+        # 書き込み後にハッシュを記録する（UPDATE トリガーで消えたものも再登録される）
+        hash_rows = zip(frame[unique_index_label].tolist(), hashes.tolist())
+        for rows in batched(hash_rows, batch_size):
+            con.executemany(f'INSERT INTO {quote(hash_table)} (id, row_hash) VALUES (?, ?) '
+                            f'ON CONFLICT(id) DO UPDATE SET row_hash = excluded.row_hash', rows)
+
+    logger.info('upsert %s: %d rows changed', name, len(frame))
+    return len(frame)
+
+
+def update_rows(con, name: str, records, unique_index_label='id', batch_size=UPSERT_BATCH_SIZE):
+    """
+    既存行の一部の列を更新する
+
+    列の組み合わせごとにまとめて executemany し、全体を1トランザクションで実行する。
+    テーブルに無い列は警告を出して無視する。
+
+    Args:
+        con (sqlite3.Connection): 接続
+        name (str): テーブル名
+        records (iterable[dict]): unique_index_label と更新する列の値を持つ辞書
+        unique_index_label (str): ユニークインデックス列名
+        batch_size (int): executemany 1回あたりの行数
+
+    Returns:
+        int: 更新された行数
+    """
+    existing = get_columns(con, name)
+    groups = {}
+    missing = set()
+    for record in records:
+        columns = tuple(c for c in record if c != unique_index_label and c in existing)
+        missing.update(c for c in record if c != unique_index_label and c not in existing)
+        groups.setdefault(columns, []).append(record)
+    if missing:
+        logger.warning('update %s: unknown columns ignored: %s', name, ', '.join(sorted(missing)))
+
+    count = 0
+    with con:
+        for columns, group in groups.items():
+            if not columns:
+                continue
+            statement = (f'UPDATE {quote(name)} SET '
+                         + ', '.join(f'{quote(c)} = ?' for c in columns)
+                         + f' WHERE {quote(unique_index_label)} = ?')
+            rows = ([r[c] for c in columns] + [r[unique_index_label]] for r in group)
+            for batch in batched(rows, batch_size):
+                count += con.executemany(statement, batch).rowcount
+    return count
+
+
+def bucket_digests(con, name, month_from=None, month_to=None):
+    """
+    ローカルの行を (sub_account_id_hash, 月) ごとにまとめたダイジェストを返す
+
+    ローカルで追加したダミー行 (id <= 0) は含めない。
+    hash は行の id / amount / updated_at から求めた、行の順序に依存しない値。
+
+    Args:
+        con (sqlite3.Connection): 接続
+        name (str): テーブル名
+        month_from (str, optional): 対象開始月 'YYYY-MM'
+        month_to (str, optional): 対象終了月 'YYYY-MM'
+
+    Returns:
+        dict: {(sub_account_id_hash, 'YYYY-MM'): {'count': 件数, 'amount': 金額合計, 'hash': ハッシュ}}
+    """
+    columns = get_columns(con, name)
+    updated_at = '"updated_at"' if 'updated_at' in columns else 'NULL'
+    month = 'substr("recognized_at", 1, 7)'
+    where = ['id > 0']
+    params = []
+    if month_from:
+        where.append(f'{month} >= ?')
+        params.append(month_from)
+    if month_to:
+        where.append(f'{month} <= ?')
+        params.append(month_to)
+    rows = con.execute(f'SELECT "sub_account_id_hash", {month}, id, "amount", {updated_at} '
+                       f'FROM {quote(name)} WHERE {" AND ".join(where)}', params)
+
+    digests = {}
+    for sub_account_id_hash, month, id_, amount, updated in rows:
+        digest = digests.setdefault((sub_account_id_hash, month), {'count': 0, 'amount': 0, 'hash': 0})
+        digest['count'] += 1
+        digest['amount'] += amount or 0
+        row_hash = hashlib.blake2b(f'{id_}\t{amount}\t{updated}'.encode(), digest_size=8).digest()
+        digest['hash'] ^= int.from_bytes(row_hash, 'big')
+    return digests
+
+
+def replace_bucket(con, name, frame, sub_account_id_hash, month, unique_index_label='id', delete=False):
+    """
+    (sub_account_id_hash, 月) のバケットをサーバーから取得し直した frame で更新する
+
+    frame の行は upsert する。バケット（recognized_at の月）内で frame に無い行は
+    サーバーで削除された行の候補として返し、delete=True の場合のみ削除する。
+    frame はバケットの月を含む期間で取得したものを渡すこと（月をまたいで移った行を消さないため）。
+    ローカルで追加したダミー行 (id <= 0) は残す。
+
+    Returns:
+        tuple: (書き込んだ行数, frame に無い行の id のリスト)
+    """
+    changed = 0
+    if len(frame):
+        changed = upsert(frame, name, unique_index_label, con)
+    # 既存テーブルの id が TEXT の場合もあるので文字列で比較する
+    ids = {str(id_) for id_ in frame[unique_index_label].tolist()} if len(frame) else set()
+    with con:
+        local_ids = [row[0] for row in con.execute(
+            f'SELECT {quote(unique_index_label)} FROM {quote(name)} '
+            f'WHERE "sub_account_id_hash" = ? AND substr("recognized_at", 1, 7) = ? AND {quote(unique_index_label)} > 0',
+            [sub_account_id_hash, month])]
+        missing = [id_ for id_ in local_ids if str(id_) not in ids]
+        if delete:
+            con.executemany(f'DELETE FROM {quote(name)} WHERE {quote(unique_index_label)} = ?',
+                            [(id_,) for id_ in missing])
+    return changed, missing
+
+
+# 全文検索インデックス (FTS5) の対象列
+FTS_COLUMNS = ('content', 'memo')
+
+# trigram トークナイザは3文字未満の検索語に使えない
+FTS_MIN_LENGTH = 3
+
+
+def fts_table_name(name):
+    return f'{name}_fts'
+
+
+def ensure_fts_index(con, name, columns=FTS_COLUMNS):
+    """
+    content / memo の全文検索インデックス (FTS5, trigram) を作成する
+
+    テーブルを外部コンテンツとする FTS5 テーブルを作成し、INSERT / UPDATE / DELETE
+    のトリガーで同期する。upsert の ON CONFLICT DO UPDATE もトリガー経由で反映される。
+    対象列が変わった場合は作り直す。FTS5 が使えない SQLite では何もしない。
+
+    Args:
+        con (sqlite3.Connection): 接続
+        name (str): テーブル名
+        columns (tuple): 対象列（テーブルに存在する列のみ使用）
+    """
+    existing = get_columns(con, name)
+    columns = [c for c in columns if c in existing]
+    if not columns:
+        return
+
+    fts = fts_table_name(name)
+    if list(get_columns(con, fts)) == columns:
+        return
+
+    drop_fts_index(con, name)
+    cols = ', '.join(quote(c) for c in columns)
+    new_cols = ', '.join(f'new.{quote(c)}' for c in columns)
+    old_cols = ', '.join(f'old.{quote(c)}' for c in columns)
+    try:
+        con.execute(f'CREATE VIRTUAL TABLE {quote(fts)} USING fts5({cols}, '
+                    f"content={quote(name)}, content_rowid='rowid', tokenize='trigram case_sensitive 1')")
+    except sqlite3.OperationalError as e:
+        logger.warning('FTS5 is not available: %s', e)
+        return
+    con.execute(f'CREATE TRIGGER {quote(fts + "_insert")} AFTER INSERT ON {quote(name)} BEGIN '
+                f'INSERT INTO {quote(fts)} (rowid, {cols}) VALUES (new.rowid, {new_cols}); END')
+    con.execute(f'CREATE TRIGGER {quote(fts + "_delete")} AFTER DELETE ON {quote(name)} BEGIN '
+                f"INSERT INTO {quote(fts)} ({quote(fts)}, rowid, {cols}) VALUES ('delete', old.rowid, {old_cols}); END")
+    con.execute(f'CREATE TRIGGER {quote(fts + "_update")} AFTER UPDATE OF {cols} ON {quote(name)} BEGIN '
+                f"INSERT INTO {quote(fts)} ({quote(fts)}, rowid, {cols}) VALUES ('delete', old.rowid, {old_cols}); "
+                f'INSERT INTO {quote(fts)} (rowid, {cols}) VALUES (new.rowid, {new_cols}); END')
+    con.execute(f"INSERT INTO {quote(fts)} ({quote(fts)}) VALUES ('rebuild')")
+    logger.info('created full-text index: %s (%s)', fts, ', '.join(columns))
+
+
+def drop_fts_index(con, name):
+    """全文検索インデックスと同期トリガーを削除する"""
+    fts = fts_table_name(name)
+    for event in ('insert', 'delete', 'update'):
+        con.execute(f'DROP TRIGGER IF EXISTS {quote(fts + "_" + event)}')
+    con.execute(f'DROP TABLE IF EXISTS {quote(fts)}')
+
+
+def get_fts_columns(con, name):
+    """全文検索インデックスの対象列を返す（インデックスが無い場合は空）"""
+    return set(get_columns(con, fts_table_name(name)))
+
+
+# 月次集計表のキー列と、元テーブルの行から値を求める式（{row} は new / old / テーブル名）
+# NULL は UNIQUE 制約で重複扱いにならないため、空文字や 0 に置き換える
+MONTHLY_SUMMARY_KEYS = {
+    'month': ('recognized_at', "COALESCE(substr({row}.\"recognized_at\", 1, 7), '')"),
+    'large_category': ('large_category', "COALESCE({row}.\"large_category\", '')"),
+    'middle_category': ('middle_category', "COALESCE({row}.\"middle_category\", '')"),
+    'sub_account_id_hash': ('sub_account_id_hash', "COALESCE({row}.\"sub_account_id_hash\", '')"),
+    'service_name': ('service_name', "COALESCE({row}.\"service_name\", '')"),
+    'is_income': ('is_income', "COALESCE({row}.\"is_income\", 0)"),
+    'is_transfer': ('is_transfer', "COALESCE({row}.\"is_transfer\", 0)"),
+}
+
+
+def monthly_summary_table_name(name):
+    return f'{name}_monthly'
+
+
+def monthly_summary_expressions(columns, row):
+    """月次集計表のキー列と金額について、元テーブルの行から値を求める式を返す"""
+    expressions = {key: expr.format(row=row) if column in columns else "''"
+                   for key, (column, expr) in MONTHLY_SUMMARY_KEYS.items()}
+    expressions['amount'] = f'COALESCE({row}."amount", 0)' if 'amount' in columns else '0'
+    # ダミーデータ (id <= 0) は集計しない（一覧や API の集計と合わせる）
+    expressions['filter'] = f'{row}."id" > 0' if 'id' in columns else '1'
+    return expressions
+
+
+def ensure_monthly_summary(con, name):
+    """
+    月次集計表 (month, large_category, middle_category, sub_account ごとの合計) を作成する
+
+    元テーブルの INSERT / UPDATE / DELETE のトリガーで差分を加減するため、
+    upsert や update_rows と同じトランザクションで常に最新に保たれる。
+    トリガーが無い場合（新規作成時やテーブルの作り直し後）は全件から集計し直す。
+    recognized_at 列の無いテーブルでは何もしない。
+
+    Args:
+        con (sqlite3.Connection): 接続
+        name (str): テーブル名
+    """
+    columns = get_columns(con, name)
+    if 'recognized_at' not in columns:
+        return
+
+    summary = monthly_summary_table_name(name)
+    source_columns = [c for c in columns if c in ('id', 'amount') or c in dict(MONTHLY_SUMMARY_KEYS.values())]
+    expected = {f'{summary}_{event}' for event in ('insert', 'delete', 'update')}
+    sql = {row[0]: row[1] for row in con.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = ?", [name])}
+    # 対象列が増えた場合や、ダミーデータを除外しない古いトリガーも作り直す
+    if (expected <= set(sql) and all(quote(c) in sql[f'{summary}_update'] for c in source_columns)
+            and monthly_summary_expressions(columns, 'new')['filter'] in sql[f'{summary}_insert']):
+        return
+
+    keys = list(MONTHLY_SUMMARY_KEYS)
+    key_cols = ', '.join(quote(k) for k in keys)
+    drop_monthly_summary(con, name)
+    con.execute(f'CREATE TABLE {quote(summary)} ('
+                + ', '.join(f'{quote(k)} NOT NULL' for k in keys)
+                + f', amount_sum NOT NULL DEFAULT 0, act_count INTEGER NOT NULL DEFAULT 0, '
+                f'PRIMARY KEY ({key_cols})) WITHOUT ROWID')
+
+    def apply(row, sign):
+        e = monthly_summary_expressions(columns, row)
+        values = ', '.join(e[k] for k in keys)
+        return (f'INSERT INTO {quote(summary)} ({key_cols}, amount_sum, act_count) '
+                f'SELECT {values}, {sign}{e["amount"]}, {sign}1 WHERE {e["filter"]} '
+                f'ON CONFLICT({key_cols}) DO UPDATE SET amount_sum = amount_sum + excluded.amount_sum, '
+                f'act_count = act_count + excluded.act_count; ')
+
+    cleanup = f'DELETE FROM {quote(summary)} WHERE act_count = 0; '
+    watched = ', '.join(quote(c) for c in source_columns)
+    con.execute(f'CREATE TRIGGER {quote(summary + "_insert")} AFTER INSERT ON {quote(name)} BEGIN '
+                + apply('new', '') + 'END')
+    con.execute(f'CREATE TRIGGER {quote(summary + "_delete")} AFTER DELETE ON {quote(name)} BEGIN '
+                + apply('old', '-') + cleanup + 'END')
+    con.execute(f'CREATE TRIGGER {quote(summary + "_update")} AFTER UPDATE OF {watched} ON {quote(name)} BEGIN '
+                + apply('old', '-') + apply('new', '') + cleanup + 'END')
+
+    e = monthly_summary_expressions(columns, quote(name))
+    con.execute(f'INSERT INTO {quote(summary)} ({key_cols}, amount_sum, act_count) '
+                f'SELECT {", ".join(e[k] for k in keys)}, SUM({e["amount"]}), COUNT(*) '
+                f'FROM {quote(name)} WHERE {e["filter"]} GROUP BY {", ".join(e[k] for k in keys)}')
+    con.execute(f'CREATE INDEX IF NOT EXISTS {quote(name + "_recognized_at")} ON {quote(name)} ("recognized_at")')
+    logger.info('created monthly summary: %s', summary)
+
+
+def drop_monthly_summary(con, name):
+    """月次集計表と同期トリガーを削除する"""
+    summary = monthly_summary_table_name(name)
+    for event in ('insert', 'delete', 'update'):
+        con.execute(f'DROP TRIGGER IF EXISTS {quote(summary + "_" + event)}')
+    con.execute(f'DROP TABLE IF EXISTS {quote(summary)}')
+
+
+def full_month_range(date_from, date_to):
+    """
+    date_from〜date_to に丸ごと含まれる月の範囲を返す
+
+    Returns:
+        tuple: ('YYYY-MM', 'YYYY-MM')。丸ごと含まれる月が無い場合は None
+    """
+    first = date_from if date_from.day == 1 else (date_from.replace(day=1) + timedelta(days=32)).replace(day=1)
+    next_day = date_to + timedelta(days=1)
+    last = date_to if next_day.day == 1 else date_to.replace(day=1) - timedelta(days=1)
+    if first > last:
+        return None
+    return first.strftime('%Y-%m'), last.strftime('%Y-%m')
+
+
+def summarize_monthly(con, name, date_from, date_to, group_by=('month',), is_income=None, exclude_transfers=True):
+    """
+    月次集計表から date_from〜date_to の合計をグループ別に求める
+
+    丸ごと含まれる月は月次集計表から、前後の端数の月だけ元テーブルから集計する。
+
+    Args:
+        con (sqlite3.Connection): 接続
+        name (str): テーブル名
+        date_from (date): 集計開始日
+        date_to (date): 集計終了日
+        group_by (tuple): MONTHLY_SUMMARY_KEYS のキー列
+        is_income (bool, optional): True=収入のみ, False=支出のみ, None=両方
+        exclude_transfers (bool): True=振替取引を除外
+
+    Returns:
+        list[tuple]: (group_by の値..., 合計金額, 件数)
+    """
+    for key in group_by:
+        if key not in MONTHLY_SUMMARY_KEYS:
+            raise ValueError(f'Unknown group_by: {key}')
+    ensure_monthly_summary(con, name)
+    summary = monthly_summary_table_name(name)
+    e = monthly_summary_expressions(get_columns(con, name), quote(name))
+
+    def conditions(expr):
+        where = []
+        if is_income is not None:
+            where.append(f'{expr["is_income"]} = {int(bool(is_income))}')
+        if exclude_transfers:
+            where.append(f'{expr["is_transfer"]} = 0')
+        return ''.join(f' AND {w}' for w in where)
+
+    # 丸ごと含まれる月が無い場合は、元テーブルだけから集計する
+    months = full_month_range(date_from, date_to)
+    summary_expr = {k: quote(k) for k in MONTHLY_SUMMARY_KEYS}
+    keys = ', '.join(quote(k) for k in group_by)
+    day = f'substr({quote(name)}."recognized_at", 1, 10)'
+    selects = []
+    params = []
+    if months:
+        selects.append(
+            f'SELECT {", ".join(summary_expr[k] + " AS " + quote(k) for k in group_by)}, amount_sum AS amount, act_count AS cnt '
+            f'FROM {quote(summary)} WHERE month BETWEEN ? AND ?{conditions(summary_expr)}')
+        params.extend(months)
+    selects.append(
+        f'SELECT {", ".join(e[k] + " AS " + quote(k) for k in group_by)}, {e["amount"]} AS amount, 1 AS cnt '
+        f'FROM {quote(name)} WHERE {e["filter"]} AND {day} BETWEEN ? AND ?'
+        + (f' AND {e["month"]} NOT BETWEEN ? AND ?' if months else '') + conditions(e))
+    params.extend([date_from.isoformat(), date_to.isoformat(), *(months or ())])
+    sql = f'SELECT {keys}, SUM(amount), SUM(cnt) FROM ({" UNION ALL ".join(selects)}) GROUP BY {keys} ORDER BY SUM(amount)'
+    return con.execute(sql, params).fetchall()
+
+
+# filter_db で絞り込みに使う列（存在する列にのみインデックスを作成する）
+FILTER_INDEX_COLUMNS = (
+    'date', 'amount', 'large_category', 'middle_category', 'service_name', 'sub_type',
+    'is_transfer', 'is_income',
+)
+
+_REGEX_SPECIAL_CHARS = set('\\.^$*+?{}[]|()')
+
+
+def is_literal_pattern(pattern):
+    """正規表現の特殊文字を含まない（部分文字列検索で代用できる）パターンかどうか"""
+    return not (set(pattern) & _REGEX_SPECIAL_CHARS)
+
+
+def combine_patterns(patterns):
+    """
+    複数の正規表現を、いずれかに一致する1つのパターンにまとめる
+
+    キャプチャグループを含むパターン（後方参照の番号がずれる）はまとめず、
+    まとめるとコンパイルできない場合（先頭以外のインラインフラグなど）は全て別にする。
+
+    Returns:
+        tuple: (まとめたパターン または None, 別に評価するパターンのリスト)
+    """
+    combinable, separate = [], []
+    for p in dict.fromkeys(patterns):
+        (separate if re.compile(p).groups else combinable).append(p)
+    if len(combinable) < 2:
+        return (combinable[0] if combinable else None), separate
+    combined = '|'.join(f'(?:{p})' for p in combinable)
+    try:
+        re.compile(combined)
+    except re.error:
+        return None, combinable + separate
+    return combined, separate
+
+
+class PatternMatcher:
+    """
+    いずれかのパターンに re.search で一致するかを判定する
+
+    パターンは combine_patterns で1つの正規表現にまとめ、判定結果は値ごとにキャッシュする。
+    文字列以外（None / NaN）は一致しない（str.contains(..., na=False) と同じ）。
+    """
+
+    def __init__(self, patterns):
+        combined, separate = combine_patterns(patterns)
+        self.regexes = [re.compile(p) for p in ([combined] if combined else []) + separate]
+        self._cache = {}
+
+    def __call__(self, value):
+        try:
+            return self._cache[value]
+        except KeyError:
+            matched = self._cache[value] = isinstance(value, str) and any(r.search(value) for r in self.regexes)
+            return matched
+
+    def flags(self, series, na=False):
+        """
+        Series の各値の判定結果を bool の配列で返す
+
+        pd.factorize で値をコードに変換し、異なる値ごとに1度だけ判定した表を引く。
+        文字列以外（None / NaN など）の値は na とする。
+        """
+        codes, uniques = pd.factorize(series)
+        matched = np.fromiter((self(v) if isinstance(v, str) else na for v in uniques), dtype=bool, count=len(uniques))
+        return np.append(matched, na)[codes]
+
+
+@lru_cache(maxsize=32)
+def get_pattern_matcher(patterns):
+    """パターンのタプルごとに PatternMatcher を共有する（chunk をまたいで判定結果を再利用する）"""
+    return PatternMatcher(patterns)
+
+
+def ensure_filter_indexes(con, name, columns=FILTER_INDEX_COLUMNS):
+    """filter_db の絞り込みに使う列にインデックスを作成する"""
+    existing = get_columns(con, name)
+    with con:
+        for c in columns:
+            if c in existing:
+                con.execute(f'CREATE INDEX IF NOT EXISTS {quote(name + "_" + c)} ON {quote(name)} ({quote(c)})')
+        ensure_fts_index(con, name)
+
+
+def register_regexp(con):
+    """REGEXP 演算子を登録する（pandas の str.contains と同じく re.search で判定）"""
+    cache = {}
+
+    def regexp(pattern, value):
+        if value is None:
+            return None
+        key = (pattern, value)
+        if key not in cache:
+            if pattern not in cache:
+                cache[pattern] = re.compile(pattern)
+            cache[key] = cache[pattern].search(str(value)) is not None
+        return cache[key]
+
+    con.create_function('regexp', 2, regexp, deterministic=True)
+
+
+def contains_clause(column, pattern, fts_table=None, regex=True):
+    """
+    部分一致（正規表現）の条件式を返す。一致しない/NULL は NULL または 0
+
+    正規表現の特殊文字を含まないパターンは部分文字列検索とし、fts_table が
+    指定されていれば全文検索インデックスを使う。
+
+    Args:
+        column (str): 列名
+        pattern (str): 検索パターン
+        fts_table (str, optional): column を含む全文検索インデックス
+        regex (bool): False の場合、pattern を常に文字列として扱う
+    """
+    if regex and not is_literal_pattern(pattern):
+        return f'{quote(column)} REGEXP ?', [pattern]
+    if fts_table and len(pattern) >= FTS_MIN_LENGTH:
+        phrase = '"{}"'.format(pattern.replace('"', '""'))
+        return (f'rowid IN (SELECT rowid FROM {quote(fts_table)} WHERE {quote(fts_table)} MATCH ?)',
+                [f'{quote(column)} : {phrase}'])
+    return f'instr({quote(column)}, ?) > 0', [pattern]
+
+
+def contains_any_clause(column, patterns, fts_table=None):
+    """
+    いずれかのパターンに部分一致（正規表現）する条件式を返す。一致しない/NULL は NULL または 0
+
+    文字列として検索できるパターンは contains_clause で個別に、正規表現のパターンは
+    combine_patterns で1つの REGEXP にまとめる。
+    """
+    literals = [p for p in dict.fromkeys(patterns) if is_literal_pattern(p)]
+    combined, separate = combine_patterns(p for p in patterns if not is_literal_pattern(p))
+    clauses = [contains_clause(column, p, fts_table) for p in literals]
+    clauses += [(f'{quote(column)} REGEXP ?', [p]) for p in ([combined] if combined else []) + separate]
+    if not clauses:
+        return '0', []
+    return ' OR '.join(c for c, _ in clauses), [x for _, ps in clauses for x in ps]
+
+
+def match_values_clause(con, name, column, match_values=None, not_match_values=None, is_null=False, is_not_null=False, distinct=True, fts_table=None):
+    """
+    update_filter_flags と同じ判定を SQL の条件式にする
+
+    カテゴリ名などの列は値の種類が少ないため、DISTINCT 値に対してパターンを
+    評価し、IN (...) に変換してインデックスを使えるようにする。
+    memo のように値の種類が多い列は distinct=False で行ごとに判定する
+    （fts_table が指定されていれば全文検索インデックスを使う）。
+
+    Returns:
+        tuple: (条件式, パラメータ)。条件が無い場合は (None, [])
+    """
+    if is_null:
+        return f'{quote(column)} IS NULL', []
+    if is_not_null:
+        return f'{quote(column)} IS NOT NULL', []
+    if not (match_values or not_match_values):
+        return None, []
+
+    if not distinct:
+        clause, params = contains_any_clause(column, match_values or not_match_values, fts_table)
+        if match_values:
+            return clause, params
+        return f'{quote(column)} IS NOT NULL AND NOT COALESCE(({clause}), 0)', params
+
+    matcher = get_pattern_matcher(tuple(match_values or not_match_values))
+    values = [row[0] for row in con.execute(f'SELECT DISTINCT {quote(column)} FROM {quote(name)} '
+                                            f'WHERE {quote(column)} IS NOT NULL')]
+    matched = [v for v in values if matcher(str(v))]
+    placeholders = ', '.join('?' * len(matched))
+    if match_values:
+        if not matched:
+            return '0', []
+        return f'{quote(column)} IN ({placeholders})', matched
+    if not matched:
+        return f'{quote(column)} IS NOT NULL', []
+    return f'{quote(column)} IS NOT NULL AND {quote(column)} NOT IN ({placeholders})', matched
+
+
+def plan_filter_query(con, name, columns=None,
+        patterns=None, exclude_patterns=None, match_columns=(),
+        date_from=None, date_to=None, ignore_invalid_data=False,
+        is_income=None, is_transfer=None, lt=None, le=None, gt=None, ge=None,
+        reverse=False):
+    """
+    filter_db の絞り込み条件を、パラメータ付きの SELECT 文に変換する
+
+    Args:
+        con (sqlite3.Connection): 接続（REGEXP を登録する）
+        name (str): テーブル名
+        columns (list, optional): 取得する列（None の場合は全列）
+        patterns (list, optional): content の部分一致パターン（いずれかに一致）
+        exclude_patterns (list, optional): content の除外パターン
+        match_columns (iterable): update_filter_flags と同じ引数のタプル
+            (column_name, match_values, not_match_values, is_null, is_not_null) のリスト
+        date_from, date_to (datetime, optional): date 列（%y/%m/%d）の範囲
+        ignore_invalid_data (bool): id > 0 のみ
+        is_income, is_transfer (int, optional): フラグの一致
+        lt, le, gt, ge (int, optional): amount の範囲
+        reverse (bool): 条件全体を反転する
+
+    Returns:
+        tuple: (SQL, パラメータのリスト)
+    """
+    register_regexp(con)
+    fts_columns = get_fts_columns(con, name)
+    conditions = []
+    params = []
+
+    def fts_table(column):
+        return fts_table_name(name) if column in fts_columns else None
+
+    def add(clause, clause_params=()):
+        if clause is not None:
+            # 反転しても NULL にならないよう、各条件は 0/1 に正規化する
+            conditions.append(f'COALESCE(({clause}), 0)')
+            params.extend(clause_params)
+
+    if patterns is not None:
+        add(*contains_any_clause('content', patterns, fts_table('content')))
+
+    if exclude_patterns:
+        clause, clause_params = contains_any_clause('content', exclude_patterns, fts_table('content'))
+        add(f'NOT COALESCE(({clause}), 0)', clause_params)
+
+    for args in match_columns:
+        add(*match_values_clause(con, name, *args, fts_table=fts_table(args[0])))
+
+    if date_from:
+        add(f'{quote("date")} >= ?', [date_from.strftime('%y/%m/%d')])
+    if date_to:
+        add(f'{quote("date")} <= ?', [date_to.strftime('%y/%m/%d')])
+
+    if ignore_invalid_data:
+        add(f'CAST({quote("id")} AS INTEGER) > 0')
+
+    if is_income is not None:
+        add(f'{quote("is_income")} = ?', [is_income])
+    if is_transfer is not None:
+        add(f'{quote("is_transfer")} = ?', [is_transfer])
+
+    for op, value in (('<', lt), ('<=', le), ('>', gt), ('>=', ge)):
+        if value is not None:
+            add(f'{quote("amount")} {op} ?', [value])
+
+    select = ', '.join(quote(c) for c in columns) if columns else '*'
+    sql = f'SELECT {select} FROM {quote(name)}'
+    where = ' AND '.join(conditions) or '1'
+    if reverse:
+        where = f'NOT ({where})'
+    if conditions or reverse:
+        sql += f' WHERE {where}'
+    return sql, params
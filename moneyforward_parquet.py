@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+MoneyForward 分析用 Parquet データセットモジュール
+
+取引データを recognized_at の年・月でパーティション分割した Parquet に保存し、
+DuckDB で SQL を実行する。pyarrow / duckdb は任意の依存で、使う時にだけ import する。
+このモジュールの関数は args に依存せず、具体的な引数のみを受け取ります。
+"""
+
+import os
+import logging
+from glob import glob
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# パーティション列 (hive 形式: recognized_year=2024/recognized_month=01)
+PARTITION_COLUMNS = ('recognized_year', 'recognized_month')
+
+PARQUET_FILE_NAME = 'part-0.parquet'
+
+# DuckDB でデータセットを参照するビュー名
+PARQUET_VIEW_NAME = 'user_asset_act'
+
+
+def import_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError('pyarrow is required for the parquet dataset (uv sync --extra parquet)') from e
+    return pa, pq
+
+
+def import_duckdb():
+    try:
+        import duckdb
+    except ImportError as e:
+        raise ImportError('duckdb is required for the sql command (uv sync --extra parquet)') from e
+    return duckdb
+
+
+def partition_dir(root, year, month):
+    return os.path.join(root, f'{PARTITION_COLUMNS[0]}={year}', f'{PARTITION_COLUMNS[1]}={month}')
+
+
+def list_partitions(root):
+    """データセット内の (year, month, ファイルパス) を返す"""
+    pattern = os.path.join(root, f'{PARTITION_COLUMNS[0]}=*', f'{PARTITION_COLUMNS[1]}=*', PARQUET_FILE_NAME)
+    partitions = []
+    for path in sorted(glob(pattern)):
+        month_dir = os.path.dirname(path)
+        year = os.path.basename(os.path.dirname(month_dir)).split('=', 1)[1]
+        month = os.path.basename(month_dir).split('=', 1)[1]
+        partitions.append((year, month, path))
+    return partitions
+
+
+def write_partition(frame, path):
+    """
+    1パーティション分の行を Parquet に書き込む
+
+    文字列列は辞書エンコードし、一時ファイルに書いてから置き換える。
+    """
+    pa, pq = import_pyarrow()
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    dictionary_columns = [f.name for f in table.schema if pa.types.is_string(f.type) or pa.types.is_large_string(f.type)]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    pq.write_table(table, tmp, use_dictionary=dictionary_columns, compression='zstd')
+    os.replace(tmp, path)
+
+
+def upsert_parquet(frame, root, unique_index_label='id'):
+    """
+    DataFrame を recognized_at の年・月で分割した Parquet データセットにアップサートする
+
+    書き込むパーティションは既存の行と結合して unique_index_label で重複を除く
+    （同じ id は新しい行を残す）。月が変わった取引は、元のパーティションから削除する。
+    既存の id を読むのは frame に含まれる年・月のパーティションだけなので、元の月が
+    frame に含まれない取引（取得期間の外から移ってきた取引）は元のパーティションに残る。
+    同じデータを何度書き込んでも結果は変わらない。
+
+    Args:
+        frame (pd.DataFrame): 保存するデータ（recognized_at 列が必要）
+        root (str): データセットのディレクトリ
+        unique_index_label (str): ユニークインデックス列名
+
+    Returns:
+        int: 書き込んだパーティション数
+    """
+    _, pq = import_pyarrow()
+    frame = frame.drop_duplicates(subset=unique_index_label, keep='last')
+    recognized_at = pd.to_datetime(frame['recognized_at'].str[:10], format='%Y-%m-%d')
+    years = recognized_at.dt.strftime('%Y')
+    months = recognized_at.dt.strftime('%m')
+
+    # 今回書き込むパーティションだけを読み、別のパーティションへ移る id はそこから削除する
+    new_partition = dict(zip(frame[unique_index_label].astype(str), zip(years, months)))
+
+    written = 0
+    for (year, month), group in frame.groupby([years, months], sort=True):
+        path = os.path.join(partition_dir(root, year, month), PARQUET_FILE_NAME)
+        if os.path.exists(path):
+            existing = pq.read_table(path).to_pandas()
+            existing_ids = existing[unique_index_label].astype(str)
+            existing = existing[~existing_ids.isin(new_partition)]
+            group = pd.concat([existing, group], ignore_index=True)
+        write_partition(group, path)
+        written += 1
+
+    logger.info('upsert parquet %s: %d rows, %d partitions written', root, len(frame), written)
+    return written
+
+
+def query_parquet(root, sql):
+    """
+    Parquet データセットに対して DuckDB で SQL を実行する
+
+    データセットは user_asset_act ビューとして参照できる
+    （recognized_year / recognized_month 列でパーティションを絞り込める）。
+
+    Args:
+        root (str): データセットのディレクトリ
+        sql (str): 実行する SQL
+
+    Returns:
+        pd.DataFrame: 結果
+    """
+    duckdb = import_duckdb()
+    pattern = os.path.join(root, '*', '*', PARQUET_FILE_NAME).replace("'", "''")
+    with duckdb.connect() as con:
+        con.execute(f"CREATE VIEW {PARQUET_VIEW_NAME} AS SELECT * FROM read_parquet('{pattern}', "
+                    f"hive_partitioning = true, union_by_name = true)")
+        return con.execute(sql).df()
@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+MoneyForward 変更キューモジュール
+
+取引の変更（カテゴリ・メモ・計算対象・振替）を送信する前に SQLite のキューへ記録し、
+キューから API に送る。送信中に落ちた変更はキューに残り、drain_mutations
+（`moneyforward.py mutation_queue --drain`）で再送される。
+apply_mutations は自分が記録した変更だけを送り、他の変更は巻き込まない。送れなかった変更は
+呼び出し元に失敗として返し、failed にする（後から黙って再送しない）。送り直す時は
+retry_failed_mutations（`moneyforward.py mutation_queue --retry_failed --drain`）を使う。
+送る変更は pending から running にしてから送る（claim_mutations）ので、複数のプロセスや
+スレッドが同じキューから送っても、同じ変更を二重に送らない。
+
+変更は全て「値を設定する」操作なので、同じ変更を何度送っても結果は変わらない。
+同じ取引・同じ種類の変更は最新の1件だけを送り、カテゴリの変更は変更先ごとに一括更新で送る。
+このモジュールの関数は args に依存せず、具体的な引数のみを受け取ります。
+"""
+
+import json
+import logging
+from collections import defaultdict
+from contextlib import closing
+from datetime import datetime, timedelta
+
+import requests
+
+from moneyforward_api import (run_category_bulk_updates, get_csrf_token, request_update_user_asset_act,
+                              request_update_change_type, request_change_transfer, request_clear_transfer)
+from moneyforward_db import connect
+
+logger = logging.getLogger(__name__)
+
+MUTATION_QUEUE_DB = 'mutation_queue.db'
+MUTATION_QUEUE_TABLE = 'mutation_queue'
+
+# 失敗した変更を再送する回数（超えたら failed にして送らない）
+MUTATION_MAX_ATTEMPTS = 5
+
+# 変更の種類と値
+#   category: [large_category_id, middle_category_id]
+#   memo: メモ
+#   is_target: 計算対象 (0 / 1)
+#   is_transfer: 振替の有効化 (1) / 無効化 (0)
+#   transfer: {partner_account_id_hash, partner_sub_account_id_hash, partner_act_id}、None は振替先の解除
+MUTATION_FIELDS = ('category', 'memo', 'is_target', 'is_transfer', 'transfer')
+
+# 状態: pending（未送信・再送待ち）, running（送信中）, done（送信済み）, failed（再送をあきらめた）,
+#       superseded（新しい変更で不要になった）
+MUTATION_STATES = ('pending', 'running', 'done', 'failed', 'superseded')
+
+# running のまま残った変更（送信中に落ちたもの）を pending に戻すまでの時間（秒）
+MUTATION_RUNNING_TIMEOUT = 10 * 60
+
+
+def connect_queue(queue_file=MUTATION_QUEUE_DB):
+    """キューに接続する（テーブルが無ければ作る）"""
+    con = connect(queue_file)
+    con.execute('PRAGMA synchronous=FULL')
+    with con:
+        con.execute(f'''CREATE TABLE IF NOT EXISTS {MUTATION_QUEUE_TABLE} (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            id INTEGER NOT NULL,
+            field TEXT NOT NULL,
+            value TEXT,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT
+        )''')
+        con.execute(f'CREATE INDEX IF NOT EXISTS {MUTATION_QUEUE_TABLE}_pending '
+                    f'ON {MUTATION_QUEUE_TABLE} (state, id, field)')
+    return con
+
+
+def enqueue_mutations(con, mutations):
+    """
+    変更をキューに記録する（1トランザクション）
+
+    同じ取引・同じ種類の未送信の変更は superseded にする。
+
+    Args:
+        con (sqlite3.Connection): connect_queue の接続
+        mutations (iterable): (取引ID, 種類, 値) のタプル
+
+    Returns:
+        list: 記録した変更の seq
+    """
+    now = datetime.now().isoformat(timespec='seconds')
+    seqs = []
+    with con:
+        for id_, field, value in mutations:
+            if field not in MUTATION_FIELDS:
+                raise ValueError(f"invalid mutation field: {field}")
+            con.execute(f"UPDATE {MUTATION_QUEUE_TABLE} SET state = 'superseded', updated_at = ? "
+                        f"WHERE id = ? AND field = ? AND state = 'pending'", (now, int(id_), field))
+            cur = con.execute(f'INSERT INTO {MUTATION_QUEUE_TABLE} (id, field, value, created_at) VALUES (?, ?, ?, ?)',
+                              (int(id_), field, json.dumps(value, ensure_ascii=False), now))
+            seqs.append(cur.lastrowid)
+    return seqs
+
+
+def select_pending(con, seqs=None):
+    """
+    pending の変更を読み、同じ取引・同じ種類の変更を最新の1件にまとめる（書き込みはしない）
+
+    Args:
+        con (sqlite3.Connection): connect_queue の接続
+        seqs (iterable, optional): 対象の seq（省略時は全て）
+
+    Returns:
+        tuple: (変更 (dict: seq, id, field, value, attempts) の seq 順のリスト, まとめられた古い変更の seq)
+    """
+    sql = f"SELECT seq, id, field, value, attempts FROM {MUTATION_QUEUE_TABLE} WHERE state = 'pending'"
+    params = []
+    if seqs is not None:
+        params = list(seqs)
+        sql += f" AND seq IN ({', '.join('?' * len(params))})"
+    latest = {}
+    superseded = []
+    for seq, id_, field, value, attempts in con.execute(sql + ' ORDER BY seq', params):
+        key = (id_, field)
+        if key in latest:
+            superseded.append(latest[key]['seq'])
+        latest[key] = dict(seq=seq, id=id_, field=field, value=json.loads(value), attempts=attempts)
+    return sorted(latest.values(), key=lambda m: m['seq']), superseded
+
+
+def pending_mutations(con):
+    """
+    送信する変更を返す（同じ取引・同じ種類の変更は最新の1件にまとめ、古い方は superseded にする）
+
+    Returns:
+        list: 変更 (dict: seq, id, field, value, attempts) の seq 順のリスト
+    """
+    mutations, superseded = select_pending(con)
+    if superseded:
+        mark_mutations(con, superseded, 'superseded')
+    return mutations
+
+
+def claim_mutations(con, seqs=None, running_timeout=MUTATION_RUNNING_TIMEOUT):
+    """
+    送信する変更を pending から running にして返す（1つの書き込みトランザクション）
+
+    BEGIN IMMEDIATE で書き込みロックを取ってから読むので、同時に呼ばれても同じ変更を
+    2か所で受け取ることはない。seqs を省略した時は、running_timeout 秒より前から
+    running のまま残っている変更（送信中に落ちたもの）を pending に戻してから受け取る。
+
+    Args:
+        con (sqlite3.Connection): connect_queue の接続
+        seqs (iterable, optional): 対象の seq（省略時は全て）
+        running_timeout (int): running を pending に戻すまでの秒数
+
+    Returns:
+        list: 受け取った変更（pending_mutations を参照）
+    """
+    now = datetime.now()
+    with con:
+        con.execute('BEGIN IMMEDIATE')
+        if seqs is None:
+            stale = (now - timedelta(seconds=running_timeout)).isoformat(timespec='seconds')
+            con.execute(f"UPDATE {MUTATION_QUEUE_TABLE} SET state = 'pending' WHERE state = 'running' AND updated_at < ?",
+                        (stale,))
+        mutations, superseded = select_pending(con, seqs)
+        now = now.isoformat(timespec='seconds')
+        con.executemany(f"UPDATE {MUTATION_QUEUE_TABLE} SET state = 'superseded', updated_at = ? WHERE seq = ?",
+                        [(now, seq) for seq in superseded])
+        con.executemany(f"UPDATE {MUTATION_QUEUE_TABLE} SET state = 'running', updated_at = ? WHERE seq = ?",
+                        [(now, m['seq']) for m in mutations])
+    return mutations
+
+
+def mark_mutations(con, seqs, state, error=None):
+    """変更の状態を記録する（pending・running の変更のみ）"""
+    now = datetime.now().isoformat(timespec='seconds')
+    with con:
+        con.executemany(f"UPDATE {MUTATION_QUEUE_TABLE} SET state = ?, error = ?, updated_at = ? "
+                        f"WHERE seq = ? AND state IN ('pending', 'running')", [(state, error, now, seq) for seq in seqs])
+
+
+def record_failures(con, mutations, max_attempts=MUTATION_MAX_ATTEMPTS):
+    """
+    送信に失敗した変更 (mutation, error) の試行回数を増やして pending に戻す
+    （max_attempts 回目は failed にする）
+    """
+    now = datetime.now().isoformat(timespec='seconds')
+    with con:
+        con.executemany(
+            f"UPDATE {MUTATION_QUEUE_TABLE} SET attempts = attempts + 1, error = ?, updated_at = ?, "
+            f"state = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END WHERE seq = ? AND state = 'running'",
+            [(error, now, max_attempts, m['seq']) for m, error in mutations])
+
+
+def send_mutation(s, csrf_token, mutation):
+    """カテゴリ以外の変更を1件送信し、レスポンスを返す"""
+    id_, field, value = mutation['id'], mutation['field'], mutation['value']
+    if field == 'memo':
+        return request_update_user_asset_act(s, csrf_token(), id_, memo=value)
+    if field == 'is_target':
+        return request_update_user_asset_act(s, csrf_token(), id_, is_target=value)
+    if field == 'is_transfer':
+        return request_update_change_type(s, csrf_token(), id_, 'enable_transfer' if value else 'disable_transfer')
+    if field == 'transfer':
+        if value is None:
+            return request_clear_transfer(s, str(id_))
+        return request_change_transfer(s, str(id_), **value)
+    raise ValueError(f"invalid mutation field: {field}")
+
+
+def drain_mutations(s, con, max_attempts=MUTATION_MAX_ATTEMPTS, seqs=None):
+    """
+    キューの未送信の変更を送信する
+
+    claim_mutations で受け取った変更だけを送る（他で送信中の変更は送らない）。
+    カテゴリの変更は変更先ごとに run_category_bulk_updates でまとめて送り、
+    それ以外は seq 順に1件ずつ送る。結果は送るたびにキューへ記録する。
+
+    Args:
+        s (requests.Session): 認証済みセッション
+        con (sqlite3.Connection): connect_queue の接続
+        max_attempts (int): 失敗した変更を failed にするまでの試行回数
+        seqs (iterable, optional): 送る変更の seq（省略時はキューの未送信の変更を全て）
+
+    Returns:
+        list: 送信した変更ごとの結果 (dict: seq, id, field, value, ok, error)
+    """
+    mutations = claim_mutations(con, seqs)
+    results = []
+
+    def record(batch, ok, error=None):
+        if ok:
+            mark_mutations(con, [m['seq'] for m in batch], 'done')
+        else:
+            record_failures(con, [(m, error) for m in batch], max_attempts)
+        results.extend(dict(m, ok=ok, error=error) for m in batch)
+
+    categories = {}
+    groups = defaultdict(list)
+    for m in mutations:
+        if m['field'] == 'category':
+            large_category_id, middle_category_id = m['value']
+            categories[large_category_id, middle_category_id, m['id']] = m
+            groups[large_category_id, middle_category_id].append(m['id'])
+    if groups:
+        for r in run_category_bulk_updates(s, groups):
+            batch = [categories.pop((r['large_category_id'], r['middle_category_id'], i)) for i in r['ids']]
+            record(batch, r['ok'], None if r['ok'] else f"{r['status_code']} {r['error']}")
+        # 送信されなかった変更（負のIDなど）は再送しない
+        if categories:
+            invalid = list(categories.values())
+            mark_mutations(con, [m['seq'] for m in invalid], 'failed', 'invalid id')
+            results.extend(dict(m, ok=False, error='invalid id') for m in invalid)
+
+    token = []
+
+    def csrf_token():
+        if not token:
+            token.append(get_csrf_token(s))
+        return token[0]
+
+    for m in mutations:
+        if m['field'] == 'category':
+            continue
+        try:
+            r = send_mutation(s, csrf_token, m)
+        except requests.RequestException as e:
+            record([m], False, str(e))
+            continue
+        ok = r.status_code == requests.codes.ok
+        record([m], ok, None if ok else f'{r.status_code} {r.text[:200]}')
+
+    failed = sum(1 for r in results if not r['ok'])
+    logger.info('drain mutations: %d sent, %d failed', len(results), failed)
+    return results
+
+
+def apply_mutations(s, mutations, queue_file=MUTATION_QUEUE_DB):
+    """
+    変更をキューに記録してから送信する
+
+    送るのはここで記録した変更だけ。以前に送れなかった変更は drain_mutations で送る。
+    失敗は呼び出し元に返すので、送れなかった変更は再送待ちに戻さず failed にする
+    （retry_failed_mutations で再送待ちに戻せる）。
+
+    Args:
+        s (requests.Session): 認証済みセッション
+        mutations (iterable): (取引ID, 種類, 値) のタプル
+        queue_file (str): キューの SQLite ファイルパス
+
+    Returns:
+        list: 渡した変更ごとの結果 (dict: id, field, value, ok, error, coalesced)。
+            同じ呼び出しの後の変更にまとめられたものは、その変更の結果を coalesced=True で返す。
+            他の呼び出しの変更で置き換えられて送らなかったものは ok=False
+    """
+    mutations = list(mutations)
+    applied = []
+    with closing(connect_queue(queue_file)) as con:
+        seqs = enqueue_mutations(con, mutations)
+        results = {r['seq']: r for r in drain_mutations(s, con, max_attempts=1, seqs=seqs)}
+        latest = {(int(id_), field): seq for (id_, field, value), seq in zip(mutations, seqs)}
+        for (id_, field, value), seq in zip(mutations, seqs):
+            result = results.get(seq) or results.get(latest[int(id_), field])
+            if result is not None:
+                ok, error = result['ok'], result['error']
+            else:
+                state, = con.execute(f'SELECT state FROM {MUTATION_QUEUE_TABLE} WHERE seq = ?', (seq,)).fetchone()
+                ok, error = False, state
+            applied.append(dict(id=id_, field=field, value=value, ok=ok, error=error,
+                                coalesced=seq not in results and result is not None))
+    return applied
+
+
+def queue_status(con):
+    """状態ごとの変更の件数を返す"""
+    counts = dict.fromkeys(MUTATION_STATES, 0)
+    counts.update(con.execute(f'SELECT state, COUNT(*) FROM {MUTATION_QUEUE_TABLE} GROUP BY state'))
+    return counts
+
+
+def retry_failed_mutations(con):
+    """failed の変更を pending に戻す（試行回数もリセットする）"""
+    now = datetime.now().isoformat(timespec='seconds')
+    with con:
+        return con.execute(f"UPDATE {MUTATION_QUEUE_TABLE} SET state = 'pending', attempts = 0, updated_at = ? "
+                           f"WHERE state = 'failed'", (now,)).rowcount
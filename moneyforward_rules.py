@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+MoneyForward 自動カテゴリ分けルールモジュール
+
+ルールファイル（JSON または CSV）の条件を取引の DataFrame に対してまとめて評価し、
+上から順に最初に一致したルールのカテゴリを割り当てる。
+このモジュールの関数は args に依存せず、具体的な引数のみを受け取ります。
+
+ルールの項目:
+    category: 変更先の中カテゴリ名（または large_category_id と middle_category_id）
+    patterns / exclude_patterns: content の正規表現（JSON ではリストも可）
+    service_name / sub_type: 口座名・サブ口座種別の正規表現（JSON ではリストも可）
+    lt / le / gt / ge: amount の範囲
+    is_income: 0 または 1
+    name: ルールの名前（表示用、省略時は行番号）
+
+例 (JSON):
+    [
+        {"name": "駐車場", "patterns": "^タイムズ", "lt": 0, "category": "駐車場"},
+        {"patterns": ["ローソン", "セブン"], "exclude_patterns": "ポイント", "category": "コンビニ"}
+    ]
+"""
+
+import json
+import logging
+import operator
+
+import numpy as np
+import pandas as pd
+
+from moneyforward_db import get_pattern_matcher
+
+logger = logging.getLogger(__name__)
+
+RULE_PATTERN_KEYS = ('patterns', 'exclude_patterns', 'service_name', 'sub_type')
+RULE_AMOUNT_OPERATORS = {'lt': operator.lt, 'le': operator.le, 'gt': operator.gt, 'ge': operator.ge}
+RULE_KEYS = ('name', 'category', 'large_category_id', 'middle_category_id', 'is_income',
+             *RULE_PATTERN_KEYS, *RULE_AMOUNT_OPERATORS)
+
+
+def load_rules(rules_file):
+    """
+    ルールファイルを読み込む（拡張子が .csv の場合は CSV、それ以外は JSON）
+
+    Returns:
+        list: ルール (dict) のリスト。空欄の項目は含まない
+
+    Raises:
+        ValueError: 不明な項目がある、または変更先のカテゴリが無い場合
+    """
+    if rules_file.lower().endswith('.csv'):
+        df = pd.read_csv(rules_file, dtype=str, keep_default_na=False)
+        rules = [{k: v for k, v in row.items() if v != ''} for row in df.to_dict('records')]
+    else:
+        with open(rules_file, encoding='utf-8') as f:
+            rules = json.load(f)
+
+    for i, rule in enumerate(rules):
+        unknown = set(rule) - set(RULE_KEYS)
+        if unknown:
+            raise ValueError(f"Unknown rule keys: {sorted(unknown)} (rule {i})")
+        if 'category' not in rule and not ('large_category_id' in rule and 'middle_category_id' in rule):
+            raise ValueError(f"Rule has no category: {rule}")
+        for key in ('large_category_id', 'middle_category_id', 'is_income', *RULE_AMOUNT_OPERATORS):
+            if key in rule:
+                rule[key] = int(rule[key])
+        rule.setdefault('name', str(i))
+    return rules
+
+
+def resolve_rule_categories(rules, index):
+    """
+    ルールの変更先を (large_category_id, middle_category_id) にする
+
+    Args:
+        rules (list): load_rules の結果
+        index (CategoryIndex): カテゴリのインデックス
+
+    Returns:
+        list: ルールごとの (large_category_id, middle_category_id)
+
+    Raises:
+        ValueError: 解決できないカテゴリ名がある場合（全ての名前をまとめて報告する）
+    """
+    targets, errors = [], []
+    for rule in rules:
+        if 'category' not in rule:
+            targets.append((rule['large_category_id'], rule['middle_category_id']))
+            continue
+        try:
+            targets.append(index.resolve(rule['category'], rule.get('is_income')))
+        except ValueError as e:
+            targets.append(None)
+            errors.append(f"{e} (rule {rule['name']})")
+    if errors:
+        raise ValueError('\n'.join(errors))
+    return targets
+
+
+def as_patterns(value):
+    return tuple(value) if isinstance(value, (list, tuple)) else (value,)
+
+
+def rule_flags(df, rule, column_names):
+    """1つのルールに一致する行の bool 配列を返す"""
+    flags = np.ones(len(df), dtype=bool)
+    for key in RULE_PATTERN_KEYS:
+        if key in rule:
+            column = 'content' if key.endswith('patterns') else column_names.get(key, key)
+            matched = get_pattern_matcher(as_patterns(rule[key])).flags(df[column])
+            flags &= ~matched if key == 'exclude_patterns' else matched
+    for key, op in RULE_AMOUNT_OPERATORS.items():
+        if key in rule:
+            flags &= op(df['amount'], rule[key]).to_numpy(dtype=bool, na_value=False)
+    if 'is_income' in rule:
+        flags &= (df['is_income'] == rule['is_income']).to_numpy(dtype=bool, na_value=False)
+    return flags
+
+
+def evaluate_rules(df, rules, column_names=None):
+    """
+    全てのルールを評価し、行ごとに最初に一致したルールの番号を返す（一致しない行は -1）
+
+    Args:
+        df (pd.DataFrame): 取引 (content, amount などの列)
+        rules (list): load_rules の結果
+        column_names (dict, optional): ルールの項目 → 列名（CSV の 'account.service.service_name' など）
+    """
+    if not rules:
+        return np.full(len(df), -1)
+    column_names = column_names or {}
+    conditions = [rule_flags(df, rule, column_names) for rule in rules]
+    return np.select(conditions, np.arange(len(rules)), default=-1)
+
+
+def plan_categorize(df, rules, targets, column_names=None):
+    """
+    ルールで変更する取引を求める
+
+    id が負の行（ダミーデータ）と、既に変更先のカテゴリになっている行は含めない。
+
+    Args:
+        df (pd.DataFrame): 取引
+        rules (list): load_rules の結果
+        targets (list): resolve_rule_categories の結果
+        column_names (dict, optional): evaluate_rules を参照
+
+    Returns:
+        pd.DataFrame: 変更する行（rule, new_large_category_id, new_middle_category_id 列を追加）
+    """
+    matched = evaluate_rules(df, rules, column_names)
+    keep = (matched >= 0) & (df['id'] > 0).to_numpy()
+    changes = df.loc[keep].copy()
+    rule_no = matched[keep]
+    target = np.array(targets, dtype=np.int64).reshape(-1, 2)[rule_no]
+    changes['rule'] = [rules[i]['name'] for i in rule_no]
+    changes['new_large_category_id'] = target[:, 0]
+    changes['new_middle_category_id'] = target[:, 1]
+    if 'middle_category_id' in changes and 'large_category_id' in changes:
+        unchanged = ((changes['middle_category_id'] == changes['new_middle_category_id'])
+                     & (changes['large_category_id'] == changes['new_large_category_id']))
+        changes = changes.loc[~unchanged]
+    return changes
+
+
+def group_category_updates(changes):
+    """
+    変更先のカテゴリごとに id をまとめる（カテゴリごとに1回の一括更新で済むように）
+
+    Returns:
+        dict: (large_category_id, middle_category_id) → id のリスト
+    """
+    groups = changes.groupby(['new_large_category_id', 'new_middle_category_id'], sort=True)['id']
+    return {(int(l), int(m)): [int(i) for i in ids] for (l, m), ids in groups}
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+MoneyForward ローカルミラー (SQLite) スキーマ管理モジュール
+
+parse_header の型注釈 (例: ``id:Int64``) から STRICT テーブルの列型を決め、
+既存のテーブルの列 (PRAGMA table_info) と比べて移行する。
+列の追加は ALTER TABLE で、列型の変更や STRICT 化はテーブルの作り直しで
+1トランザクション内に移行する（WAL なので移行中も読み込みは止まらない）。
+このモジュールの関数は args に依存せず、具体的な引数のみを受け取ります。
+"""
+
+import logging
+
+from moneyforward_db import (quote, get_columns, is_strict_table, row_hash_table_name,
+                             drop_fts_index, ensure_fts_index, drop_monthly_summary, ensure_monthly_summary)
+
+logger = logging.getLogger(__name__)
+
+# ローカルミラー (user_asset_act) の列と型注釈。cf_term_data.py --sqlite と moneyforward.py reconcile で共通
+# 金額は外貨の口座で小数になることがあるので Float64 (REAL)
+SQLITE_HEADER = """id:Int64 date:string year:string month:string account_id:str sub_account_id:str is_transfer:boolean is_income:boolean
+                 orig_content=content:string orig_amount=amount:Float64 currency:string jpyrate:Float64 memo:string 
+                 large_category_id:Int64 middle_category_id:Int64 large_category:string middle_category:string
+                 is_target:boolean partner_account_id:str partner_sub_account_id:str partner_act_id:str
+                 created_at:string recognized_at:string updated_at:string sub_account_id_hash:string transfer_type
+                 account.account.service_id=service_id:Int64
+                 account.account.service_category_id=service_category_id:Int64
+                 account.account.disp_name=disp_name:string
+                 account.account.service.service.service_name=service_name:string
+                 sub_account.sub_account.sub_name=sub_name:string
+                 sub_account.sub_account.sub_type=sub_type:string
+                 sub_account.sub_account.sub_number=sub_number
+                 partner_account.partner_account.service_id=partner_account_service_id
+                 partner_account.partner_account.service_category_id=partner_account_service_category_id
+                 partner_account.partner_account.disp_name=partner_account_disp_name
+                 partner_account.partner_account.memo=partner_account_memo
+                 partner_account.partner_account.display_name=partner_account_display_name
+                 partner_sub_account.partner_sub_account.sub_name=partner_account_sub_name
+                 partner_sub_account.partner_sub_account.sub_type=partner_account_sub_type
+                 partner_sub_account.partner_sub_account.sub_number=partner_account_sub_number
+                 partner_sub_account.partner_sub_account.service_category_id=partner_sub_account_service_category_id
+                 partner_sub_account.partner_sub_account.is_dummy=partner_sub_account_is_dummy
+                 partner_act.partner_act.orig_content=partner_act_content
+                 partner_act.partner_act.orig_amount=partner_act_amount:Float64
+                 partner_act.partner_act.currency=partner_act_currency
+                 partner_act.partner_act.jpyrate=partner_act_jpyrate
+                 partner_act.partner_act.memo=partner_act_memo:string
+                 partner_act.partner_act.large_category_id=partner_act_large_category_id:Int64
+                 partner_act.partner_act.middle_category_id=partner_act_middle_category_id:Int64
+                 partner_act.partner_act.sub_account_id_hash=partner_act_sub_account_id_hash
+                 partner_act.partner_act.partner_sub_account_id_hash=partner_act_partner_sub_account_id_hash
+                 """.split()
+
+# STRICT テーブルで使える列型
+STRICT_TYPES = ('INTEGER', 'REAL', 'TEXT', 'BLOB', 'ANY')
+
+
+def parse_header(header_list):
+    select_header = []
+    rename_header = {}
+    dtypes_dict = {}
+    
+    for item in header_list:
+        # まず : で型を分離
+        if ':' in item:
+            name_part, dtype = item.rsplit(':', 1)  # 右からsplitして最後の:を型とする
+        else:
+            name_part = item
+            dtype = None
+        
+        # 次に = でnameとaliasを分離
+        if '=' in name_part:
+            name, alias = name_part.split('=', 1)
+            rename_header[name] = alias
+            select_header.append(name)
+            if dtype:
+                dtypes_dict[alias] = dtype  # エイリアス後の型はaliasに適用
+            else:
+                dtypes_dict[alias] = 'object'
+        else:
+            name = name_part
+            select_header.append(name)
+            if dtype:
+                dtypes_dict[name] = dtype
+            else:
+                dtypes_dict[name] = 'object'
+    
+    return select_header, rename_header, dtypes_dict
+
+
+def apply_header(df, header_list):
+    """
+    header_list (parse_header の書式) の列を選んで名前を変え、型注釈を適用する
+
+    Returns:
+        tuple: (変換した DataFrame, dtypes_dict)
+    """
+    select_header, rename_header, dtypes_dict = parse_header(header_list)
+    df = df.copy()
+    for c in set(select_header) - set(df.columns):
+        df[c] = None
+    df = df[select_header]
+    if rename_header:
+        df = df.rename(columns=rename_header)
+    return df.astype(dtypes_dict), dtypes_dict
+
+
+def sqlite_type(dtype):
+    """
+    parse_header の型注釈 (pandas の dtype 名) を STRICT テーブルの列型に変換する
+
+    型注釈の無い列 (object) は、値をそのまま保持する ANY とする。
+    日時は ISO 8601 形式の TEXT として保存する。
+    """
+    dtype = str(dtype).lower()
+    if dtype.startswith(('int', 'uint')) or dtype in ('bool', 'boolean'):
+        return 'INTEGER'
+    if dtype.startswith('float'):
+        return 'REAL'
+    if dtype in ('str', 'string') or dtype.startswith(('string', 'datetime')):
+        return 'TEXT'
+    if dtype == 'bytes':
+        return 'BLOB'
+    return 'ANY'
+
+
+def table_schema(dtypes_dict):
+    """
+    parse_header の dtypes_dict から {列名: 列型} を作る
+
+    Args:
+        dtypes_dict (dict): {列名: dtype 名}
+
+    Returns:
+        dict: {列名: STRICT 列型}（列の順序は dtypes_dict と同じ）
+    """
+    return {name: sqlite_type(dtype) for name, dtype in dtypes_dict.items()}
+
+
+def create_table_sql(name, schema, unique_index_label):
+    """STRICT テーブルの CREATE TABLE 文を作る"""
+    column_defs = ', '.join(f'{quote(c)} {t}' for c, t in schema.items())
+    return (f'CREATE TABLE {quote(name)} ({column_defs}, '
+            f'CONSTRAINT {quote(name + "_pk")} PRIMARY KEY ({quote(unique_index_label)})) STRICT')
+
+
+def migrate(con, name, schema, unique_index_label='id'):
+    """
+    テーブルを schema に合わせて作成・移行する
+
+    - テーブルが無ければ STRICT テーブルを作成する
+    - 列が増えただけなら ALTER TABLE ADD COLUMN で追加する
+    - 列型が変わった場合や STRICT でない既存テーブルは、新しいテーブルに
+      値を型変換しながらコピーして置き換える（schema に無い既存列は ANY で残す）
+
+    移行の要否は既存のテーブルの列型と STRICT かどうかだけで決める。
+    値が列型に変換できない場合は sqlite3.IntegrityError となり、移行は行われない。
+
+    Args:
+        con (sqlite3.Connection): 接続
+        name (str): テーブル名
+        schema (dict): {列名: STRICT 列型}
+        unique_index_label (str): 主キー列名
+
+    Returns:
+        bool: テーブルを作成・変更した場合 True
+    """
+    if unique_index_label not in schema:
+        raise ValueError(f'{unique_index_label} is not in schema')
+    for c, t in schema.items():
+        if t not in STRICT_TYPES:
+            raise ValueError(f'invalid column type: {c} {t}')
+
+    with con:
+        if not con.in_transaction:
+            # CREATE / ALTER も含めて1トランザクションにする
+            con.execute('BEGIN')
+        columns = get_columns(con, name)
+
+        if not columns:
+            logger.info('create table: %s', name)
+            con.execute(create_table_sql(name, schema, unique_index_label))
+        else:
+            current = {c: t.upper() for c, (t, _) in columns.items()}
+            changed = {c: (current[c], t) for c, t in schema.items() if c in current and current[c] != t}
+            added = [c for c in schema if c not in current]
+
+            if not changed and not added and is_strict_table(con, name):
+                return False
+
+            if changed or not is_strict_table(con, name):
+                # 既存列の型は schema を優先し、schema に無い列はそのまま残す
+                merged = {**{c: schema.get(c, 'ANY') for c in current}, **schema}
+                for c, (old, new) in changed.items():
+                    logger.info('migrate column type: %s.%s %s -> %s', name, c, old or '(none)', new)
+                rebuild_table(con, name, merged, list(current), unique_index_label)
+            else:
+                for c in added:
+                    logger.info('add column: %s.%s %s', name, c, schema[c])
+                    con.execute(f'ALTER TABLE {quote(name)} ADD COLUMN {quote(c)} {schema[c]}')
+
+    return True
+
+
+def rebuild_table(con, name, schema, copy_columns, unique_index_label):
+    """
+    テーブルを schema の STRICT テーブルで作り直し、copy_columns の値をコピーする
+
+    SQLite の推奨手順 (新テーブル作成→コピー→DROP→RENAME) に従う。
+    行ハッシュ・全文検索インデックス・月次集計表は rowid や値の型が変わるため作り直す。
+    呼び出し側のトランザクション内で実行すること。
+    """
+    tmp = f'{name}__migrate'
+    con.execute(f'DROP TABLE IF EXISTS {quote(tmp)}')
+    con.execute(create_table_sql(tmp, schema, unique_index_label))
+    cols = ', '.join(quote(c) for c in copy_columns)
+    con.execute(f'INSERT INTO {quote(tmp)} ({cols}) SELECT {cols} FROM {quote(name)}')
+
+    drop_fts_index(con, name)
+    con.execute(f'DROP TABLE {quote(name)}')
+    con.execute(f'ALTER TABLE {quote(tmp)} RENAME TO {quote(name)}')
+    con.execute(f'DROP TABLE IF EXISTS {quote(row_hash_table_name(name))}')
+    ensure_fts_index(con, name)
+    drop_monthly_summary(con, name)
+    ensure_monthly_summary(con, name)
@@ -10,9 +10,14 @@ MoneyForward 共通ユーティリティモジュール
 """
 
 import os
+import re
 import csv
 import json
 import logging
+import threading
+from time import time
+from bisect import bisect_left
+from collections import defaultdict
 from datetime import datetime
 import pandas as pd
 from moneyforward_api import request_large_categories, request_user_asset_acts
@@ -104,7 +109,238 @@ def save_large_categories_csv(fn, large_categories):
                 ])
 
 
-def search_category_sub(s, cache_csv, force_update, large=None, middle=None, is_income=None):
+# 収入の大カテゴリID
+INCOME_LARGE_CATEGORY_ID = 1
+
+CATEGORY_COLUMNS = ['large_category_id', 'large_category_name', 'middle_category_id', 'middle_category_name', 'user_category']
+
+
+class CategoryIndex:
+    """
+    カテゴリ一覧の検索用インデックス
+
+    大カテゴリ名・中カテゴリ名の完全一致・前方一致・部分一致・正規表現の検索と、
+    ID から名前への変換を、CSV を読み直さずに行う。
+    get_category_index でキャッシュCSVごとに1度だけ作り、プロセス内で共有する。
+
+    Attributes:
+        rows (list): (large_category_id, large_category_name, middle_category_id, middle_category_name, user_category)
+        large (dict): 大カテゴリID → 名前
+        middle (dict): 中カテゴリID → 名前
+        middle_to_large (dict): 中カテゴリID → 大カテゴリID
+    """
+
+    # find_middle で試す順（regex は正規表現として不正な名前では何も一致しない）
+    MATCH_MODES = ('exact', 'prefix', 'substring', 'regex')
+
+    def __init__(self, rows):
+        self.rows = [tuple(row) for row in rows]
+        self.large = {}
+        self.middle = {}
+        self.middle_to_large = {}
+        by_large = defaultdict(list)
+        by_middle = defaultdict(list)
+        for i, (large_id, large_name, middle_id, middle_name, _) in enumerate(self.rows):
+            self.large[large_id] = large_name
+            self.middle[middle_id] = middle_name
+            self.middle_to_large[middle_id] = large_id
+            by_large[large_name].append(i)
+            by_middle[middle_name].append(i)
+        self._names = {'large': dict(by_large), 'middle': dict(by_middle)}
+        self._sorted_names = {key: sorted(names) for key, names in self._names.items()}
+        self._substring_cache = {}
+        self._resolve_cache = {}
+
+    @classmethod
+    def from_large_categories(cls, large_categories):
+        """request_large_categories のレスポンスから作る"""
+        return cls((large['id'], large['name'], middle['id'], middle['name'], middle['user_category'])
+                   for large in large_categories for middle in large['middle_categories'])
+
+    @classmethod
+    def from_csv(cls, cache_csv):
+        """save_large_categories_csv で保存したCSVから作る"""
+        df = pd.read_csv(cache_csv)
+        df[['large_category_name', 'middle_category_name']] = df[['large_category_name', 'middle_category_name']].fillna('').astype(str)
+        return cls(df[CATEGORY_COLUMNS].itertuples(index=False, name=None))
+
+    def lookup(self, key, query, mode='substring'):
+        """
+        名前で検索し、一致した行番号を返す
+
+        Args:
+            key (str): 'large' または 'middle'
+            query (str): 検索文字列
+            mode (str): 'exact'（完全一致）, 'prefix'（前方一致）, 'substring'（部分一致）,
+                'regex'（正規表現の部分一致、pandas の str.contains と同じ）
+
+        Raises:
+            re.error: mode='regex' で query が正規表現として不正な場合
+
+        Returns:
+            list: 行番号（CSVの順）
+        """
+        names = self._names[key]
+        if mode == 'exact':
+            matched = [query] if query in names else []
+        elif mode == 'prefix':
+            sorted_names = self._sorted_names[key]
+            matched = []
+            for name in sorted_names[bisect_left(sorted_names, query):]:
+                if not name.startswith(query):
+                    break
+                matched.append(name)
+        elif mode in ('substring', 'regex'):
+            cache_key = (key, query, mode)
+            if cache_key not in self._substring_cache:
+                if mode == 'regex':
+                    pattern = re.compile(query)
+                    self._substring_cache[cache_key] = [name for name in self._sorted_names[key] if pattern.search(name)]
+                else:
+                    self._substring_cache[cache_key] = [name for name in self._sorted_names[key] if query in name]
+            matched = self._substring_cache[cache_key]
+        else:
+            raise ValueError(f'invalid mode: {mode}')
+        return sorted(i for name in matched for i in names[name])
+
+    def _filter_income(self, indexes, is_income):
+        if is_income is None:
+            return indexes
+        return [i for i in indexes if (self.rows[i][0] == INCOME_LARGE_CATEGORY_ID) == bool(is_income)]
+
+    def search(self, large=None, middle=None, is_income=None, mode='substring'):
+        """
+        大カテゴリ名・中カテゴリ名で絞り込んだ行番号を返す
+
+        Args:
+            large (str, optional): 大カテゴリ名の検索文字列
+            middle (str, optional): 中カテゴリ名の検索文字列
+            is_income (bool, optional): True=収入のみ, False=収入以外, None=全て
+            mode (str): 一致方法（lookup を参照）
+
+        Returns:
+            list: 行番号（CSVの順）
+        """
+        indexes = range(len(self.rows))
+        if large:
+            indexes = self.lookup('large', large, mode)
+        if middle:
+            matched = set(self.lookup('middle', middle, mode))
+            indexes = [i for i in indexes if i in matched]
+        return self._filter_income(list(indexes), is_income)
+
+    def find_middle(self, name, is_income=None):
+        """
+        中カテゴリ名で検索する。完全一致・前方一致・部分一致・正規表現の順に探し、
+        最初に見つかった方法で一致した行番号を返す（見つからなければ空）。
+        """
+        for mode in self.MATCH_MODES:
+            try:
+                indexes = self._filter_income(self.lookup('middle', name, mode), is_income)
+            except re.error:
+                continue
+            if indexes:
+                return indexes
+        return []
+
+    def resolve(self, name, is_income=None):
+        """
+        中カテゴリ名から (large_category_id, middle_category_id) を求める
+
+        Raises:
+            ValueError: カテゴリが見つからない、または一意でない場合
+        """
+        cache_key = (name, is_income)
+        if cache_key not in self._resolve_cache:
+            indexes = self.find_middle(name, is_income)
+            if not indexes:
+                result = ValueError(f"Not Found Category Name: {name}")
+            elif len(indexes) > 1:
+                result = ValueError(f"Not Unique Category Name: {name}")
+            else:
+                large_id, _, middle_id, _, _ = self.rows[indexes[0]]
+                result = (int(large_id), int(middle_id))
+            self._resolve_cache[cache_key] = result
+        result = self._resolve_cache[cache_key]
+        if isinstance(result, ValueError):
+            raise ValueError(*result.args)
+        return result
+
+    def resolve_many(self, names, is_income=None):
+        """
+        複数の中カテゴリ名をまとめて解決する
+
+        重複する名前は1度だけ解決し、見つからない・一意でない名前は例外にせず errors に集める。
+
+        Args:
+            names (iterable): 中カテゴリ名（重複可）
+            is_income (bool, optional): True=収入のみ, False=収入以外, None=全て
+
+        Returns:
+            tuple: (resolved, errors)
+                resolved (dict): 名前 → (large_category_id, middle_category_id)
+                errors (dict): 名前 → 候補の行番号（見つからない場合は空）
+        """
+        resolved = {}
+        errors = {}
+        for name in dict.fromkeys(names):
+            try:
+                resolved[name] = self.resolve(name, is_income)
+            except ValueError:
+                errors[name] = self.find_middle(name, is_income)
+        return resolved, errors
+
+    def frame(self, indexes=None):
+        """行番号のカテゴリを DataFrame で返す（省略時は全て）"""
+        rows = self.rows if indexes is None else [self.rows[i] for i in indexes]
+        return pd.DataFrame(rows, columns=CATEGORY_COLUMNS)
+
+    def to_large_categories(self):
+        """request_large_categories と同じ入れ子の形 (id, name, middle_categories) で返す"""
+        large_categories = {}
+        for large_id, large_name, middle_id, middle_name, user_category in self.rows:
+            large = large_categories.setdefault(large_id, {'id': large_id, 'name': large_name, 'middle_categories': []})
+            large['middle_categories'].append({'id': middle_id, 'name': middle_name, 'user_category': user_category})
+        return list(large_categories.values())
+
+
+# キャッシュCSVの絶対パス → (更新日時, CategoryIndex)
+_category_indexes = {}
+# プロセス内で一度 API から取り直したキャッシュCSV
+_category_forced = set()
+_category_lock = threading.Lock()
+
+
+def get_category_index(s, cache_csv, force_update=False):
+    """
+    キャッシュCSVの CategoryIndex を返す（プロセス内で共有）
+
+    CSVが無い場合、または force_update の場合は API から取得して保存する。
+    force_update はプロセス内で最初の1回だけ API を呼び、CSVが更新されるまでは
+    同じインデックスを返す。
+
+    Args:
+        s (requests.Session): 認証済みセッション（API から取得する場合のみ使用）
+        cache_csv (str): キャッシュCSVファイルパス
+        force_update (bool): 強制的にAPIから再取得するかどうか
+
+    Returns:
+        CategoryIndex: インデックス
+    """
+    key = os.path.abspath(cache_csv)
+    with _category_lock:
+        if not os.path.exists(cache_csv) or (force_update and key not in _category_forced):
+            large_categories = request_large_categories(s)
+            save_large_categories_csv(cache_csv, large_categories)
+            _category_forced.add(key)
+        mtime = os.stat(cache_csv).st_mtime_ns
+        cached = _category_indexes.get(key)
+        if cached is None or cached[0] != mtime:
+            cached = _category_indexes[key] = (mtime, CategoryIndex.from_csv(cache_csv))
+        return cached[1]
+
+
+def search_category_sub(s, cache_csv, force_update, large=None, middle=None, is_income=None, mode='regex'):
     """
     カテゴリを検索してDataFrameで返す
     
@@ -115,37 +351,27 @@ def search_category_sub(s, cache_csv, force_update, large=None, middle=None, is_
         large (str, optional): 大カテゴリ名の検索文字列
         middle (str, optional): 中カテゴリ名の検索文字列
         is_income (bool, optional): True=収入のみ, False=収入以外, None=全て
+        mode (str): 一致方法（CategoryIndex.lookup を参照）。既定は正規表現
     
     Returns:
         pd.DataFrame: フィルタ済みカテゴリ情報
     """
-    if not os.path.exists(cache_csv) or force_update:
-        large_categories = request_large_categories(s)
-        save_large_categories_csv(cache_csv, large_categories)
-    
-    df = pd.read_csv(cache_csv)
-    if large:
-        df = df[df['large_category_name'].str.contains(large, na=False)]
-    if middle:
-        df = df[df['middle_category_name'].str.contains(middle, na=False)]
-    if is_income is not None:
-        if is_income:
-            df = df[df['large_category_id'] == 1]
-        else:
-            df = df[df['large_category_id'] != 1]
-    
-    return df
+    index = get_category_index(s, cache_csv, force_update)
+    return index.frame(index.search(large, middle, is_income, mode))
 
 
 def get_middle_category_impl(s, cache_csv, force_update, category_name, is_income=None):
     """
     カテゴリ名から大カテゴリID・中カテゴリIDを取得
     
+    中カテゴリ名の完全一致・前方一致・部分一致・正規表現の順に探し、最初に見つかった方法で
+    一意に決まればそのIDを返す。
+    
     Args:
         s (requests.Session): 認証済みセッション
         cache_csv (str): キャッシュCSVファイルパス
         force_update (bool): 強制的にAPIから再取得するかどうか
-        category_name (str): 中カテゴリ名（部分一致）
+        category_name (str): 中カテゴリ名
         is_income (bool, optional): True=収入カテゴリから検索, False=支出カテゴリから検索
     
     Returns:
@@ -154,24 +380,7 @@ def get_middle_category_impl(s, cache_csv, force_update, category_name, is_incom
     Raises:
         ValueError: カテゴリが見つからない、または一意でない場合
     """
-    category_df = search_category_sub(
-        s,
-        cache_csv,
-        force_update,
-        middle=category_name,
-        is_income=is_income
-    )
-    
-    if len(category_df) == 0:
-        raise ValueError(f"Not Found Category Name: {category_name}")
-    
-    if len(category_df) > 1:
-        raise ValueError(f"Not Unique Category Name: {category_name}")
-    
-    return (
-        int(category_df.iloc[0].large_category_id),
-        int(category_df.iloc[0].middle_category_id)
-    )
+    return get_category_index(s, cache_csv, force_update).resolve(category_name, is_income)
 
 
 def save_json(fn, obj):
@@ -180,19 +389,127 @@ def save_json(fn, obj):
         json.dump(obj, f)
 
 
-def get_categories_form_user_asset_acts(user_asset_acts):
-    """user_asset_actsレスポンスからカテゴリ辞書を取得"""
+# user_asset_acts の large / middle (ID→名前) のキャッシュ
+CATEGORY_MAP_CACHE = 'cache_category_maps.json'
+CATEGORY_MAP_TTL = 24 * 60 * 60  # 秒
+
+# キャッシュファイルの絶対パス → (取得日時, large, middle)
+_category_maps = {}
+_category_maps_lock = threading.Lock()
+
+
+class CategoryNames(dict):
+    """
+    カテゴリID → 名前の辞書
+
+    キャッシュに無いIDを引いた時は、一度だけ refresh を呼んで最新の対応表を取り込む
+    （`[]` と get の両方）。refresh が無い、または取り込んでも無いIDは通常の辞書と同じ扱い。
+    """
+
+    def __init__(self, names, refresh=None):
+        super().__init__(names)
+        self._refresh = refresh
+
+    def __missing__(self, key):
+        if self._refresh is not None:
+            refresh, self._refresh = self._refresh, None
+            logger.info('unknown category id %s, refreshing category maps', key)
+            self.update(refresh())
+            if key in self:
+                return self[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+def load_category_maps(cache_file=CATEGORY_MAP_CACHE):
+    """
+    カテゴリ対応表をプロセス内、無ければファイルから読み込む
+
+    Returns:
+        tuple: (取得日時, large, middle)。無い場合は None
+    """
+    key = os.path.abspath(cache_file)
+    with _category_maps_lock:
+        if key not in _category_maps and os.path.exists(cache_file):
+            try:
+                with open(cache_file, encoding='utf-8') as f:
+                    data = json.load(f)
+                _category_maps[key] = (data['fetched_at'],
+                                       {int(k): v for k, v in data['large'].items()},
+                                       {int(k): v for k, v in data['middle'].items()})
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning('failed to read category maps %s: %s', cache_file, e)
+        return _category_maps.get(key)
+
+
+def store_category_maps(large, middle, cache_file=CATEGORY_MAP_CACHE):
+    """カテゴリ対応表をプロセス内とファイルに保存する（内容が同じで期限内なら書き込まない）"""
+    key = os.path.abspath(cache_file)
+    now = time()
+    with _category_maps_lock:
+        cached = _category_maps.get(key)
+        if cached and cached[1] == large and cached[2] == middle and now - cached[0] < CATEGORY_MAP_TTL / 2:
+            return
+        _category_maps[key] = (now, dict(large), dict(middle))
+        try:
+            tmp = cache_file + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({'fetched_at': now, 'large': large, 'middle': middle}, f, ensure_ascii=False)
+            os.replace(tmp, cache_file)
+        except OSError as e:
+            logger.warning('failed to save category maps %s: %s', cache_file, e)
+
+
+def get_categories_form_user_asset_acts(user_asset_acts, cache_file=CATEGORY_MAP_CACHE):
+    """
+    user_asset_actsレスポンスからカテゴリ辞書を取得
+
+    取得した対応表はキャッシュにも保存し、get_categories_form_session で再利用する。
+    """
     large = { int(k):v for k, v in user_asset_acts['large'].items()}
     large[0] = '-'
     middle = { int(k):v for k, v in user_asset_acts['middle'].items()}
     middle[0] = '-'
+    store_category_maps(large, middle, cache_file)
     return large, middle
 
 
-def get_categories_form_session(s):
-    """セッションからカテゴリ情報を取得（user_asset_acts経由）"""
-    user_asset_acts = request_user_asset_acts(s, size=1)
-    return get_categories_form_user_asset_acts(user_asset_acts)
+def get_categories_form_session(s, cache_file=CATEGORY_MAP_CACHE, ttl=CATEGORY_MAP_TTL):
+    """
+    カテゴリ情報 (large, middle) を取得
+
+    user_asset_acts のレスポンスから保存したキャッシュ（プロセス内・ファイル）が
+    ttl 秒以内なら API を呼ばずに返す。期限切れか無い場合は user_asset_acts 経由で取得する。
+    返す辞書は、キャッシュに無いIDを引いた時に一度だけ API から取り直す。
+
+    Args:
+        s (requests.Session): 認証済みセッション
+        cache_file (str): キャッシュファイルパス
+        ttl (float): キャッシュの有効期間（秒）
+
+    Returns:
+        tuple: (large, middle) の CategoryNames
+    """
+    fetched = {}
+
+    def refresh():
+        # large / middle のどちらで未知のIDが出ても、API は1回だけ呼ぶ
+        if not fetched:
+            fetched['maps'] = get_categories_form_user_asset_acts(request_user_asset_acts(s, size=1), cache_file)
+        return fetched['maps']
+
+    cached = load_category_maps(cache_file)
+    if cached is None or time() - cached[0] >= ttl:
+        large, middle = refresh()
+        return CategoryNames(large), CategoryNames(middle)
+    _, large, middle = cached
+    return (CategoryNames(large, lambda: refresh()[0]),
+            CategoryNames(middle, lambda: refresh()[1]))
 
 
 def append_row_form_user_asset_acts(rows, user_asset_acts, list_header):
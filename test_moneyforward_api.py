@@ -0,0 +1,96 @@
+import unittest
+import json
+import threading
+
+from moneyforward_api import run_category_bulk_updates, RateLimiter
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, text=''):
+        self.status_code = status_code
+        self.text = text
+
+
+class FakeSession:
+    """transactions_category_bulk_updates を受け付けるセッション（max_ids 件を超えると 413）"""
+
+    def __init__(self, max_ids=100, status_code=200, failures=None):
+        self.max_ids = max_ids
+        self.status_code = status_code
+        self.failures = None if failures is None else list(failures)  # 先頭から順に返すステータス
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def put(self, url, data, headers=None):
+        params = json.loads(data)
+        with self.lock:
+            self.requests.append(params)
+        if len(params['ids']) > self.max_ids:
+            return FakeResponse(413, 'Request Entity Too Large')
+        if self.failures:
+            with self.lock:
+                return FakeResponse(self.failures.pop(0), 'error')
+        return FakeResponse(self.status_code, '' if self.status_code == 200 else 'error')
+
+
+class TestCategoryBulkUpdates(unittest.TestCase):
+
+    def run_updates(self, s, groups, **kwargs):
+        return run_category_bulk_updates(s, groups, limiter=RateLimiter(0), backoff=0, **kwargs)
+
+    def test_batches(self):
+        """全カテゴリのバッチを送信し、バッチごとの結果を返す"""
+        s = FakeSession()
+        groups = {(11, 41): list(range(1, 251)), (12, 51): [-1, 1001, 1002]}
+        results = self.run_updates(s, groups)
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(r['ok'] for r in results))
+        updated = {(r['large_category_id'], r['middle_category_id']): set() for r in results}
+        for r in results:
+            updated[r['large_category_id'], r['middle_category_id']].update(r['ids'])
+        self.assertEqual(updated, {(11, 41): set(range(1, 251)), (12, 51): {1001, 1002}})
+        self.assertEqual(max(len(p['ids']) for p in s.requests), 100)
+
+    def test_adaptive_batch_size(self):
+        """大きすぎて受け付けられないバッチは分けて送り直す"""
+        s = FakeSession(max_ids=30)
+        results = self.run_updates(s, {(11, 41): list(range(1, 251))}, workers=1)
+        self.assertTrue(all(r['ok'] for r in results))
+        self.assertEqual(sorted(i for r in results for i in r['ids']), list(range(1, 251)))
+        self.assertLessEqual(max(len(r['ids']) for r in results), 30)
+        # 縮めたサイズは以降のバッチにも使う（失敗は最初のバッチの分だけ）
+        self.assertEqual(sum(1 for p in s.requests if len(p['ids']) > 30), 2)
+
+    def test_failure_report(self):
+        """分けても通らないエラーは、バッチをそのまま失敗として返す"""
+        s = FakeSession(status_code=401)
+        results = self.run_updates(s, {(11, 41): list(range(1, 151))})
+        self.assertEqual([(len(r['ids']), r['status_code'], r['ok']) for r in results if len(r['ids']) == 100],
+                         [(100, 401, False)])
+        self.assertEqual(len(s.requests), 2)
+
+    def test_validation_error(self):
+        """検証エラー (400, 422) はバッチを分けずに失敗とする"""
+        for status_code in (400, 422):
+            s = FakeSession(status_code=status_code)
+            results = self.run_updates(s, {(11, 41): list(range(1, 151))})
+            self.assertEqual(sorted((len(r['ids']), r['status_code'], r['ok']) for r in results),
+                             [(50, status_code, False), (100, status_code, False)])
+            self.assertEqual(len(s.requests), 2)
+
+    def test_retry_server_error(self):
+        """サーバーエラーは同じバッチを送り直し、retries 回を超えたら失敗とする"""
+        s = FakeSession(failures=[503, 502])
+        results = self.run_updates(s, {(11, 41): list(range(1, 101))})
+        self.assertEqual([(len(r['ids']), r['ok']) for r in results], [(100, True)])
+        self.assertEqual([len(p['ids']) for p in s.requests], [100, 100, 100])
+
+        s = FakeSession(status_code=500)
+        results = self.run_updates(s, {(11, 41): list(range(1, 101))}, retries=1)
+        self.assertEqual([(len(r['ids']), r['status_code'], r['ok']) for r in results], [(100, 500, False)])
+        self.assertEqual(len(s.requests), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,552 @@
+import unittest
+import os
+import tempfile
+import sqlite3
+import io
+import requests
+from contextlib import redirect_stdout, redirect_stderr
+from unittest import mock
+from contextlib import closing
+import pandas as pd
+
+from datetime import date, datetime
+from moneyforward_db import (connect, upsert, update_rows, get_columns, get_fts_columns, fts_table_name,
+                             summarize_monthly, full_month_range, bucket_digests, replace_bucket,
+                             combine_patterns, PatternMatcher)
+from moneyforward_schema import SQLITE_HEADER, apply_header
+
+
+class TestUpsert(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.DataFrame({
+            'id': [1, 2, 3],
+            'content': ['A', 'B', 'C'],
+            'amount': [-10, -20, 30],
+        })
+        self.temp_dir = tempfile.mkdtemp()
+        self.sqlite_file = os.path.join(self.temp_dir, 'test.db')
+        self.con = connect(self.sqlite_file)
+
+    def tearDown(self):
+        self.con.close()
+        for fn in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, fn))
+        os.rmdir(self.temp_dir)
+
+    def _read(self, table='user_asset_act'):
+        return pd.read_sql(f'SELECT * FROM {table} ORDER BY id', self.con)
+
+    def test_wal_mode(self):
+        """WALモードで接続される"""
+        mode = self.con.execute('PRAGMA journal_mode').fetchone()[0]
+        self.assertEqual(mode, 'wal')
+
+    def test_new_table(self):
+        """新規テーブル作成"""
+        self.assertEqual(upsert(self.df, 'user_asset_act', 'id', self.con), 3)
+        self.assertTrue(self._read().equals(self.df))
+        self.assertEqual(get_columns(self.con, 'user_asset_act')['id'], ('INTEGER', 1))
+
+    def test_no_change_on_same_data(self):
+        """同じデータの再同期では書き込みなし"""
+        upsert(self.df, 'user_asset_act', 'id', self.con)
+        changes = self.con.total_changes
+        self.assertEqual(upsert(self.df, 'user_asset_act', 'id', self.con), 0)
+        self.assertEqual(self.con.total_changes, changes)
+
+    def test_update_changed_row(self):
+        """変更行と新規行のみ書き込み"""
+        upsert(self.df, 'user_asset_act', 'id', self.con)
+        new_df = self.df.copy()
+        new_df.loc[1, 'content'] = 'X'
+        new_df = pd.concat([new_df, pd.DataFrame({'id': [4], 'content': ['D'], 'amount': [40]})], ignore_index=True)
+        self.assertEqual(upsert(new_df, 'user_asset_act', 'id', self.con), 2)
+        self.assertTrue(self._read().equals(new_df))
+
+    def test_add_new_column(self):
+        """新規列はALTER TABLEで追加"""
+        upsert(self.df, 'user_asset_act', 'id', self.con)
+        new_df = self.df.copy()
+        new_df['memo'] = ['m1', None, 'm3']
+        upsert(new_df, 'user_asset_act', 'id', self.con)
+        memo = [row[0] for row in self.con.execute('SELECT memo FROM user_asset_act ORDER BY id')]
+        self.assertEqual(memo, ['m1', None, 'm3'])
+
+    def test_external_update_invalidates_hash(self):
+        """upsert以外で更新された行は次回のupsertで書き戻される"""
+        upsert(self.df, 'user_asset_act', 'id', self.con)
+        with self.con:
+            self.con.execute("UPDATE user_asset_act SET content = 'Z' WHERE id = 2")
+        self.assertEqual(upsert(self.df, 'user_asset_act', 'id', self.con), 1)
+        self.assertTrue(self._read().equals(self.df))
+
+    def test_deleted_row_restored(self):
+        """削除された行は次回のupsertで復元される"""
+        upsert(self.df, 'user_asset_act', 'id', self.con)
+        with self.con:
+            self.con.execute("DELETE FROM user_asset_act WHERE id = 3")
+        self.assertEqual(upsert(self.df, 'user_asset_act', 'id', self.con), 1)
+        self.assertTrue(self._read().equals(self.df))
+
+    def test_existing_table_without_primary_key(self):
+        """主キーの無い既存テーブルにも一意インデックスを作成してupsert"""
+        with closing(sqlite3.connect(self.sqlite_file)) as con:
+            self.df.to_sql('user_asset_act', con, index=False)
+        new_df = self.df.copy()
+        new_df.loc[0, 'amount'] = -99
+        upsert(new_df, 'user_asset_act', 'id', self.con)
+        self.assertTrue(self._read().equals(new_df))
+
+    def test_update_rows(self):
+        """列の組み合わせが異なる行もまとめて更新し、未知の列は無視する"""
+        upsert(self.df, 'user_asset_act', 'id', self.con)
+        records = [
+            {'id': 1, 'content': 'X'},
+            {'id': 2, 'content': 'Y', 'amount': -99},
+            {'id': 3, 'unknown': 1},
+            {'id': 9, 'content': 'Z'},
+        ]
+        self.assertEqual(update_rows(self.con, 'user_asset_act', records), 2)
+        expected = self.df.assign(content=['X', 'Y', 'C'], amount=[-10, -99, 30])
+        self.assertTrue(self._read().equals(expected))
+        # 更新された行はハッシュが無効になり、次回のupsertで書き戻される
+        self.assertEqual(upsert(self.df, 'user_asset_act', 'id', self.con), 2)
+
+    def test_invalid_frame(self):
+        """DataFrame/Series以外はエラー"""
+        with self.assertRaises(NotImplementedError):
+            upsert([1, 2], 'user_asset_act', 'id', self.con)
+
+    def test_fts_index_follows_upsert(self):
+        """全文検索インデックスは upsert と UPDATE に追従する"""
+        df = self.df.assign(memo=['ローソン大阪', None, 'セブン'])
+        upsert(df, 'user_asset_act', 'id', self.con)
+        self.assertEqual(get_fts_columns(self.con, 'user_asset_act'), {'content', 'memo'})
+        fts = fts_table_name('user_asset_act')
+
+        def search(text):
+            sql = f'SELECT rowid FROM {fts} WHERE {fts} MATCH ? ORDER BY rowid'
+            return [row[0] for row in self.con.execute(sql, [f'"memo" : "{text}"'])]
+
+        self.assertEqual(search('ローソン'), [1])
+        df.loc[1, 'memo'] = 'ローソン梅田'
+        upsert(df, 'user_asset_act', 'id', self.con)
+        self.assertEqual(search('ローソン'), [1, 2])
+        with self.con:
+            self.con.execute("UPDATE user_asset_act SET memo = NULL WHERE id = 1")
+            self.con.execute("DELETE FROM user_asset_act WHERE id = 2")
+        self.assertEqual(search('ローソン'), [])
+
+
+class TestMonthlySummary(unittest.TestCase):
+    """月次集計表が元テーブルからの集計と一致するか"""
+
+    def setUp(self):
+        self.df = pd.DataFrame({
+            'id': [1, 2, 3, 4, 5, 6],
+            'recognized_at': ['2024-01-05T10:00:00+09:00', '2024-01-31T10:00:00+09:00', '2024-02-10T10:00:00+09:00',
+                              '2024-02-29T10:00:00+09:00', '2024-03-01T10:00:00+09:00', '2024-03-20T10:00:00+09:00'],
+            'amount': [-500, -1200, -300, 10000, -50, -700],
+            'large_category': ['食費', '交通費', '食費', '収入', None, '食費'],
+            'service_name': ['財布', 'カード', 'カード', '銀行', 'カード', '財布'],
+            'is_income': [0, 0, 0, 1, 0, 0],
+            'is_transfer': [0, 0, 1, 0, 0, 0],
+        })
+        self.temp_dir = tempfile.mkdtemp()
+        self.con = connect(os.path.join(self.temp_dir, 'test.db'))
+        upsert(self.df, 'user_asset_act', 'id', self.con)
+
+    def tearDown(self):
+        self.con.close()
+        for fn in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, fn))
+        os.rmdir(self.temp_dir)
+
+    def _summary(self):
+        return self.con.execute('SELECT month, large_category, amount_sum, act_count FROM user_asset_act_monthly '
+                                'ORDER BY month, large_category').fetchall()
+
+    def _expected(self, df):
+        df = df.assign(month=df['recognized_at'].str[:7], large_category=df['large_category'].fillna(''))
+        grouped = df.groupby(['month', 'large_category'])['amount'].agg(['sum', 'count']).reset_index()
+        return [tuple(row) for row in grouped.itertuples(index=False)]
+
+    def test_full_month_range(self):
+        self.assertEqual(full_month_range(date(2024, 1, 1), date(2024, 3, 31)), ('2024-01', '2024-03'))
+        self.assertEqual(full_month_range(date(2024, 1, 2), date(2024, 3, 30)), ('2024-02', '2024-02'))
+        self.assertEqual(full_month_range(date(2024, 12, 15), date(2025, 1, 31)), ('2025-01', '2025-01'))
+        self.assertIsNone(full_month_range(date(2024, 2, 2), date(2024, 2, 28)))
+
+    def test_follows_changes(self):
+        """upsert / update_rows / DELETE の差分が反映される"""
+        self.assertEqual(self._summary(), self._expected(self.df))
+        df = self.df.copy()
+        df.loc[0, 'amount'] = -800
+        df.loc[2, 'recognized_at'] = '2024-03-10T10:00:00+09:00'
+        upsert(df, 'user_asset_act', 'id', self.con)
+        update_rows(self.con, 'user_asset_act', [{'id': 6, 'large_category': '交通費'}])
+        df.loc[5, 'large_category'] = '交通費'
+        with self.con:
+            self.con.execute('DELETE FROM user_asset_act WHERE id = 5')
+        self.assertEqual(self._summary(), self._expected(df.drop(index=4)))
+
+    def test_summarize_monthly(self):
+        """端数の月は元テーブルから集計する"""
+        rows = summarize_monthly(self.con, 'user_asset_act', date(2024, 1, 10), date(2024, 3, 31))
+        self.assertEqual(rows, [('2024-01', -1200, 1), ('2024-03', -750, 2), ('2024-02', 10000, 1)])
+        rows = summarize_monthly(self.con, 'user_asset_act', date(2024, 1, 1), date(2024, 3, 1),
+                                 group_by=('service_name',), is_income=False, exclude_transfers=False)
+        self.assertEqual(rows, [('カード', -1550, 3), ('財布', -500, 1)])
+
+    def test_summarize_partial_month(self):
+        """丸ごと含まれる月が無い範囲は元テーブルだけから集計する（月の無い行の集計を拾わない）"""
+        upsert(pd.DataFrame({'id': [7], 'recognized_at': [''], 'amount': [-999], 'is_income': [0], 'is_transfer': [0]}),
+               'user_asset_act', 'id', self.con)
+        rows = summarize_monthly(self.con, 'user_asset_act', date(2024, 1, 2), date(2024, 1, 30))
+        self.assertEqual(rows, [('2024-01', -500, 1)])
+
+    def test_exclude_dummy_rows(self):
+        """ダミーデータ (id <= 0) は月次集計表にも端数の月の集計にも含めない"""
+        dummy = pd.DataFrame({'id': [-1, -2], 'recognized_at': ['2024-01-20T10:00:00+09:00', '2024-03-25T10:00:00+09:00'],
+                              'amount': [-100000, -200000], 'large_category': ['食費', '食費'],
+                              'service_name': ['財布', '財布'], 'is_income': [0, 0], 'is_transfer': [0, 0]})
+        upsert(dummy, 'user_asset_act', 'id', self.con)
+        self.assertEqual(self._summary(), self._expected(self.df))
+        rows = summarize_monthly(self.con, 'user_asset_act', date(2024, 1, 10), date(2024, 3, 31))
+        self.assertEqual(rows, [('2024-01', -1200, 1), ('2024-03', -750, 2), ('2024-02', 10000, 1)])
+        # id を正にすると集計に加わる
+        with self.con:
+            self.con.execute('UPDATE user_asset_act SET id = 7 WHERE id = -1')
+        self.assertEqual(self._summary(), self._expected(pd.concat([self.df, dummy.iloc[:1].assign(id=7)])))
+
+    def test_rebuild_old_triggers(self):
+        """ダミーデータを除外しない古いトリガーは作り直す"""
+        with self.con:
+            self.con.execute("INSERT INTO user_asset_act (id, recognized_at, amount) VALUES (-1, '2024-01-20', -9)")
+            self.con.execute('DROP TRIGGER user_asset_act_monthly_insert')
+            self.con.execute('CREATE TRIGGER user_asset_act_monthly_insert AFTER INSERT ON user_asset_act BEGIN SELECT 1; END')
+        summarize_monthly(self.con, 'user_asset_act', date(2024, 1, 1), date(2024, 1, 31))
+        self.assertEqual(self._summary(), self._expected(self.df))
+
+
+class TestReconcile(unittest.TestCase):
+    """(sub_account, 月) ごとのダイジェストとバケットの置き換え"""
+
+    def setUp(self):
+        self.df = pd.DataFrame({
+            'id': [1, 2, 3, 4, -5],
+            'sub_account_id_hash': ['A', 'A', 'A', 'B', 'A'],
+            'recognized_at': ['2024-01-05T10:00:00+09:00', '2024-01-20T10:00:00+09:00', '2024-02-03T10:00:00+09:00',
+                              '2024-01-09T10:00:00+09:00', '2024-01-05T10:00:00+09:00'],
+            'amount': [-100, -200, -300, -50, 100],
+            'updated_at': ['u1', 'u2', 'u3', 'u4', 'u5'],
+        })
+        self.temp_dir = tempfile.mkdtemp()
+        self.con = connect(os.path.join(self.temp_dir, 'test.db'))
+        upsert(self.df, 'user_asset_act', 'id', self.con)
+
+    def tearDown(self):
+        self.con.close()
+        for fn in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, fn))
+        os.rmdir(self.temp_dir)
+
+    def test_bucket_digests(self):
+        """ダミー行を除いて件数・金額を集計し、行の内容が変わるとハッシュも変わる"""
+        digests = bucket_digests(self.con, 'user_asset_act')
+        self.assertEqual({k: (v['count'], v['amount']) for k, v in digests.items()},
+                         {('A', '2024-01'): (2, -300), ('A', '2024-02'): (1, -300), ('B', '2024-01'): (1, -50)})
+        self.assertEqual(list(bucket_digests(self.con, 'user_asset_act', '2024-02', '2024-02')), [('A', '2024-02')])
+        with self.con:
+            self.con.execute("UPDATE user_asset_act SET updated_at = 'x' WHERE id = 2")
+        changed = bucket_digests(self.con, 'user_asset_act')
+        self.assertNotEqual(changed[('A', '2024-01')]['hash'], digests[('A', '2024-01')]['hash'])
+        self.assertEqual(changed[('B', '2024-01')]['hash'], digests[('B', '2024-01')]['hash'])
+
+    def test_replace_bucket(self):
+        """frame に無い行は既定では削除せずに返し、delete=True の場合だけ削除する"""
+        frame = self.df.iloc[[0]].assign(amount=-111)
+        self.assertEqual(replace_bucket(self.con, 'user_asset_act', frame, 'A', '2024-01'), (1, [2]))
+        rows = self.con.execute('SELECT id, amount FROM user_asset_act ORDER BY id').fetchall()
+        self.assertEqual(rows, [(-5, 100), (1, -111), (2, -200), (3, -300), (4, -50)])
+
+        self.assertEqual(replace_bucket(self.con, 'user_asset_act', frame, 'A', '2024-01', delete=True), (0, [2]))
+        rows = self.con.execute('SELECT id, amount FROM user_asset_act ORDER BY id').fetchall()
+        self.assertEqual(rows, [(-5, 100), (1, -111), (3, -300), (4, -50)])
+
+    def test_replace_bucket_moved_row(self):
+        """前後に広げて取得した frame にある行は、月が変わっていても削除しない"""
+        frame = self.df.iloc[[0, 1]].assign(recognized_at=['2024-01-05T10:00:00+09:00', '2024-02-01T09:00:00+09:00'])
+        self.assertEqual(replace_bucket(self.con, 'user_asset_act', frame, 'A', '2024-01', delete=True), (1, []))
+        self.assertEqual(self.con.execute("SELECT substr(recognized_at, 1, 7) FROM user_asset_act WHERE id = 2").fetchone(),
+                         ('2024-02',))
+
+    def test_bucket_fetch_range(self):
+        """バケットの月を前後に広げて取得する"""
+        import moneyforward
+        self.assertEqual(moneyforward.bucket_fetch_range('2024-02', 7),
+                         (datetime(2024, 1, 25), datetime(2024, 3, 7)))
+
+    def test_reconcile_month_range(self):
+        """丸ごと含まれる月だけを比べ、省略時は今月を含む years 年分"""
+        import moneyforward
+        self.assertEqual(moneyforward.reconcile_month_range(today=datetime(2024, 3, 15)), ('2023-04', '2024-03'))
+        self.assertEqual(moneyforward.reconcile_month_range(years=2, today=datetime(2024, 1, 1)), ('2022-02', '2024-01'))
+        self.assertEqual(moneyforward.reconcile_month_range(datetime(2024, 1, 10), datetime(2024, 3, 31)),
+                         ('2024-02', '2024-03'))
+        self.assertIsNone(moneyforward.reconcile_month_range(datetime(2024, 1, 10), datetime(2024, 1, 20)))
+
+    def test_years_argument(self):
+        """--years は1以上"""
+        import moneyforward
+        with redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+            moneyforward.parser.parse_args(['reconcile', '-s', 'x.db', '--years', '0'])
+
+
+def term_data_response(acts):
+    """cf_term_data_by_sub_account のレスポンス（get_term_data_list が読む形式）"""
+    return {'user_asset_acts': [{'user_asset_act': dict(
+        id=id_, sub_account_id_hash=sub, recognized_at=recognized_at, orig_amount=amount, updated_at=updated_at,
+        orig_content='content', is_transfer=False, is_target=True, large_category_id=11, middle_category_id=41,
+        account={'account': {'service_id': 1, 'disp_name': '財布'}})} for id_, sub, recognized_at, amount, updated_at in acts]}
+
+
+class TestReconcileCommand(unittest.TestCase):
+    """サーバーの取引と同じ列型のダイジェストで比べ、違うバケットだけ書き換える"""
+
+    ACTS = [(1, 'A', '2024-01-05T10:00:00+09:00', -100, 'u1'), (2, 'A', '2024-01-20T10:00:00+09:00', -200, 'u2'),
+            (3, 'A', '2024-02-03T10:00:00+09:00', -300, 'u3'), (4, 'B', '2024-01-09T10:00:00+09:00', -50, 'u4')]
+
+    def setUp(self):
+        import moneyforward
+        self.moneyforward = moneyforward
+        self.temp_dir = tempfile.mkdtemp()
+        self.sqlite_file = os.path.join(self.temp_dir, 'test.db')
+        # cf_term_data --sqlite と同じ経路でローカルミラーを作る
+        frame, _ = apply_header(moneyforward.get_term_data_list(term_data_response(self.ACTS)), SQLITE_HEADER)
+        with closing(connect(self.sqlite_file)) as con:
+            upsert(frame, 'user_asset_act', 'id', con)
+        with closing(connect(self.sqlite_file)) as con:
+            con.execute('INSERT INTO user_asset_act (id, sub_account_id_hash, recognized_at, amount) '
+                        "VALUES (-5, 'A', '2024-01-05T10:00:00+09:00', 100)")
+            con.commit()
+
+    def tearDown(self):
+        for fn in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, fn))
+        os.rmdir(self.temp_dir)
+
+    def reconcile(self, responses, *options):
+        """responses: sub_account_id_hash → レスポンス"""
+        moneyforward = self.moneyforward
+        args = moneyforward.parser.parse_args(['reconcile', '-s', self.sqlite_file, '-f', '2024-01-01', '-t', '2024-02-29',
+                                               *options])
+        summaries = pd.DataFrame({'sub_accounts.sub_account_id_hash': list(responses)})
+        with mock.patch.object(moneyforward, 'change_default_group'), \
+                mock.patch.object(moneyforward, 'get_categories_form_session', return_value=(None, None)), \
+                mock.patch.object(moneyforward, 'request_account_summaries'), \
+                mock.patch.object(moneyforward, 'get_account_summaries_list', return_value=summaries), \
+                mock.patch.object(moneyforward, 'request_cf_term_data_by_sub_account',
+                                  side_effect=lambda s, sub, *_: responses[sub]) as fetch, \
+                mock.patch.object(moneyforward, 'sleep'), \
+                redirect_stdout(io.StringIO()) as out, redirect_stderr(io.StringIO()):
+            args.func(None, args)
+        with closing(sqlite3.connect(self.sqlite_file)) as con:
+            rows = con.execute('SELECT id, amount FROM user_asset_act ORDER BY id').fetchall()
+        return out.getvalue(), rows, fetch
+
+    def test_same(self):
+        """同じ内容なら1件も違わない（サブアカウントごとに1回だけ取得する）"""
+        out, rows, fetch = self.reconcile({'A': term_data_response(self.ACTS[:3]), 'B': term_data_response(self.ACTS[3:])})
+        self.assertIn('0 buckets differ (2024-01..2024-02, 2/2 sub accounts compared)', out)
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_edit_and_delete(self):
+        """編集・削除されたバケットだけを書き換え、削除は --delete の場合だけ"""
+        edited = [self.ACTS[0][:3] + (-111, 'u1x'), self.ACTS[2]]
+        responses = {'A': term_data_response(edited), 'B': term_data_response(self.ACTS[3:])}
+        out, rows, _ = self.reconcile(responses)
+        self.assertIn('1 buckets differ', out)
+        self.assertEqual(rows, [(-5, 100), (1, -111), (2, -200), (3, -300), (4, -50)])
+        out, rows, _ = self.reconcile(responses, '--delete')
+        self.assertEqual(rows, [(-5, 100), (1, -111), (3, -300), (4, -50)])
+        out, _, _ = self.reconcile(responses, '--dry_run')
+        self.assertIn('0 buckets differ', out)
+
+    def test_skip(self):
+        """想定外のレスポンスや空のレスポンスのサブアカウントは比べず、全て飛ばしたら失敗にする"""
+        out, rows, _ = self.reconcile({'A': {'user_asset_acts': []}, 'B': term_data_response(self.ACTS[3:])}, '--delete')
+        self.assertIn('1/2 sub accounts compared', out)
+        self.assertEqual(len(rows), 5)
+        with self.assertRaises(SystemExit) as cm:
+            self.reconcile({'A': {'error': 'unauthorized'}, 'B': {'error': 'unauthorized'}})
+        self.assertIn('all 2 sub accounts were skipped', str(cm.exception.code))
+
+
+class TestFilterQuery(unittest.TestCase):
+    """filter_db の SQL 絞り込みが pandas での絞り込みと同じ結果になるか"""
+
+    def setUp(self):
+        self.df = pd.DataFrame({
+            'id': [1, 2, 3, 4, 5, -6],
+            'date': ['24/01/05', '24/02/10', '24/03/15', '24/03/31', '25/01/01', '24/02/10'],
+            'content': ['ローソン大阪', 'タイムズ梅田', 'セブン', None, 'ローソン(ポイント利用分)', 'ダミー'],
+            'amount': [-500, -1200, -300, 10000, 50, 500],
+            'large_category': ['食費', '交通費', '食費', '収入', '収入', '食費'],
+            'middle_category': ['食料品', '駐車場', 'コンビニ', '給与', None, '食料品'],
+            'service_name': ['財布', 'カード', 'カード', '銀行', 'カード', '財布'],
+            'sub_type': ['wallet', 'card', 'card', 'bank', 'card', 'wallet'],
+            'memo': [None, 'x', 'メモ', None, 'abc', ''],
+            'is_income': [0, 0, 0, 1, 1, 0],
+            'is_transfer': [0, 0, 1, 0, 0, 0],
+        })
+        self.temp_dir = tempfile.mkdtemp()
+        self.sqlite_file = os.path.join(self.temp_dir, 'test.db')
+        with closing(connect(self.sqlite_file)) as con:
+            upsert(self.df, 'user_asset_act', 'id', con)
+
+    def tearDown(self):
+        for fn in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, fn))
+        os.rmdir(self.temp_dir)
+
+    def assertSameResult(self, *options):
+        import moneyforward
+        args = moneyforward.parser.parse_args(['filter_db', '--sqlite', self.sqlite_file, *options])
+        flags = moneyforward.get_filter_flags(self.df, args, 'service_name', 'sub_type')
+        expected = self.df.loc[flags ^ args.reverse, 'id'].tolist()
+        actual = moneyforward.read_filtered_sqlite(args)['id'].tolist()
+        self.assertEqual(sorted(actual), sorted(expected), options)
+
+    def test_options(self):
+        for options in [
+            [],
+            ['-p', 'ローソン', '^タイムズ'],
+            ['-p', '.*', '-E', 'ポイント利用分'],
+            ['-E', r'\(ポイント'],
+            ['-m', '食料', 'コンビニ'],
+            ['-M', 'コンビニ'],
+            ['-l', '食費'],
+            ['-L', '収入'],
+            ['-s', 'カード', '-T', 'card'],
+            ['--null_memo'],
+            ['--not_null_memo'],
+            ['--match_memo', 'x', 'メモ'],
+            ['--not_match_memo', 'x'],
+            ['-b', '2024-02-10', '-e', '2024-03-31'],
+            ['-i', '--is_income', '0'],
+            ['--is_transfer', '1'],
+            ['--lt', '0'], ['--le', '-500'], ['--gt', '0'], ['--ge', '50'],
+            ['-r', '-p', 'ローソン'],
+            ['-r', '-M', 'コンビニ', '--lt', '0'],
+            ['-p', '^ロー', 'ン$', '(ムズ|ブン)', 'セブン', '-E', r'\(ポ', '大阪$'],
+            ['-M', '食料', '^駐', '-L', '収入', '-S', '財布', '-T', 'wallet', 'bank'],
+        ]:
+            self.assertSameResult(*options)
+
+    def test_chunked(self):
+        """--chunksize の結果は一括読み込みと同じ"""
+        import moneyforward
+        csv_file = os.path.join(self.temp_dir, 'test.csv')
+        self.df.rename(columns={'service_name': 'account.service.service_name',
+                                'sub_type': 'sub_account.sub_type'}).to_csv(csv_file, index=False)
+        for options in [[], ['-p', 'ローソン', '-r'], ['-m', '食料', 'コンビニ', '--lt', '0'], ['--query', 'amount < 0']]:
+            for source in (['--sqlite', self.sqlite_file], ['--csv', csv_file]):
+                args = moneyforward.parser.parse_args(['filter_db', *source, '--chunksize', '2', *options])
+                flags = moneyforward.get_filter_flags(self.df, args, 'service_name', 'sub_type')
+                expected = self.df.loc[flags ^ args.reverse]
+                if args.query:
+                    expected = expected.query(args.query)
+                actual = pd.concat(moneyforward.iter_filtered_chunks(args))['id'].tolist()
+                self.assertEqual(sorted(actual), sorted(expected['id'].tolist()), (source[0], options))
+
+    def test_combine_patterns(self):
+        """パターンは1つの正規表現にまとめ、キャプチャグループを含むものは別にする"""
+        self.assertEqual(combine_patterns(['^a', 'b', '^a']), ('(?:^a)|(?:b)', []))
+        self.assertEqual(combine_patterns(['a', r'(x)\1']), ('a', [r'(x)\1']))
+        self.assertEqual(combine_patterns(['a', '(?i)b']), (None, ['a', '(?i)b']))
+        matcher = PatternMatcher(['^ロー', r'(\w)\1', '(?i)abc'])
+        self.assertEqual(matcher.flags(pd.Series(['ローソン', 'aa', 'ABC', 'x', None])).tolist(),
+                         [True, True, True, False, False])
+        self.assertEqual(matcher.flags(pd.Series(['x', None, 1.0], dtype=object), na=True).tolist(), [False, True, True])
+        self.assertEqual(matcher.flags(pd.Series(['ローソン', None, 'x', 'ローソン'], dtype='category')).tolist(),
+                         [True, False, False, True])
+
+    def test_query_fallback(self):
+        """--query は pandas で評価される"""
+        import moneyforward
+        args = moneyforward.parser.parse_args(['filter_db', '--sqlite', self.sqlite_file, '--lt', '0'])
+        result = moneyforward.read_filtered_sqlite(args).query("large_category == '食費'", engine='python')
+        self.assertEqual(sorted(result['id'].tolist()), [1, 3])
+
+
+
+class TestApplyCategoryUpdates(unittest.TestCase):
+    """一括更新したカテゴリを、再取得せずにローカルミラーへ書き込む"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.sqlite_file = os.path.join(self.temp_dir, 'test.db')
+        df = pd.DataFrame({'id': [1, 2, 3], 'content': ['a', 'b', 'c'],
+                           'large_category_id': [11, 11, 12], 'large_category': ['食費', '食費', '日用品'],
+                           'middle_category_id': [41, 41, 51], 'middle_category': ['食料品', '食料品', '日用品']})
+        with closing(connect(self.sqlite_file)) as con:
+            upsert(df, 'user_asset_act', 'id', con)
+
+    def tearDown(self):
+        for fn in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, fn))
+        os.rmdir(self.temp_dir)
+
+    def apply(self, groups, fetched):
+        """fetched: 再取得した時に返す id → カテゴリID"""
+        import moneyforward
+        maps = ({11: '食費', 12: '日用品'}, {41: '食料品', 42: '外食', 51: '日用品'})
+        with mock.patch.object(moneyforward, 'get_categories_form_session', return_value=maps), \
+                mock.patch.object(moneyforward, 'request_user_asset_act_records', side_effect=lambda s, ids, *_: ([
+                    dict(id=i, large_category_id=fetched[i][0], middle_category_id=fetched[i][1]) for i in ids], [])) as fetch, \
+                self.assertLogs(moneyforward.logger, 'INFO') as logs:
+            moneyforward.apply_category_updates_to_db(None, groups, self.sqlite_file, 'user_asset_act', verify_sample=1)
+        with closing(sqlite3.connect(self.sqlite_file)) as con:
+            rows = con.execute('SELECT id, large_category_id, middle_category_id, middle_category '
+                               'FROM user_asset_act ORDER BY id').fetchall()
+        return rows, fetch, logs.output
+
+    def test_apply(self):
+        """変更内容を書き込み、1件だけ再取得する"""
+        rows, fetch, logs = self.apply({(11, 42): [1, 3]}, {1: (11, 42), 3: (11, 42)})
+        self.assertEqual(rows, [(1, 11, 42, '外食'), (2, 11, 41, '食料品'), (3, 11, 42, '外食')])
+        self.assertEqual(len(fetch.call_args.args[1]), 1)
+        self.assertFalse(any('differ' in line for line in logs))
+
+    def test_verify_mismatch(self):
+        """再取得した内容が違えば、その内容で上書きして警告する"""
+        rows, _, logs = self.apply({(11, 42): [2]}, {2: (11, 41)})
+        self.assertEqual(rows[1][:3], (2, 11, 41))
+        self.assertTrue(any('differ' in line for line in logs))
+
+    def test_fetch_failure(self):
+        """取得に失敗した取引は飛ばし、取得できた分だけ書き戻す"""
+        import moneyforward
+
+        def fetch(s, id):
+            if id == 2:
+                raise requests.ConnectionError('reset')
+            return {'id': id}
+
+        maps = ({11: '食費'}, {42: '外食'})
+        with mock.patch.object(moneyforward, 'request_user_asset_act_by_id', side_effect=fetch), \
+                mock.patch.object(moneyforward, 'convert_user_asset_act_to_dict',
+                                  side_effect=lambda act, *_: dict(middle_category_id=42)), \
+                mock.patch.object(moneyforward, 'get_categories_form_session', return_value=maps), \
+                self.assertLogs(moneyforward.logger, 'WARNING'):
+            failed = moneyforward.request_update_sqlite_db(None, [1, 2, 3], self.sqlite_file, 'user_asset_act')
+        self.assertEqual(failed, [2])
+        with closing(sqlite3.connect(self.sqlite_file)) as con:
+            self.assertEqual(con.execute('SELECT id, middle_category_id FROM user_asset_act ORDER BY id').fetchall(),
+                             [(1, 42), (2, 41), (3, 42)])
+
+
+if __name__ == '__main__':
+    unittest.main()
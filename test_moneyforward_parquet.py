@@ -0,0 +1,75 @@
+import unittest
+import os
+import shutil
+import tempfile
+from unittest import mock
+import pandas as pd
+
+from moneyforward_parquet import upsert_parquet, query_parquet, list_partitions
+
+try:
+    import pyarrow
+    import duckdb
+    HAS_PARQUET = True
+except ImportError:
+    HAS_PARQUET = False
+
+
+@unittest.skipUnless(HAS_PARQUET, 'pyarrow / duckdb is not installed')
+class TestParquet(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.DataFrame({
+            'id': [1, 2, 3],
+            'recognized_at': ['2024-01-05T10:00:00+09:00', '2024-02-10T10:00:00+09:00', '2025-01-01T10:00:00+09:00'],
+            'amount': [-500, -1200, 300],
+            'large_category': ['食費', '交通費', None],
+        })
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _read(self):
+        return query_parquet(self.root, 'SELECT id, amount FROM user_asset_act ORDER BY id')
+
+    def test_partitioned_by_year_month(self):
+        """recognized_at の年・月で分割される"""
+        self.assertEqual(upsert_parquet(self.df, self.root), 3)
+        self.assertEqual([p[:2] for p in list_partitions(self.root)],
+                         [('2024', '01'), ('2024', '02'), ('2025', '01')])
+
+    def test_idempotent_upsert(self):
+        """同じデータを書き込んでも行は増えず、変更された行は置き換わる"""
+        upsert_parquet(self.df, self.root)
+        upsert_parquet(self.df, self.root)
+        self.assertEqual(self._read()['id'].tolist(), [1, 2, 3])
+
+        new_df = self.df.copy()
+        new_df.loc[1, 'amount'] = -999
+        upsert_parquet(new_df.iloc[[1]], self.root)
+        self.assertEqual(self._read()['amount'].tolist(), [-500, -999, 300])
+
+    def test_moved_row(self):
+        """月が変わった取引は、元の月も書き込む場合に元のパーティションから削除される"""
+        upsert_parquet(self.df, self.root)
+        new_df = pd.concat([self.df.iloc[[0]].assign(recognized_at='2024-02-01T10:00:00+09:00'),
+                            self.df.iloc[[0]].assign(id=4, recognized_at='2024-01-31T10:00:00+09:00')])
+        upsert_parquet(new_df, self.root)
+        result = query_parquet(self.root, 'SELECT recognized_month, list_sort(list(id)) AS ids FROM user_asset_act '
+                                          'WHERE recognized_year = 2024 GROUP BY ALL ORDER BY ALL')
+        self.assertEqual([list(ids) for ids in result['ids']], [[4], [1, 2]])
+
+    def test_reads_written_partitions_only(self):
+        """既存の id は今回書き込む年・月のパーティションからだけ読む"""
+        import pyarrow.parquet as pq
+        upsert_parquet(self.df, self.root)
+        with mock.patch.object(pq, 'read_table', wraps=pq.read_table) as read_table:
+            upsert_parquet(self.df.iloc[[1]].assign(amount=-1), self.root)
+        self.assertEqual({os.path.relpath(c.args[0], self.root).split(os.sep)[1] for c in read_table.call_args_list},
+                         {'recognized_month=02'})
+        self.assertEqual(self._read()['amount'].tolist(), [-500, -1, 300])
+
+
+if __name__ == '__main__':
+    unittest.main()
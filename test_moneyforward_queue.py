@@ -0,0 +1,160 @@
+import unittest
+import os
+import json
+import tempfile
+import threading
+from contextlib import closing
+from unittest import mock
+
+from moneyforward_queue import (MUTATION_QUEUE_TABLE, connect_queue, enqueue_mutations, pending_mutations,
+                                claim_mutations, drain_mutations, apply_mutations, queue_status, retry_failed_mutations)
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, text=''):
+        self.status_code = status_code
+        self.text = text
+
+
+class FakeSession:
+    """一括更新 (PUT JSON)・明細更新 (PUT form)・振替 (POST) を記録するセッション"""
+
+    def __init__(self, status_code=200):
+        self.status_code = status_code
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def respond(self, method, url, params):
+        with self.lock:
+            self.requests.append((method, url.rsplit('/', 1)[-1], params))
+        return FakeResponse(self.status_code, '' if self.status_code == 200 else 'error')
+
+    def put(self, url, data, headers=None):
+        params = data if isinstance(data, dict) else json.loads(data)
+        return self.respond('PUT', url, params)
+
+    def post(self, url, data, headers=None):
+        return self.respond('POST', url, json.loads(data))
+
+
+@mock.patch('moneyforward_queue.get_csrf_token', lambda s: 'token')
+class TestMutationQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.queue_file = os.path.join(self.temp_dir, 'mutation_queue.db')
+
+    def tearDown(self):
+        for fn in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, fn))
+        os.rmdir(self.temp_dir)
+
+    def test_coalesce(self):
+        """同じ取引・同じ種類の変更は最新の1件だけを送る"""
+        with closing(connect_queue(self.queue_file)) as con:
+            enqueue_mutations(con, [(1, 'memo', 'a'), (1, 'category', [11, 41]), (2, 'memo', 'b')])
+            enqueue_mutations(con, [(1, 'memo', 'c')])
+            self.assertEqual([(m['id'], m['field'], m['value']) for m in pending_mutations(con)],
+                             [(1, 'category', [11, 41]), (2, 'memo', 'b'), (1, 'memo', 'c')])
+            self.assertEqual(queue_status(con), {'pending': 3, 'running': 0, 'done': 0, 'failed': 0, 'superseded': 1})
+            with self.assertRaisesRegex(ValueError, 'invalid mutation field'):
+                enqueue_mutations(con, [(1, 'amount', 100)])
+
+    def test_category_batches(self):
+        """カテゴリの変更は変更先ごとに1回の一括更新で送る"""
+        s = FakeSession()
+        mutations = [(i, 'category', [11, 41]) for i in range(1, 6)] + [(6, 'category', [12, 51]), (7, 'memo', 'm')]
+        results = apply_mutations(s, mutations, self.queue_file)
+        self.assertTrue(all(r['ok'] for r in results))
+        bulk = sorted((p['large_category_id'], p['middle_category_id'], sorted(p['ids']))
+                      for method, name, p in s.requests if name == 'transactions_category_bulk_updates')
+        self.assertEqual(bulk, [(11, 41, [1, 2, 3, 4, 5]), (12, 51, [6])])
+        self.assertEqual([(name, p['user_asset_act[memo]']) for method, name, p in s.requests if name == 'update'],
+                         [('update', 'm')])
+        with closing(connect_queue(self.queue_file)) as con:
+            self.assertEqual(queue_status(con)['done'], 7)
+
+    def test_other_mutations(self):
+        """振替・計算対象の変更は対応する API で送る"""
+        s = FakeSession()
+        transfer = dict(partner_account_id_hash='a', partner_sub_account_id_hash='b', partner_act_id=None)
+        apply_mutations(s, [(1, 'transfer', transfer), (2, 'transfer', None), (3, 'is_transfer', 1),
+                            (4, 'is_target', 0)], self.queue_file)
+        self.assertEqual([(method, name) for method, name, p in s.requests],
+                         [('POST', 'change_transfer'), ('POST', 'clear_transfer'), ('PUT', 'update'), ('PUT', 'update')])
+        self.assertEqual(s.requests[2][2]['change_type'], 'enable_transfer')
+        self.assertEqual(s.requests[3][2]['user_asset_act[is_target]'], 0)
+
+    def test_replay_after_restart(self):
+        """送れなかった変更は failed になり、再送待ちに戻した後は最新の値だけを再送する"""
+        results = apply_mutations(FakeSession(status_code=503), [(1, 'memo', 'a'), (2, 'category', [11, 41])],
+                                  self.queue_file)
+        self.assertFalse(any(r['ok'] for r in results))
+        with closing(connect_queue(self.queue_file)) as con:
+            self.assertEqual(queue_status(con)['pending'], 0)
+            self.assertEqual(queue_status(con)['failed'], 2)
+            # 失敗を返した変更は、明示的に戻すまで送らない
+            self.assertEqual(drain_mutations(FakeSession(), con), [])
+            self.assertEqual(retry_failed_mutations(con), 2)
+            enqueue_mutations(con, [(1, 'memo', 'b')])
+
+        s = FakeSession()
+        with closing(connect_queue(self.queue_file)) as con:
+            results = drain_mutations(s, con)
+            self.assertEqual(sorted((r['id'], r['field'], r['ok']) for r in results),
+                             [(1, 'memo', True), (2, 'category', True)])
+            self.assertEqual(queue_status(con), {'pending': 0, 'running': 0, 'done': 2, 'failed': 0, 'superseded': 1})
+            # 2回目は何も送らない
+            self.assertEqual(drain_mutations(s, con), [])
+        self.assertEqual([p.get('user_asset_act[memo]') for method, name, p in s.requests if name == 'update'], ['b'])
+
+    def test_apply_sends_own_mutations(self):
+        """apply_mutations は自分が記録した変更だけを送り、キューに残っている変更は巻き込まない"""
+        with closing(connect_queue(self.queue_file)) as con:
+            enqueue_mutations(con, [(1, 'memo', 'a')])
+        s = FakeSession()
+        results = apply_mutations(s, [(2, 'memo', 'b')], self.queue_file)
+        self.assertEqual([(r['id'], r['ok']) for r in results], [(2, True)])
+        self.assertEqual([p['user_asset_act[memo]'] for method, name, p in s.requests], ['b'])
+        with closing(connect_queue(self.queue_file)) as con:
+            self.assertEqual(queue_status(con)['pending'], 1)
+
+    def test_coalesced_in_batch(self):
+        """同じ呼び出しの中で後の変更にまとめられた変更は、その結果を coalesced として返す"""
+        s = FakeSession()
+        results = apply_mutations(s, [(1, 'memo', 'a'), (1, 'memo', 'b')], self.queue_file)
+        self.assertEqual([(r['value'], r['ok'], r['coalesced']) for r in results], [('a', True, True), ('b', True, False)])
+        self.assertEqual(len(s.requests), 1)
+
+    def test_claim(self):
+        """受け取った変更は running になり、他からは受け取れない。送信中に落ちた変更は時間が経てば戻る"""
+        with closing(connect_queue(self.queue_file)) as con:
+            enqueue_mutations(con, [(1, 'memo', 'a'), (2, 'memo', 'b')])
+            self.assertEqual([m['id'] for m in claim_mutations(con)], [1, 2])
+            with closing(connect_queue(self.queue_file)) as other:
+                self.assertEqual(claim_mutations(other), [])
+                self.assertEqual(drain_mutations(FakeSession(), other), [])
+            self.assertEqual(queue_status(con)['running'], 2)
+            with con:
+                con.execute(f"UPDATE {MUTATION_QUEUE_TABLE} SET updated_at = '2000-01-01T00:00:00' WHERE id = 1")
+            self.assertEqual([m['id'] for m in claim_mutations(con)], [1])
+
+    def test_max_attempts(self):
+        """max_attempts 回失敗した変更は failed にして送らない"""
+        s = FakeSession(status_code=500)
+        with closing(connect_queue(self.queue_file)) as con:
+            enqueue_mutations(con, [(1, 'memo', 'a'), (-2, 'category', [11, 41])])
+            drain_mutations(s, con, max_attempts=2)
+            self.assertEqual(queue_status(con)['pending'], 1)
+            self.assertEqual(queue_status(con)['failed'], 1)  # 負のIDは送らない
+            drain_mutations(s, con, max_attempts=2)
+            self.assertEqual(queue_status(con)['failed'], 2)
+            self.assertEqual(drain_mutations(s, con, max_attempts=2), [])
+            self.assertEqual(retry_failed_mutations(con), 2)
+            self.assertEqual(queue_status(con)['pending'], 2)
+        self.assertEqual(len(s.requests), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import unittest
+import os
+import io
+import json
+import tempfile
+from contextlib import redirect_stdout
+from unittest import mock
+import pandas as pd
+
+from moneyforward_rules import (load_rules, resolve_rule_categories, evaluate_rules, plan_categorize,
+                                group_category_updates)
+from moneyforward_utils import CategoryIndex, save_large_categories_csv
+from test_moneyforward_utils import LARGE_CATEGORIES
+
+
+class TestCategorizeRules(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.DataFrame({
+            'id': [1, 2, 3, 4, 5, -6],
+            'date': ['24/01/05', '24/02/10', '24/03/15', '24/03/31', '25/01/01', '24/02/10'],
+            'content': ['ローソン大阪', 'タイムズ梅田', 'セブン', None, 'ローソン(ポイント利用分)', 'ローソン'],
+            'amount': [-500, -1200, -300, 10000, 50, -500],
+            'large_category_id': [11, 12, 11, 1, 1, 11],
+            'middle_category_id': [41, 51, 44, 1, 2, 41],
+            'service_name': ['財布', 'カード', 'カード', '銀行', 'カード', '財布'],
+            'is_income': [0, 0, 0, 1, 1, 0],
+        })
+        self.rules = [
+            {'name': 'ローソン', 'patterns': 'ローソン', 'exclude_patterns': 'ポイント', 'category': '食料品'},
+            {'name': 'カード', 'service_name': ['カード'], 'lt': 0, 'category': '外食'},
+            {'name': 'コンビニ', 'patterns': ['ローソン', 'セブン'], 'large_category_id': 12, 'middle_category_id': 52},
+        ]
+        self.temp_dir = tempfile.mkdtemp()
+        self.index = CategoryIndex.from_large_categories(LARGE_CATEGORIES)
+
+    def tearDown(self):
+        for fn in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, fn))
+        os.rmdir(self.temp_dir)
+
+    def test_load_rules(self):
+        """JSON と CSV のルールファイルを読み込む"""
+        json_file = os.path.join(self.temp_dir, 'rules.json')
+        with open(json_file, 'w', encoding='utf-8') as f:
+            json.dump(self.rules, f, ensure_ascii=False)
+        self.assertEqual(load_rules(json_file), self.rules)
+
+        csv_file = os.path.join(self.temp_dir, 'rules.csv')
+        pd.DataFrame([{'patterns': '^タイムズ', 'lt': '0', 'category': '駐車場'}, {'service_name': '財布', 'category': '外食'}]
+                     ).to_csv(csv_file, index=False)
+        self.assertEqual(load_rules(csv_file), [
+            {'patterns': '^タイムズ', 'lt': 0, 'category': '駐車場', 'name': '0'},
+            {'service_name': '財布', 'category': '外食', 'name': '1'},
+        ])
+
+        with open(json_file, 'w', encoding='utf-8') as f:
+            json.dump([{'pattern': 'x', 'category': '外食'}], f)
+        with self.assertRaisesRegex(ValueError, 'Unknown rule keys'):
+            load_rules(json_file)
+
+    def test_resolve_rule_categories(self):
+        """カテゴリ名を解決し、解決できない名前は全てまとめて報告する"""
+        self.assertEqual(resolve_rule_categories(self.rules, self.index), [(11, 41), (11, 42), (12, 52)])
+        rules = [{'name': 'a', 'category': 'その他'}, {'name': 'b', 'category': '交通費'}]
+        with self.assertRaisesRegex(ValueError, r'Not Unique Category Name: その他 \(rule a\)\n'
+                                                r'Not Found Category Name: 交通費 \(rule b\)'):
+            resolve_rule_categories(rules, self.index)
+
+    def test_first_match_wins(self):
+        """上のルールが優先される"""
+        self.assertEqual(evaluate_rules(self.df, self.rules).tolist(), [0, 1, 1, -1, 2, 0])
+        self.assertEqual(evaluate_rules(self.df, []).tolist(), [-1] * 6)
+
+    def test_plan_categorize(self):
+        """既に変更先のカテゴリの行とダミーデータは変更しない"""
+        changes = plan_categorize(self.df, self.rules, resolve_rule_categories(self.rules, self.index))
+        self.assertEqual(changes['id'].tolist(), [2, 3, 5])
+        self.assertEqual(changes['rule'].tolist(), ['カード', 'カード', 'コンビニ'])
+        self.assertEqual(group_category_updates(changes), {(11, 42): [2, 3], (12, 52): [5]})
+
+    def parse_categorize_args(self, *options):
+        import moneyforward
+        cache_csv = os.path.join(self.temp_dir, 'categories.csv')
+        save_large_categories_csv(cache_csv, LARGE_CATEGORIES)
+        rules_file = os.path.join(self.temp_dir, 'rules.json')
+        with open(rules_file, 'w', encoding='utf-8') as f:
+            json.dump(self.rules, f, ensure_ascii=False)
+        csv_file = os.path.join(self.temp_dir, 'data.csv')
+        self.df.rename(columns={'service_name': 'account.service.service_name'}).to_csv(csv_file, index=False)
+
+        return moneyforward.parser.parse_args(['--cache_category_csv', cache_csv, 'categorize', rules_file,
+                                               '--csv', csv_file, '-b', '2024-01-01', '-e', '2024-12-31', *options])
+
+    def test_dry_run(self):
+        """--dry_run は変更内容を表示するだけ"""
+        args = self.parse_categorize_args('--dry_run')
+        with redirect_stdout(io.StringIO()) as out:
+            args.func(None, args)
+        self.assertIn('食費/外食 large_category_id 11 middle_category_id 42 (2)', out.getvalue())
+        self.assertIn('2 transactions, 1 categories', out.getvalue())
+
+    @mock.patch('moneyforward.request_category_bulk_updates_with_update_db')
+    def test_confirm(self, bulk_update):
+        """確認で y 以外を答えたら更新しない。--yes なら確認せずに更新する"""
+        args = self.parse_categorize_args()
+        with redirect_stdout(io.StringIO()), mock.patch('builtins.input', return_value='n'):
+            with self.assertRaises(SystemExit):
+                args.func(None, args)
+        bulk_update.assert_not_called()
+
+        args = self.parse_categorize_args('--yes')
+        with redirect_stdout(io.StringIO()), mock.patch('builtins.input') as input_:
+            args.func(None, args)
+        input_.assert_not_called()
+        self.assertEqual(bulk_update.call_args.args[1], {(11, 42): [2, 3]})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import unittest
+import os
+import tempfile
+import sqlite3
+from contextlib import closing
+import pandas as pd
+
+from moneyforward_db import connect, upsert, get_columns, is_strict_table, get_fts_columns
+from moneyforward_schema import sqlite_type, table_schema, migrate, parse_header, apply_header, SQLITE_HEADER
+
+
+class TestSchema(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.sqlite_file = os.path.join(self.temp_dir, 'test.db')
+        self.con = connect(self.sqlite_file)
+        _, _, dtypes_dict = parse_header(['id:Int64', 'orig_content=content:string', 'amount', 'is_income:boolean'])
+        self.schema = table_schema(dtypes_dict)
+
+    def tearDown(self):
+        self.con.close()
+        for fn in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, fn))
+        os.rmdir(self.temp_dir)
+
+    def _types(self):
+        return {c: t for c, (t, _) in get_columns(self.con, 'user_asset_act').items()}
+
+    def test_sqlite_type(self):
+        """型注釈から STRICT の列型への変換"""
+        self.assertEqual(sqlite_type('Int64'), 'INTEGER')
+        self.assertEqual(sqlite_type('int64'), 'INTEGER')
+        self.assertEqual(sqlite_type('boolean'), 'INTEGER')
+        self.assertEqual(sqlite_type('Float64'), 'REAL')
+        self.assertEqual(sqlite_type('str'), 'TEXT')
+        self.assertEqual(sqlite_type('string'), 'TEXT')
+        self.assertEqual(sqlite_type('datetime64[ns]'), 'TEXT')
+        self.assertEqual(sqlite_type('object'), 'ANY')
+
+    def test_create_table(self):
+        """新規テーブルは STRICT で作成する"""
+        self.assertTrue(migrate(self.con, 'user_asset_act', self.schema))
+        self.assertTrue(is_strict_table(self.con, 'user_asset_act'))
+        self.assertEqual(self._types(), {'id': 'INTEGER', 'content': 'TEXT', 'amount': 'ANY', 'is_income': 'INTEGER'})
+        # 同じスキーマでは何もしない
+        self.assertFalse(migrate(self.con, 'user_asset_act', self.schema))
+
+    def test_add_column(self):
+        """列の追加は ALTER TABLE で行う"""
+        migrate(self.con, 'user_asset_act', self.schema)
+        self.assertTrue(migrate(self.con, 'user_asset_act', {**self.schema, 'memo': 'TEXT'}))
+        self.assertEqual(self._types()['memo'], 'TEXT')
+        self.assertFalse(migrate(self.con, 'user_asset_act', {**self.schema, 'memo': 'TEXT'}))
+
+    def test_migrate_untyped_table(self):
+        """pandas で作られた TEXT のテーブルを型付きの STRICT テーブルへ移行する"""
+        df = pd.DataFrame({'id': ['1', '2'], 'content': ['ローソン', 'セブン'], 'amount': [-1, -2],
+                           'is_income': ['0', '1'], 'extra': ['x', None]})
+        with closing(sqlite3.connect(self.sqlite_file)) as con:
+            df.to_sql('user_asset_act', con, index=False)
+        upsert(df.drop(columns='extra'), 'user_asset_act', 'id', self.con)
+
+        self.assertTrue(migrate(self.con, 'user_asset_act', self.schema))
+        self.assertTrue(is_strict_table(self.con, 'user_asset_act'))
+        self.assertEqual(self._types()['extra'], 'ANY')
+        rows = self.con.execute('SELECT id, typeof(id), is_income, extra FROM user_asset_act ORDER BY id').fetchall()
+        self.assertEqual(rows, [(1, 'integer', 0, 'x'), (2, 'integer', 1, None)])
+        # 全文検索インデックスは作り直される
+        self.assertEqual(get_fts_columns(self.con, 'user_asset_act'), {'content'})
+        fts = self.con.execute("SELECT rowid FROM user_asset_act_fts WHERE user_asset_act_fts MATCH 'ローソン'").fetchall()
+        self.assertEqual(fts, [(1,)])
+
+    def test_retype_amount(self):
+        """型注釈の無かった金額・サービスIDの列を SQLITE_HEADER の型へ移行する"""
+        migrate(self.con, 'user_asset_act', {**self.schema, 'service_id': 'ANY'})
+        self.con.executemany('INSERT INTO user_asset_act (id, amount, service_id) VALUES (?, ?, ?)',
+                             [(1, -1200, '7'), (2, None, None)])
+        _, _, dtypes_dict = parse_header(SQLITE_HEADER)
+        self.assertTrue(migrate(self.con, 'user_asset_act', table_schema(dtypes_dict)))
+        types = self._types()
+        self.assertEqual((types['amount'], types['partner_act_amount'], types['service_id']), ('REAL', 'REAL', 'INTEGER'))
+        rows = self.con.execute('SELECT amount, typeof(amount), service_id, typeof(service_id) '
+                                'FROM user_asset_act ORDER BY id').fetchall()
+        self.assertEqual(rows, [(-1200.0, 'real', 7, 'integer'), (None, 'null', None, 'null')])
+
+        # 外貨の小数の金額もそのまま書き込める
+        df, _ = apply_header(pd.DataFrame({'id': [3], 'orig_amount': [12.5]}), SQLITE_HEADER)
+        upsert(df, 'user_asset_act', 'id', self.con)
+        self.assertEqual(self.con.execute('SELECT amount FROM user_asset_act WHERE id = 3').fetchone(), (12.5,))
+
+    def test_invalid_value_rolls_back(self):
+        """型に変換できない値があれば移行しない"""
+        with closing(sqlite3.connect(self.sqlite_file)) as con:
+            pd.DataFrame({'id': ['1', 'a'], 'content': ['A', 'B']}).to_sql('user_asset_act', con, index=False)
+        with self.assertRaises(sqlite3.IntegrityError):
+            migrate(self.con, 'user_asset_act', self.schema)
+        self.assertFalse(is_strict_table(self.con, 'user_asset_act'))
+        self.assertEqual(self._types(), {'id': 'TEXT', 'content': 'TEXT'})
+
+    def test_upsert_typed_frame(self):
+        """parse_header の dtypes を適用したデータを upsert できる"""
+        migrate(self.con, 'user_asset_act', self.schema)
+        df = pd.DataFrame({'id': [1, 2], 'content': ['A', None], 'amount': [-1, 2], 'is_income': [False, None]})
+        df = df.astype({'id': 'Int64', 'content': 'string', 'is_income': 'boolean'})
+        self.assertEqual(upsert(df, 'user_asset_act', 'id', self.con), 2)
+        rows = self.con.execute('SELECT * FROM user_asset_act ORDER BY id').fetchall()
+        self.assertEqual(rows, [(1, 'A', -1, 0), (2, None, 2, None)])
+
+    def test_apply_header(self):
+        """ヘッダーの列を選んで名前を変え、型注釈を適用する（無い列は欠損値）"""
+        df = pd.DataFrame({'id': ['1'], 'orig_content': ['A'], 'other': ['x']})
+        df, dtypes_dict = apply_header(df, ['id:Int64', 'orig_content=content:string', 'is_income:boolean'])
+        self.assertEqual(list(df.columns), ['id', 'content', 'is_income'])
+        self.assertEqual(dtypes_dict, {'id': 'Int64', 'content': 'string', 'is_income': 'boolean'})
+        self.assertEqual(str(df['id'].dtype), 'Int64')
+        self.assertTrue(df['is_income'].isna().all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+import unittest
+import os
+import tempfile
+
+import moneyforward_utils
+from moneyforward_utils import (save_large_categories_csv, CategoryIndex, get_category_index, search_category_sub,
+                                get_categories_form_user_asset_acts, get_categories_form_session)
+
+
+LARGE_CATEGORIES = [
+    {'id': 1, 'name': '収入', 'middle_categories': [
+        {'id': 1, 'name': '給与', 'user_category': False},
+        {'id': 2, 'name': '一時所得', 'user_category': False},
+    ]},
+    {'id': 11, 'name': '食費', 'middle_categories': [
+        {'id': 41, 'name': '食料品', 'user_category': False},
+        {'id': 42, 'name': '外食', 'user_category': False},
+        {'id': 43, 'name': '外食(会社)', 'user_category': True},
+        {'id': 44, 'name': 'その他食費', 'user_category': False},
+    ]},
+    {'id': 12, 'name': '日用品', 'middle_categories': [
+        {'id': 51, 'name': '日用品', 'user_category': False},
+        {'id': 52, 'name': 'その他日用品', 'user_category': False},
+    ]},
+]
+
+
+class TestCategoryIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_csv = os.path.join(self.temp_dir, 'categories.csv')
+        save_large_categories_csv(self.cache_csv, LARGE_CATEGORIES)
+        self.index = CategoryIndex.from_csv(self.cache_csv)
+
+    def tearDown(self):
+        for fn in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, fn))
+        os.rmdir(self.temp_dir)
+
+    def test_id_maps(self):
+        """ID から名前への変換"""
+        self.assertEqual(self.index.large[11], '食費')
+        self.assertEqual(self.index.middle[43], '外食(会社)')
+        self.assertEqual(self.index.middle_to_large[51], 12)
+
+    def test_lookup(self):
+        """完全一致・前方一致・部分一致"""
+        self.assertEqual(self.index.lookup('middle', '外食', 'exact'), [3])
+        self.assertEqual(self.index.lookup('middle', '外食', 'prefix'), [3, 4])
+        self.assertEqual(self.index.lookup('middle', 'その他', 'prefix'), [5, 7])
+        self.assertEqual(self.index.lookup('middle', '日用品', 'substring'), [6, 7])
+        self.assertEqual(self.index.lookup('large', '食', 'substring'), [2, 3, 4, 5])
+        self.assertEqual(self.index.lookup('middle', '交通', 'substring'), [])
+        self.assertEqual(self.index.lookup('middle', '^外食$|^日用品', 'regex'), [3, 6])
+
+    def test_resolve(self):
+        """完全一致を優先し、一意に決まらない場合はエラー"""
+        self.assertEqual(self.index.resolve('外食'), (11, 42))
+        self.assertEqual(self.index.resolve('会社'), (11, 43))
+        self.assertEqual(self.index.resolve('給'), (1, 1))
+        with self.assertRaisesRegex(ValueError, 'Not Unique'):
+            self.index.resolve('その他')
+        self.assertEqual(self.index.resolve('^日用品$'), (12, 51))  # 最後は正規表現
+        with self.assertRaisesRegex(ValueError, 'Not Found'):
+            self.index.resolve('給与', is_income=False)
+        with self.assertRaisesRegex(ValueError, 'Not Found'):
+            self.index.resolve('交通(')
+
+    def test_resolve_many(self):
+        """重複を除いてまとめて解決し、解決できない名前は候補と一緒に返す"""
+        resolved, errors = self.index.resolve_many(['外食', '日用品', '外食', 'その他', '交通費'])
+        self.assertEqual(resolved, {'外食': (11, 42), '日用品': (12, 51)})
+        self.assertEqual(errors, {'その他': [5, 7], '交通費': []})
+        with self.assertRaisesRegex(ValueError, 'Not Unique'):
+            self.index.resolve('その他')  # キャッシュ済みでも同じ例外
+
+    def test_search_category_sub(self):
+        """search_category_sub は CSV の列で絞り込み結果を返す"""
+        df = search_category_sub(None, self.cache_csv, False, large='食費', middle='外食')
+        self.assertEqual(df['middle_category_id'].tolist(), [42, 43])
+        df = search_category_sub(None, self.cache_csv, False, is_income=True)
+        self.assertEqual(df['middle_category_name'].tolist(), ['給与', '一時所得'])
+        # 検索文字列は正規表現（pandas の str.contains と同じ）
+        df = search_category_sub(None, self.cache_csv, False, middle='^外食|日用品$')
+        self.assertEqual(df['middle_category_id'].tolist(), [42, 43, 51, 52])
+        df = search_category_sub(None, self.cache_csv, False, middle='外食(会社)', mode='substring')
+        self.assertEqual(df['middle_category_id'].tolist(), [43])
+
+    def test_to_large_categories(self):
+        """API と同じ入れ子の形に戻せる"""
+        self.assertEqual(self.index.to_large_categories(), LARGE_CATEGORIES)
+
+    def test_shared_per_process(self):
+        """同じキャッシュCSVのインデックスは共有され、CSVが更新されたら読み直す"""
+        index = get_category_index(None, self.cache_csv)
+        self.assertIs(get_category_index(None, self.cache_csv), index)
+        save_large_categories_csv(self.cache_csv, LARGE_CATEGORIES[:1])
+        os.utime(self.cache_csv, ns=(0, 0))
+        self.assertEqual(list(get_category_index(None, self.cache_csv).large), [1])
+
+
+class FakeResponse:
+
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+class FakeSession:
+    """user_asset_acts API の応答を返すセッション（呼び出し回数を数える）"""
+
+    def __init__(self, data):
+        self.data = data
+        self.calls = 0
+
+    def get(self, url, params=None):
+        self.calls += 1
+        return FakeResponse(self.data)
+
+
+class TestCategoryMaps(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.temp_dir, 'category_maps.json')
+        self.response = {'user_asset_acts': [], 'large': {'11': '食費'}, 'middle': {'42': '外食'}}
+
+    def tearDown(self):
+        moneyforward_utils._category_maps.clear()
+        for fn in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, fn))
+        os.rmdir(self.temp_dir)
+
+    def test_cached_from_response(self):
+        """取得したレスポンスの対応表を、APIを呼ばずにファイルから再利用する"""
+        get_categories_form_user_asset_acts(self.response, self.cache_file)
+        moneyforward_utils._category_maps.clear()  # 別プロセスを想定
+        s = FakeSession(self.response)
+        large, middle = get_categories_form_session(s, self.cache_file)
+        self.assertEqual((large[11], large[0], middle[42]), ('食費', '-', '外食'))
+        self.assertEqual(s.calls, 0)
+
+    def test_refresh_on_unknown_id(self):
+        """未知のIDを引いた時だけ1度APIから取り直す"""
+        get_categories_form_user_asset_acts(self.response, self.cache_file)
+        s = FakeSession({'user_asset_acts': [], 'large': {'11': '食費', '12': '日用品'},
+                         'middle': {'42': '外食', '51': '日用品'}})
+        large, middle = get_categories_form_session(s, self.cache_file)
+        self.assertEqual(large[12], '日用品')
+        self.assertEqual(middle.get(51), '日用品')
+        self.assertEqual(middle.get(99, '-'), '-')
+        self.assertEqual(s.calls, 1)
+
+    def test_refresh_on_ttl(self):
+        """期限切れの場合はAPIから取得する"""
+        get_categories_form_user_asset_acts(self.response, self.cache_file)
+        s = FakeSession(self.response)
+        get_categories_form_session(s, self.cache_file, ttl=0)
+        self.assertEqual(s.calls, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
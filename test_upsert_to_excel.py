@@ -3,12 +3,13 @@ import pandas as pd
 import os
 import tempfile
 import warnings
+from unittest import mock
 from openpyxl import load_workbook, Workbook
 from openpyxl.utils import range_boundaries
 from openpyxl.worksheet.table import Table, TableStyleInfo
 
 # cf_term_data.py から upsert_to_excel をインポート
-from cf_term_data import upsert_to_excel, load_excel_sheet
+from cf_term_data import upsert_to_excel, upsert_to_excel_by_year, load_excel_sheet, scan_excel_sheet, changed_cells, save_workbook
 
 class TestUpsertToExcel(unittest.TestCase):
 
@@ -20,12 +21,15 @@ class TestUpsertToExcel(unittest.TestCase):
         })
         self.temp_dir = tempfile.mkdtemp()
         self.excel_file = os.path.join(self.temp_dir, 'test.xlsx')
+        self.index_file = self.excel_file + '.index.json'
         self.sheet_name = 'Sheet1'
         self.unique_index = 'id'
 
     def tearDown(self):
         if os.path.exists(self.excel_file):
             os.remove(self.excel_file)
+        if os.path.exists(self.index_file):
+            os.remove(self.index_file)
         os.rmdir(self.temp_dir)
 
     def _read_excel(self):
@@ -349,6 +353,76 @@ class TestUpsertToExcel(unittest.TestCase):
             self.assertNotEqual(max_row, 10, "Table includes distant row")
             self.assertNotEqual(max_col, 10, "Table includes distant column")
 
+    def test_scan_matches_full_load(self):
+        """読み取り専用スキャンと通常の読み込みの結果が一致するテスト"""
+        upsert_to_excel(self.df, self.sheet_name, self.excel_file, self.unique_index)
+        _, _, existing_df, headers = load_excel_sheet(self.excel_file, self.sheet_name, self.unique_index)
+        scanned_df, scanned_headers = scan_excel_sheet(self.excel_file, self.sheet_name, self.unique_index)
+        self.assertEqual(list(scanned_headers), list(headers))
+        self.assertTrue(scanned_df.equals(existing_df))
+
+    def test_no_write_without_changes(self):
+        """変更が無い場合はファイルを書き込まないテスト"""
+        upsert_to_excel(self.df, self.sheet_name, self.excel_file, self.unique_index)
+        mtime = os.stat(self.excel_file).st_mtime_ns
+        timings = upsert_to_excel(self.df, self.sheet_name, self.excel_file, self.unique_index)
+        self.assertEqual(list(timings), ['scan', 'diff'])
+        self.assertEqual(os.stat(self.excel_file).st_mtime_ns, mtime)
+
+    def test_index_skips_scan(self):
+        """インデックスが新しい間はシートを読まずに更新・追加するテスト"""
+        index_file = self.index_file
+        timings = upsert_to_excel(self.df, self.sheet_name, self.excel_file, self.unique_index, index_file=index_file)
+        self.assertIn('scan', timings)
+        new_df = pd.concat([self.df, pd.DataFrame({'id': [4], 'name': ['D'], 'value': [40]})], ignore_index=True)
+        new_df.loc[1, 'value'] = 99
+        timings = upsert_to_excel(new_df, self.sheet_name, self.excel_file, self.unique_index, index_file=index_file)
+        self.assertNotIn('scan', timings)
+        headers, data = self._read_excel()
+        self.assertEqual(data, [[1, 'A', 10], [2, 'B', 99], [3, 'C', 30], [4, 'D', 40]])
+        # 変更が無ければ書き込まない
+        mtime = os.stat(self.excel_file).st_mtime_ns
+        timings = upsert_to_excel(new_df, self.sheet_name, self.excel_file, self.unique_index, index_file=index_file)
+        self.assertEqual(list(timings), ['diff'])
+        self.assertEqual(os.stat(self.excel_file).st_mtime_ns, mtime)
+
+    def test_stale_index_rescans(self):
+        """Excelで編集された場合はインデックスを使わずに読み直すテスト"""
+        index_file = self.index_file
+        upsert_to_excel(self.df, self.sheet_name, self.excel_file, self.unique_index, index_file=index_file)
+        wb = load_workbook(self.excel_file)
+        ws = wb[self.sheet_name]
+        ws.delete_rows(3)  # id=2 の行を削除
+        wb.save(self.excel_file)
+        timings = upsert_to_excel(self.df, self.sheet_name, self.excel_file, self.unique_index, index_file=index_file)
+        self.assertIn('scan', timings)
+        headers, data = self._read_excel()
+        self.assertEqual(data, [[1, 'A', 10], [3, 'C', 30], [2, 'B', 20]])
+
+    def test_save_locked_file(self):
+        """ロックされたファイルへの保存は一定回数リトライしてエラーになり、元のファイルは壊れないテスト"""
+        upsert_to_excel(self.df, self.sheet_name, self.excel_file, self.unique_index)
+        wb = load_workbook(self.excel_file)
+        wb[self.sheet_name].cell(row=2, column=2, value='Z')
+        with mock.patch('cf_term_data.os.replace', side_effect=PermissionError) as replace:
+            with self.assertRaises(PermissionError):
+                save_workbook(wb, self.excel_file, retries=2, interval=0)
+        self.assertEqual(replace.call_count, 3)
+        self.assertFalse(os.path.exists(self.excel_file + '.tmp'))
+        headers, data = self._read_excel()
+        self.assertEqual(data[0], [1, 'A', 10])
+
+    def test_changed_cells(self):
+        """差分マスクテスト（欠損値同士は一致、既存に無い列は変更あり）"""
+        new_df = pd.DataFrame({'name': ['A', None, 'C'], 'value': [10, 20, 31], 'memo': ['x', 'y', 'z']}, index=[1, 2, 3])
+        old_df = pd.DataFrame({'name': ['C', float('nan'), 'A'], 'value': [30.0, 20.0, 10.0]}, index=[3, 2, 1])
+        mask = changed_cells(new_df, old_df)
+        self.assertEqual(mask.values.tolist(), [
+            [False, False, True],
+            [False, False, True],
+            [False, True, True],
+        ])
+
     def test_manage_table_existing_table_a1_with_overlap(self):
         """既存テーブル（A1含む）で範囲拡張時に重複がある場合のテスト"""
         # 初期データを書き込み
@@ -494,5 +568,72 @@ class TestUpsertToExcel(unittest.TestCase):
     #     # manage_tableは新規作成時に重複チェック
     #     # テストしにくいので、スキップ
 
+class TestUpsertToExcelByYear(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.DataFrame({
+            'id': [1, 2, 3],
+            'recognized_at': ['2023-12-31T00:00:00+09:00', '2024-01-01T00:00:00+09:00', '2024-02-01T00:00:00+09:00'],
+            'value': [10, 20, 30]
+        })
+        self.temp_dir = tempfile.mkdtemp()
+        self.excel_file = os.path.join(self.temp_dir, 'test.xlsx')
+
+    def tearDown(self):
+        for fn in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, fn))
+        os.rmdir(self.temp_dir)
+
+    def _ids(self, excel_file, sheet_name):
+        ws = load_workbook(excel_file)[sheet_name]
+        return [row[0] for row in ws.iter_rows(min_row=2, values_only=True)]
+
+    def test_partition_sheet(self):
+        """年ごとのシートに分けて保存するテスト"""
+        upsert_to_excel_by_year(self.df, 'act', self.excel_file, 'id', 'act', partition='sheet')
+        wb = load_workbook(self.excel_file)
+        self.assertEqual(wb.sheetnames, ['act_2023', 'act_2024'])
+        self.assertIn('act_2024', wb['act_2024'].tables)
+        self.assertEqual(self._ids(self.excel_file, 'act_2023'), [1])
+        self.assertEqual(self._ids(self.excel_file, 'act_2024'), [2, 3])
+
+    def test_partition_sheet_single_load(self):
+        """年ごとのシートでも、ファイルの読み込み・保存は年の数に関わらず1回ずつ"""
+        upsert_to_excel_by_year(self.df, 'act', self.excel_file, 'id', 'act', partition='sheet', index=True)
+        new_df = pd.DataFrame({'id': [1, 3, 5], 'recognized_at': ['2023-12-31T00:00:00+09:00', '2024-02-01T00:00:00+09:00',
+                                                                '2025-01-01T00:00:00+09:00'], 'value': [11, 31, 50]})
+        with mock.patch('cf_term_data.load_workbook', wraps=load_workbook) as loaded, \
+                mock.patch('cf_term_data.save_workbook', wraps=save_workbook) as saved:
+            timings = upsert_to_excel_by_year(new_df, 'act', self.excel_file, 'id', 'act', partition='sheet', index=True)
+        self.assertEqual(list(timings), ['2023', '2024', '2025'])
+        # インデックスの無い 2025 年のシートのための読み取り専用と、書き込みのための読み書きモードで1回ずつ
+        self.assertEqual(loaded.call_count, 2)
+        self.assertEqual(saved.call_count, 1)
+        wb = load_workbook(self.excel_file)
+        self.assertEqual(wb.sheetnames, ['act_2023', 'act_2024', 'act_2025'])
+        self.assertIn('act_2025', wb['act_2025'].tables)
+        self.assertEqual([r[2] for r in wb['act_2024'].iter_rows(min_row=2, values_only=True)], [20, 31])
+        self.assertEqual(self._ids(self.excel_file, 'act_2025'), [5])
+
+    def test_partition_workbook(self):
+        """年ごとのファイルに分け、変更のある年だけを書き込むテスト"""
+        upsert_to_excel_by_year(self.df, 'act', self.excel_file, 'id', partition='workbook', index=True)
+        file_2023 = os.path.join(self.temp_dir, 'test_2023.xlsx')
+        file_2024 = os.path.join(self.temp_dir, 'test_2024.xlsx')
+        self.assertEqual(self._ids(file_2023, 'act'), [1])
+        self.assertEqual(self._ids(file_2024, 'act'), [2, 3])
+
+        mtime = os.stat(file_2023).st_mtime_ns
+        new_df = pd.DataFrame({'id': [4], 'recognized_at': ['2024-03-01T00:00:00+09:00'], 'value': [40]})
+        timings = upsert_to_excel_by_year(new_df, 'act', self.excel_file, 'id', partition='workbook', index=True)
+        self.assertEqual(list(timings), ['2024'])
+        self.assertEqual(os.stat(file_2023).st_mtime_ns, mtime)
+        self.assertEqual(self._ids(file_2024, 'act'), [2, 3, 4])
+
+    def test_missing_recognized_at(self):
+        """recognized_at 列が無い場合のエラーテスト"""
+        with self.assertRaises(ValueError):
+            upsert_to_excel_by_year(self.df.drop(columns='recognized_at'), 'act', self.excel_file, 'id')
+
 if __name__ == '__main__':
     unittest.main()
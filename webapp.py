@@ -1,20 +1,22 @@
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, render_template, jsonify, request, Response, stream_with_context
 from moneyforward_api import (
     request_user_asset_acts, 
-    request_large_categories, 
-    request_transactions_category_bulk_updates, 
     request_manual_user_asset_act_partner_sources,
-    request_change_transfer,
-    request_clear_transfer,
-    request_update_user_asset_act,
-    get_csrf_token
+    request_user_asset_act_by_id,
 )
-from moneyforward_utils import append_row_form_user_asset_acts
+from moneyforward_queue import apply_mutations
+from moneyforward_utils import append_row_form_user_asset_acts, get_category_index
+from moneyforward_db import quote, get_columns, get_fts_columns, fts_table_name, contains_clause
 import os
+import json
+import logging
+import sqlite3
 from datetime import datetime
 import pickle
 import requests
-from contextlib import contextmanager
+from contextlib import contextmanager, closing
+
+logger = logging.getLogger(__name__)
 
 
 app = Flask(__name__)
@@ -22,6 +24,42 @@ COOKIE_FILE = 'mf_cookies.pkl'
 with open(COOKIE_FILE, 'rb') as f:
     app.config['COOKIES_DATA'] = pickle.load(f)
 
+# ローカルミラー (cf_term_data.py --sqlite で作成) があれば、キーワード検索に使う
+app.config['SQLITE_DB'] = os.environ.get('MF_SQLITE_DB')
+app.config['SQLITE_TABLE'] = os.environ.get('MF_SQLITE_TABLE', 'user_asset_act')
+
+# カテゴリ一覧のキャッシュ (moneyforward.py search_category と共通)
+app.config['CATEGORY_CACHE'] = os.environ.get('MF_CATEGORY_CACHE', 'cache_search_categories.csv')
+
+# 取引の変更キュー (moneyforward.py --mutation_queue と共通)
+app.config['MUTATION_QUEUE'] = os.environ.get('MF_MUTATION_QUEUE', 'mutation_queue.db')
+
+# user_asset_acts API の1リクエストあたりの最大取得件数
+ACTS_PAGE_SIZE = 500
+
+# user_asset_acts.py と同じヘッダー定義を使用
+ACTS_LIST_HEADER = 'id is_transfer is_income is_target updated_at content amount large_category_id large_category middle_category_id middle_category memo account.service.service_name sub_account.sub_type sub_account.sub_name'.split()
+
+# 数値の文字列化ルール (JavaScriptの精度落ち対策)
+# {親キー: 文字列化するキー} の形式。親キーの下にある dict (リスト要素を含む) に適用する。
+# is_... フラグは 0/1 のままにしておく (JSで boolean として扱うため)
+ACTS_STRINGIFY_RULES = {
+    'acts': frozenset(['id', 'amount', 'large_category_id', 'middle_category_id']),
+}
+PARTNER_SOURCES_STRINGIFY_RULES = {
+    'sub_account': frozenset(['id']),
+    'partner_candidate_act': frozenset(['id', 'amount']),
+}
+
+# ACTS_LIST_HEADER のうち、ローカルミラーで列名が異なるもの
+LOCAL_ACT_COLUMNS = {
+    'account.service.service_name': 'service_name',
+    'sub_account.sub_type': 'sub_type',
+    'sub_account.sub_name': 'sub_name',
+}
+
+_encode_json = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+
 
 @contextmanager
 def session_from_cookies_data(cookies_data):
@@ -33,6 +71,176 @@ def session_from_cookies_data(cookies_data):
         s.close()
 
 
+def iter_json(obj, stringify_rules, parent_key=None):
+    """
+    obj を JSON 文字列の断片として順に返す。
+    
+    stringify_rules に一致するキーの値はエンコード時に文字列として出力するため、
+    元の dict をコピー・変更する必要がない。
+    
+    Args:
+        obj: JSON 化するオブジェクト（dict, list, スカラー値）
+        stringify_rules (dict): {親キー: 文字列化するキーの集合}
+        parent_key (str, optional): obj を保持している親のキー
+    """
+    if isinstance(obj, dict):
+        keys = stringify_rules.get(parent_key, ())
+        yield '{'
+        for i, (k, v) in enumerate(obj.items()):
+            if i:
+                yield ','
+            yield _encode_json(str(k))
+            yield ':'
+            if k in keys and v is not None and not isinstance(v, (dict, list)):
+                yield _encode_json(str(v))
+            else:
+                yield from iter_json(v, stringify_rules, k)
+        yield '}'
+    elif isinstance(obj, (list, tuple)):
+        yield '['
+        for i, v in enumerate(obj):
+            if i:
+                yield ','
+            yield from iter_json(v, stringify_rules, parent_key)
+        yield ']'
+    else:
+        yield _encode_json(obj)
+
+
+def buffered(chunks, buffer_size=64 * 1024):
+    """細かい断片をまとめて buffer_size 程度ごとに返す（書き込み回数削減）"""
+    buf = []
+    n = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        n += len(chunk)
+        if n >= buffer_size:
+            yield ''.join(buf)
+            buf = []
+            n = 0
+    if buf:
+        yield ''.join(buf)
+
+
+def json_response(chunks):
+    """JSON 断片のイテレータをストリーミングレスポンスとして返す"""
+    return Response(stream_with_context(buffered(chunks)), mimetype='application/json')
+
+
+def rows_from_user_asset_acts(data):
+    """user_asset_acts レスポンスから ACTS_LIST_HEADER 順の行を抽出する"""
+    rows = []
+    # 共通関数を使用してデータを抽出
+    append_row_form_user_asset_acts(rows, data, ACTS_LIST_HEADER)
+    return rows
+
+
+def filter_acts(rows, exclude_large_ids, exclude_middle_ids, has_memo, memo_keyword):
+    """行を辞書に変換し、除外条件に合わないものを返す"""
+    acts = []
+    for row in rows:
+        act = dict(zip(ACTS_LIST_HEADER, row))
+        if act.get('large_category_id') in exclude_large_ids:
+            continue
+        if act.get('middle_category_id') in exclude_middle_ids:
+            continue
+        if has_memo and not act.get('memo'):
+            continue
+        if memo_keyword and memo_keyword not in (act.get('memo') or ''):
+            continue
+        acts.append(act)
+    return acts, len(rows)
+
+
+def search_local_acts(sqlite_file, table, offset, size, keyword=None, memo_keyword=None, select_category=None):
+    """
+    ローカルミラーから content / memo の部分一致で取引を検索する
+    
+    全文検索インデックスがあればそれを使う。
+    
+    Returns:
+        tuple: (ACTS_LIST_HEADER 順の行のリスト, 該当件数)
+    """
+    with closing(sqlite3.connect(sqlite_file)) as con:
+        columns = get_columns(con, table)
+        fts_columns = get_fts_columns(con, table)
+        
+        # ダミーデータ (id <= 0) は一覧に出さない
+        conditions = ['id > 0']
+        params = []
+        for column, text in (('content', keyword), ('memo', memo_keyword)):
+            if text:
+                fts = fts_table_name(table) if column in fts_columns else None
+                clause, clause_params = contains_clause(column, text, fts, regex=False)
+                conditions.append(clause)
+                params.extend(clause_params)
+        if select_category is not None:
+            conditions.append('large_category_id = ?')
+            params.append(select_category)
+        where = ' AND '.join(conditions)
+        
+        select = ', '.join(quote(c) if c in columns else 'NULL'
+                           for c in (LOCAL_ACT_COLUMNS.get(h, h) for h in ACTS_LIST_HEADER))
+        order = next((c for c in ('recognized_at', 'date') if c in columns), 'id')
+        
+        total_count = con.execute(f'SELECT COUNT(*) FROM {quote(table)} WHERE {where}', params).fetchone()[0]
+        rows = con.execute(f'SELECT {select} FROM {quote(table)} WHERE {where} '
+                           f'ORDER BY {quote(order)} DESC, id DESC LIMIT ? OFFSET ?',
+                           [*params, size, offset]).fetchall()
+    return rows, total_count
+
+
+def iter_remote_pages(first_page, total_count, offset, size, params, filters):
+    """
+    変換済みの最初のページ (acts, APIから取得した件数) に続けて、size 件に達するまで
+    残りのページを取得し、(acts, APIから取得した件数) を順に返す
+    """
+    acts, page_count = first_page
+    requested = min(size, ACTS_PAGE_SIZE)
+    fetched_count = 0
+    with session_from_cookies_data(app.config['COOKIES_DATA']) as s:
+        while True:
+            fetched_count += page_count
+            yield acts, page_count
+            
+            remaining = size - fetched_count
+            if remaining <= 0 or page_count < requested or offset + fetched_count >= total_count:
+                break
+            requested = min(remaining, ACTS_PAGE_SIZE)
+            data = request_user_asset_acts(s, offset=offset + fetched_count, size=requested, **params)
+            acts, page_count = filter_acts(rows_from_user_asset_acts(data), *filters)
+
+
+def iter_acts_response(pages, total_count):
+    """(acts, 取得件数) のページを順に /api/acts の JSON として出力する"""
+    fetched_count = 0
+    error = None
+    first = True
+    yield '{"acts":['
+    try:
+        for acts, page_count in pages:
+            fetched_count += page_count
+            for act in acts:
+                if not first:
+                    yield ','
+                first = False
+                yield from iter_json(act, ACTS_STRINGIFY_RULES, 'acts')
+    except Exception as e:
+        # 送信開始後のエラーは、それまでの結果に error を付けて返す
+        logger.exception("get_acts: failed after %d acts", fetched_count)
+        error = str(e)
+    
+    yield '],"total_count":'
+    yield _encode_json(total_count)
+    # APIから取得した実際の件数（ページネーション制御用）
+    yield ',"fetched_count":'
+    yield _encode_json(fetched_count)
+    if error:
+        yield ',"error":'
+        yield _encode_json(error)
+    yield '}'
+
+
 @app.route('/')
 def index():
     notify()
@@ -60,78 +268,65 @@ def get_acts():
     exclude_large_ids = set(int(x) for x in exclude_large.split(',') if x.isdigit())
     exclude_middle_ids = set(int(x) for x in exclude_middle.split(',') if x.isdigit())
 
+    params = dict(
+        keyword=keyword,
+        base_date=base_date,
+        select_category=select_category,
+        is_new=is_new,
+        is_old=is_old,
+        is_continuous=is_continuous
+    )
+    filters = (exclude_large_ids, exclude_middle_ids, has_memo, memo_keyword)
+    
+    use_local = (app.config['SQLITE_DB'] and (keyword or memo_keyword)
+                 and not (base_date or is_new or is_old or is_continuous))
+    
     try:
+        if use_local:
+            # キーワード検索はローカルミラーの全文検索インデックスで行う
+            rows, total_count = search_local_acts(
+                app.config['SQLITE_DB'], app.config['SQLITE_TABLE'], offset, size,
+                keyword=keyword, memo_keyword=memo_keyword, select_category=select_category)
+            return json_response(iter_acts_response([filter_acts(rows, *filters)], total_count))
+        
+        # 最初のページはレスポンス開始前に取得・変換し、エラーは 500 で返す
         with session_from_cookies_data(app.config['COOKIES_DATA']) as s:
-            # API呼び出し
-            data = request_user_asset_acts(
-                s,
-                offset=offset,
-                size=size,
-                keyword=keyword,
-                base_date=base_date,
-                select_category=select_category,
-                is_new=is_new,
-                is_old=is_old,
-                is_continuous=is_continuous
-            )
-
-            # user_asset_acts.py と同じヘッダー定義を使用
-            list_header = 'id is_transfer is_income is_target updated_at content amount large_category_id large_category middle_category_id middle_category memo account.service.service_name sub_account.sub_type sub_account.sub_name'.split()
-            
-            rows = []
-            # 共通関数を使用してデータを抽出
-            append_row_form_user_asset_acts(rows, data, list_header)
-            
-            # リストのリストを辞書のリストに変換してJSONレスポンス用に整形
-            all_acts = [dict(zip(list_header, row)) for row in rows]
-            
-            # フィルタリング実行
-            filtered_acts = []
-            for act in all_acts:
-                lid = act.get('large_category_id')
-                mid = act.get('middle_category_id')
-                
-                if lid in exclude_large_ids:
-                    continue
-                if mid in exclude_middle_ids:
-                    continue
-                if has_memo and not act.get('memo'):
-                    continue
-                if memo_keyword and memo_keyword not in (act.get('memo') or ''):
-                    continue
-                filtered_acts.append(act)
-            
-            # 数値の文字列化 (JavaScriptの精度落ち対策)
-            # id, amount, category_id 等を文字列に変換
-            # is_... フラグは 0/1 のままにしておく (JSで boolean として扱うため)
-            stringified_acts = []
-            for act in filtered_acts:
-                new_act = act.copy()
-                for key in ['id', 'amount', 'large_category_id', 'middle_category_id']:
-                    if key in new_act and new_act[key] is not None:
-                        new_act[key] = str(new_act[key])
-                stringified_acts.append(new_act)
-
-            return jsonify({
-                'acts': stringified_acts, 
-                'total_count': data.get('total_count', 0),
-                'fetched_count': len(all_acts) # APIから取得した実際の件数（ページネーション制御用）
-            })
-            
+            data = request_user_asset_acts(s, offset=offset, size=min(size, ACTS_PAGE_SIZE), **params)
+        first_page = filter_acts(rows_from_user_asset_acts(data), *filters)
+        total_count = data.get('total_count', 0)
     except Exception as e:
         import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
+    
+    # ページサイズを超える要求は、送信しながら残りのページを取得する
+    # （送信開始後のエラーはステータスを変えられないため、本文の "error" で返す）
+    pages = iter_remote_pages(first_page, total_count, offset, size, params, filters)
+    return json_response(iter_acts_response(pages, total_count))
 
 @app.route('/api/categories')
 def get_categories():
     try:
         with session_from_cookies_data(app.config['COOKIES_DATA']) as s:
-            cats = request_large_categories(s)
-            return jsonify(cats)
+            index = get_category_index(s, app.config['CATEGORY_CACHE'])
+        return jsonify(index.to_large_categories())
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def apply_act_mutations(mutations):
+    """変更キューを通して変更を送信し、失敗があればエラーのレスポンスを返す（全て成功したら None）"""
+    with session_from_cookies_data(app.config['COOKIES_DATA']) as s:
+        results = apply_mutations(s, mutations, app.config['MUTATION_QUEUE'])
+    failed = [r for r in results if not r['ok']]
+    if not failed:
+        return None
+    return jsonify({
+        'status': 'error',
+        'message': f"{len(failed)}件の更新に失敗しました ({failed[0]['error']})",
+        'updated_count': len(results) - len(failed),
+        'failed_ids': [r['id'] for r in failed],
+    }), 502
+
 @app.route('/api/bulk_update_category', methods=['POST'])
 def bulk_update_category():
     try:
@@ -144,14 +339,10 @@ def bulk_update_category():
         if not ids or large_category_id is None or middle_category_id is None:
             return jsonify({'status': 'error', 'message': 'Missing required parameters'}), 400
 
-        with session_from_cookies_data(app.config['COOKIES_DATA']) as s:
-            request_transactions_category_bulk_updates(
-                s,
-                large_category_id=large_category_id,
-                middle_category_id=middle_category_id,
-                ids=ids
-            )
-            return jsonify({'status': 'success', 'updated_count': len(ids)})
+        error = apply_act_mutations([(i, 'category', [large_category_id, middle_category_id]) for i in ids])
+        if error:
+            return error
+        return jsonify({'status': 'success', 'updated_count': len(ids)})
 
     except Exception as e:
         import traceback
@@ -172,25 +363,9 @@ def get_partner_sources(id):
     try:
         with session_from_cookies_data(app.config['COOKIES_DATA']) as s:
             data = request_manual_user_asset_act_partner_sources(s, id)
-            
-            # Stringify IDs to prevent JS precision loss
-            if 'manual_user_asset_act_partner_sources' in data:
-                for source in data['manual_user_asset_act_partner_sources']:
-                    if 'sub_account' in source:
-                        sub = source['sub_account']
-                        if 'id' in sub:
-                            sub['id'] = str(sub['id'])
-                        
-                        if 'partner_candidate_acts' in sub:
-                            for candidate in sub['partner_candidate_acts']:
-                                if 'partner_candidate_act' in candidate:
-                                    act = candidate['partner_candidate_act']
-                                    if 'id' in act:
-                                        act['id'] = str(act['id'])
-                                    if 'amount' in act:
-                                        act['amount'] = str(act['amount'])
-
-            return jsonify(data)
+        
+        # Stringify IDs to prevent JS precision loss (エンコード時に変換)
+        return json_response(iter_json(data, PARTNER_SOURCES_STRINGIFY_RULES))
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -203,15 +378,12 @@ def set_transfer(id):
         partner_account_id_hash = data.get('partner_account_id_hash')
         partner_sub_account_id_hash = data.get('partner_sub_account_id_hash')
         partner_act_id = data.get('partner_act_id') # Optional
-        with session_from_cookies_data(app.config['COOKIES_DATA']) as s:
-            request_change_transfer(
-                s, 
-                id, 
-                partner_account_id_hash=partner_account_id_hash, 
-                partner_sub_account_id_hash=partner_sub_account_id_hash,
-                partner_act_id=partner_act_id
-            )
-            return jsonify({'status': 'success'})
+        error = apply_act_mutations([(id, 'transfer', dict(
+            partner_account_id_hash=partner_account_id_hash, 
+            partner_sub_account_id_hash=partner_sub_account_id_hash,
+            partner_act_id=partner_act_id
+        ))])
+        return error or jsonify({'status': 'success'})
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -220,14 +392,28 @@ def set_transfer(id):
 @app.route('/api/act/<id>/transfer', methods=['DELETE'])
 def clear_transfer(id):
     try:
-        with session_from_cookies_data(app.config['COOKIES_DATA']) as s:
-            request_clear_transfer(s, id)
-            return jsonify({'status': 'success'})
+        error = apply_act_mutations([(id, 'transfer', None)])
+        return error or jsonify({'status': 'success'})
     except Exception as e:
         import traceback
         traceback.print_exc()
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+def complete_category(s, id, large_category_id, middle_category_id):
+    """
+    大・中カテゴリの片方だけの変更を、両方そろった変更にする（変更キューに載せるため）
+
+    中カテゴリだけの時はカテゴリ一覧から大カテゴリを、大カテゴリだけの時は現在の取引の中カテゴリを補う。
+    """
+    if middle_category_id:
+        index = get_category_index(s, app.config['CATEGORY_CACHE'])
+        large_category_id = index.middle_to_large.get(int(middle_category_id))
+        if large_category_id is None:
+            raise ValueError(f'unknown middle_category_id: {middle_category_id}')
+    else:
+        middle_category_id = request_user_asset_act_by_id(s, id)['user_asset_act']['middle_category_id']
+    return [large_category_id, middle_category_id]
+
 @app.route('/api/act/<id>', methods=['PUT'])
 def update_act(id):
     try:
@@ -237,18 +423,26 @@ def update_act(id):
         is_target = data.get('is_target')
         memo = data.get('memo')
 
-        with session_from_cookies_data(app.config['COOKIES_DATA']) as s:
-            token = get_csrf_token(s)
-            request_update_user_asset_act(
-                s, 
-                token, 
-                id, 
-                large_category_id=large_category_id,
-                middle_category_id=middle_category_id,
-                is_target=is_target,
-                memo=memo
-            )
-            return jsonify({'status': 'success'})
+        mutations = []
+        if large_category_id and middle_category_id:
+            mutations.append((id, 'category', [large_category_id, middle_category_id]))
+        elif large_category_id or middle_category_id:
+            # 片方だけの変更も、もう片方を補って変更キューを通す
+            with session_from_cookies_data(app.config['COOKIES_DATA']) as s:
+                try:
+                    category = complete_category(s, id, large_category_id, middle_category_id)
+                except ValueError as e:
+                    return jsonify({'status': 'error', 'message': str(e)}), 400
+            mutations.append((id, 'category', category))
+        if is_target is not None:
+            mutations.append((id, 'is_target', is_target))
+        if memo:
+            mutations.append((id, 'memo', memo))
+        if not mutations:
+            return jsonify({'status': 'error', 'message': 'Nothing to update'}), 400
+
+        error = apply_act_mutations(mutations)
+        return error or jsonify({'status': 'success'})
     except Exception as e:
         import traceback
         traceback.print_exc()